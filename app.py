@@ -1,13 +1,54 @@
+import time
+_import_start = time.perf_counter()
 import streamlit as st
 import os
+import asyncio
 import base64
-import re
-from zhipuai import ZhipuAI
+import copy
+import json
+import logging
+import uuid
+from dataclasses import asdict, dataclass
 from datetime import datetime
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
+# langchain、Chroma、sentence-transformers、httpx 等重依赖都在首次使用时才导入，
+# 并由 startup 模块在后台线程中预热，页面无需等待模型加载即可渲染
+import constitution
+import metrics
+import startup
+from formatting import format_ai_content_no_bold, render_reply
+from llm_cache import ResponseCache, make_cache_key
+from prefetch import Prefetcher
+from prompting import MODE_INQUIRY, MODE_MORE_ADVICE, HistorySummary
+from semantic_cache import warmup_profiles, warmup_queries
+from session_store import (
+    SessionHistory,
+    issue_session_token,
+    load_session_secret,
+    new_session_id,
+    open_session_store,
+    verify_session_token,
+)
+from consultation_service import (
+    ConsultationService,
+    GLMClient,
+    ServiceConfig,
+    ServiceRunner,
+    build_prompt_assembler,
+    clean_model_output,
+    get_age_category,
+    strip_partial_marker,
+)
+from knowledge_base import (
+    PROJECT_DIR,
+    SYMPTOM_KEYWORDS,
+    HybridRetriever,
+    SymptomIndex,
+    load_knowledge_documents,
+    load_retriever,
+)
+startup.report.record("imports", time.perf_counter() - _import_start)
+
+logger = logging.getLogger("tcm.app")
 
 # ---------- 样式设置（按钮配色+绿色成功卡片） ----------
 st.set_page_config(
@@ -118,9 +159,10 @@ st.markdown("""
             width: 56px;
             height: 56px;
             border-radius: 50%;
-            object-fit: cover;
             border: 2px solid #3A5F0B;
-            background: #FFF;
+            background-color: #FFF;
+            background-size: cover;
+            background-position: center;
             flex-shrink: 0;
         }
         .doctor-avatar-content {
@@ -140,83 +182,101 @@ st.markdown("""
     """, unsafe_allow_html=True
 )
 
+# 问诊记录每页展示的轮数，更早的记录按需加载，保证每次重跑的页面体积有上限
+HISTORY_PAGE_SIZE = 5
+# 点选症状按选择器中的顺序拼成查询，同一组症状总是得到同一个查询（可命中启动时预热的查询向量）
+PICKER_ORDER = {term: i for i, term in enumerate(term for terms in SYMPTOM_KEYWORDS.values() for term in terms)}
+
+# 回复缓存与会话存储所在目录
+CACHE_DIR = os.environ.get("TCM_CACHE_DIR", os.path.join(PROJECT_DIR, ".cache"))
+# 会话存储：SQLite 文件路径（多个副本可指向同一文件），设为 memory 时只保存在当前进程内
+SESSION_STORE = os.environ.get("TCM_SESSION_STORE", os.path.join(CACHE_DIR, "sessions.sqlite3"))
+SESSION_TTL = int(os.environ.get("TCM_SESSION_TTL", str(3 * 24 * 3600)))
+SESSION_MAX = 10000
+# TCM_SESSION_STORE=memory 时所有会话的内存上限（MB），超出后淘汰最久未访问的会话
+SESSION_MEMORY_MB = int(os.environ.get("TCM_SESSION_MEMORY_MB", "64"))
+# 每个会话常驻内存的消息条数：一页问诊记录，更早的按需从存储读取
+SESSION_WINDOW_MESSAGES = 2 * HISTORY_PAGE_SIZE
+# 会话令牌的签名密钥；未设置时使用与会话存储放在一起的密钥文件（首次启动生成），多个副本共用同一文件即可
+SESSION_SECRET = os.environ.get("TCM_SESSION_SECRET", "")
+SESSION_SECRET_FILE = os.path.join(
+    CACHE_DIR if SESSION_STORE == "memory" else os.path.dirname(os.path.abspath(SESSION_STORE)), "session_secret"
+)
+SESSION_COOKIE = "tcm_session"
+
+@st.cache_resource
+def get_session_store():
+    return open_session_store(SESSION_STORE, SESSION_TTL, SESSION_MAX, SESSION_MEMORY_MB * 1024 * 1024)
+
+@st.cache_resource
+def get_session_secret():
+    return SESSION_SECRET.encode("utf-8") if SESSION_SECRET else load_session_secret(SESSION_SECRET_FILE)
+
+def write_session_cookie(token):
+    # Streamlit 不能设置响应头，由一个不占位置的组件在浏览器端写入 Cookie；会话 ID 不出现在页面地址中，分享链接不会带出问诊记录
+    import streamlit.components.v1 as components
+
+    components.html(
+        f"""<script>parent.document.cookie = "{SESSION_COOKIE}={token}; path=/; max-age={SESSION_TTL}; SameSite=Strict"
+        + (parent.location.protocol === "https:" ? "; Secure" : "");</script>""",
+        height=0,
+    )
+
+def current_session():
+    """返回 (会话 ID, 个人信息)。会话 ID 只由服务端生成：Cookie 中的令牌签名不符，或会话在存储中已不存在（过期、被清理）时一律新开会话。"""
+    cookies = getattr(getattr(st, "context", None), "cookies", None) or {}
+    session_id = verify_session_token(cookies.get(SESSION_COOKIE), get_session_secret())
+    profile = get_session_store().load_profile(session_id) if session_id is not None else None
+    if profile is None:
+        session_id, profile = new_session_id(), {}
+        write_session_cookie(issue_session_token(session_id, get_session_secret()))
+    params = getattr(st, "query_params", None)
+    if params is not None and "sid" in params:
+        # 旧版本放在地址栏里的会话 ID 不再使用，从地址中去掉
+        del params["sid"]
+    return session_id, profile
+
+def restore_session(session_id, profile):
+    st.session_state.session_id = session_id
+    st.session_state.user_gender = profile.get("gender")
+    st.session_state.user_age = profile.get("age")
+    st.session_state.info_collected = profile.get("info_collected", False)
+    st.session_state.selected_symptoms = set(profile.get("symptoms", ()))
+    st.session_state.history_summary = HistorySummary(**profile.get("summary", {}))
+    st.session_state.chat_history = SessionHistory(get_session_store(), session_id, SESSION_WINDOW_MESSAGES)
+
+def save_session():
+    # 个人信息、已选症状或历史摘要变化后写回存储；问诊记录由 SessionHistory 逐条写入
+    get_session_store().save_profile(st.session_state.session_id, {
+        "gender": st.session_state.user_gender,
+        "age": st.session_state.user_age,
+        "info_collected": st.session_state.info_collected,
+        "symptoms": sorted(st.session_state.selected_symptoms),
+        "summary": asdict(st.session_state.history_summary),
+    })
+
 # ----------- session_state初始化 -----------
+# 问诊数据来自会话存储，session_state 只持有最近一页消息；界面状态仍只保存在 session_state
+if "session_id" not in st.session_state:
+    restore_session(*current_session())
 if "show_constitution_test" not in st.session_state:
     st.session_state.show_constitution_test = False
-if "vectorstore" not in st.session_state:
-    st.session_state.vectorstore = None
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "selected_symptoms" not in st.session_state:
-    st.session_state.selected_symptoms = set()
-if "user_gender" not in st.session_state:
-    st.session_state.user_gender = None
-if "user_age" not in st.session_state:
-    st.session_state.user_age = None
-if "info_collected" not in st.session_state:
-    st.session_state.info_collected = False
+if "history_turns_shown" not in st.session_state:
+    st.session_state.history_turns_shown = HISTORY_PAGE_SIZE
 
 # ----------- 工具函数（图片和内容格式化） -----------
+@st.cache_resource
 def get_base64_image(img_path):
+    # 每个进程只读取并编码一次
     with open(img_path, "rb") as f:
         data = f.read()
     return base64.b64encode(data).decode()
 
-def format_ai_content(content):
-    # 修复错误的HTML标签
-    # 1. 修复不正确的加粗标签
-    content = re.sub(r'b>([^<]+?)/b>', r'<b>\1</b>', content)
-    # 2. 修复不正确的换行标签
-    content = re.sub(r'br>', r'<br>', content)
-    
-    # 处理Markdown格式的加粗
-    content = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', content)
-    
-    # 处理数字序号和中文序号前加换行
-    content = re.sub(r'(\d+\.)', r'<br>\1', content)
-    content = re.sub(r'（[一二三四五六七八九十]）', r'<br>\g<0>', content)
-    
-    # 处理主标题
-    content = re.sub(r'([一二三四五六七八九十])、([^\n<]+)', r'<br>\1、\2', content)
-    
-    # 列表点转HTML
-    content = re.sub(r'•\s*(.+)', r'<ul><li>\1</li></ul>', content)
-    
-    # 处理独立的<，但不破坏HTML标签
-    content = re.sub(r'(?<!<)(<)(?![a-z/])', '', content)
-    
-    # 去掉多余空行
-    content = content.replace("\n", "")
-    
-    return content
-
-def format_ai_content_no_bold(content):
-    # 修复错误的HTML标签
-    # 1. 修复不正确的加粗标签（但不添加新的加粗）
-    content = re.sub(r'b>([^<]+?)/b>', r'\1', content)
-    # 2. 修复不正确的换行标签
-    content = re.sub(r'br>', r'<br>', content)
-    
-    # 处理Markdown格式的加粗（不添加HTML加粗）
-    content = re.sub(r'\*\*(.*?)\*\*', r'\1', content)
-    
-    # 处理数字序号和中文序号前加换行
-    content = re.sub(r'(\d+\.)', r'<br>\1', content)
-    content = re.sub(r'（[一二三四五六七八九十]）', r'<br>\g<0>', content)
-    
-    # 处理主标题
-    content = re.sub(r'([一二三四五六七八九十])、([^\n<]+)', r'<br>\1、\2', content)
-    
-    # 列表点转HTML
-    content = re.sub(r'•\s*(.+)', r'<ul><li>\1</li></ul>', content)
-    
-    # 处理独立的<，但不破坏HTML标签
-    content = re.sub(r'(?<!<)(<)(?![a-z/])', '', content)
-    
-    # 去掉多余空行
-    content = content.replace("\n", "")
-    
-    return content
+# 医生头像只以一条 CSS 规则下发一次，消息中只引用 class，不再逐条内联 base64
+st.markdown(
+    f"""<style>.doctor-avatar-img {{ background-image: url(data:image/png;base64,{get_base64_image("images/doctor_avatar.png")}); }}</style>""",
+    unsafe_allow_html=True
+)
 
 def collect_user_info():
     if not st.session_state.info_collected:
@@ -237,21 +297,12 @@ def collect_user_info():
             st.session_state.user_gender = gender
             st.session_state.user_age = age
             st.session_state.info_collected = True
+            save_session()
             st.rerun()
         return False
     return True
 
 # ---------------- 体质测试 ----------------
-CONSTITUTION_QUESTIONS = [
-    {"q": "1. 您手脚发凉的情况多吗？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "阳虚质"},
-    {"q": "2. 您感到精力不济，容易疲乏吗？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "气虚质"},
-    {"q": "3. 您皮肤或口唇感觉干燥吗？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "阴虚质"},
-    {"q": "4. 您感觉身体沉重，或腹部肥满松软吗？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "痰湿质"},
-    {"q": "5. 您面部或鼻部是否总是油光发亮，易生粉刺？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "湿热质"},
-    {"q": "6. 您的皮肤在抓挠后是否容易出现紫色瘀斑？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "血瘀质"},
-    {"q": "7. 您是否经常感到情绪抑郁、紧张焦虑？", "options": ["没有", "很少", "有时", "经常", "总是"], "type": "气郁质"},
-    {"q": "8. 您是否精力充沛、面色红润、适应能力强？", "options": ["是的", "大部分是", "有时是", "很少是", "不是"], "type": "平和质"}
-]
 CONSTITUTION_DESCRIPTIONS = {
     "平和质": "恭喜您！这是最健康的体质。形体匀称健壮，面色红润，精力充沛，适应能力强。请继续保持良好的生活习惯。",
     "气虚质": "表现为元气不足，易疲乏，声音低弱，易出汗，易感冒。建议多食用补气健脾的食物，如山药、黄芪、大枣，并进行适度、缓和的锻炼。",
@@ -261,167 +312,431 @@ CONSTITUTION_DESCRIPTIONS = {
     "湿热质": "湿与热并存，表现为面垢油光，易生痤疮，口苦口干，大便黏滞。建议饮食清淡，多吃清热利湿的食物如绿豆、冬瓜、苦瓜，忌辛辣油腻。",
     "血瘀质": "血液运行不畅，表现为面色晦暗，皮肤粗糙，易出现瘀斑，口唇暗淡。建议多进行可促进血液循环的运动，并可适量食用活血化瘀的食物如山楂、黑木耳。",
     "气郁质": "气的运行不畅，表现为神情抑郁，情感脆弱，烦闷不乐，易失眠。建议多参加社交活动，听轻松音乐，多食用能行气解郁的食物如佛手、玫瑰花茶。",
+    "特禀质": "先天禀赋不足或过敏体质，表现为易打喷嚏、鼻塞流涕，易患荨麻疹、哮喘，对药物、食物、花粉等过敏。建议饮食清淡均衡，避开已知过敏原，季节交替时注意防护。",
 }
-def judge_constitution(answers):
-    scores = {"平和质": 0, "气虚质": 0, "阳虚质": 0, "阴虚质": 0, "痰湿质": 0, "湿热质": 0, "血瘀质": 0, "气郁质": 0}
-    option_map = {"没有": 1, "很少": 2, "有时": 3, "经常": 4, "总是": 5}
-    peaceful_reverse_map = {"是的": 1, "大部分是": 2, "有时是": 3, "很少是": 4, "不是": 5}
-    scores["平和质"] = peaceful_reverse_map[answers[7]]
-    for i in range(7):
-        q_type = CONSTITUTION_QUESTIONS[i]["type"]
-        scores[q_type] = option_map[answers[i]]
-    non_peaceful_scores = {k: v for k, v in scores.items() if k != "平和质"}
-    max_score_type = max(non_peaceful_scores, key=non_peaceful_scores.get)
-    max_score = non_peaceful_scores[max_score_type]
-    if scores["平和质"] <= 2 and all(score < 3 for score in non_peaceful_scores.values()):
-        return "平和质", CONSTITUTION_DESCRIPTIONS["平和质"]
-    if max_score >= 3:
-        return max_score_type, CONSTITUTION_DESCRIPTIONS[max_score_type]
-    else:
-        return "混合或不明显体质", "您的体质倾向不太明显，建议结合具体症状进行综合判断，并保持健康的生活方式。"
+UNCLEAR_CONSTITUTION = ("混合或不明显体质", "您的体质倾向不太明显，建议结合具体症状进行综合判断，并保持健康的生活方式。")
 
 # ----------- 知识库 -----------
-@st.cache_resource
+# 向量检索后端：chroma（默认）、numpy（需先运行 python vector_index.py build 预编译索引）或 bm25
+# 知识库位置与分片见 knowledge_base.KNOWLEDGE_PATH（TCM_KNOWLEDGE 指向目录时每个文件一个分片）
+VECTOR_BACKEND = os.environ.get("TCM_VECTOR_BACKEND", "chroma")
+
+@dataclass
+class LexicalKnowledge:
+    retriever: HybridRetriever
+    symptom_index: SymptomIndex
+    assembler: object
+
+def load_lexical_knowledge():
+    # 在后台线程执行：解析知识库，建立 BM25 兜底检索器、症状→证型倒排表与提示词组装器，三者共用同一份文档
+    with startup.report.phase("warmup:knowledge_documents"):
+        documents = load_knowledge_documents()
+    return LexicalKnowledge(HybridRetriever(documents), SymptomIndex(documents), build_prompt_assembler(documents))
+
 def load_knowledge_base():
-    try:
-        persist_dir = "./chroma_db"
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
-        if os.path.exists(persist_dir):
-            return Chroma(persist_directory=persist_dir, embedding_function=embeddings)
-        st.info("首次运行或知识库更新，正在构建向量数据库...")
-        loader = TextLoader("knowledge/knowledge.txt", encoding="utf-8")
-        documents = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=50)
-        splits = text_splitter.split_documents(documents)
-        vectorstore = Chroma.from_documents(documents=splits, embedding=embeddings, persist_directory=persist_dir)
-        vectorstore.persist()
-        st.success("知识库构建完成并已持久化！")
-        return vectorstore
-    except Exception as e:
-        st.error(f"加载知识库失败：{str(e)}")
-        return None
-
-if st.session_state.vectorstore is None:
-    st.session_state.vectorstore = load_knowledge_base()
-
-try:
-    client = ZhipuAI(api_key=os.environ["ZHIPUAI_API_KEY"])
-except KeyError:
+    # 在后台线程执行：不能调用 st.* 组件，进度与错误通过日志和 kb_loader 状态反馈；
+    # 复用已解析的文档与 BM25 索引，语料在进程内只解析、索引一次
+    lexical = kb_lexical.result()
+    with metrics.timer("load_knowledge_base"):
+        return load_retriever(VECTOR_BACKEND, phase=startup.report.phase, lexical=lexical.retriever)
+
+def get_symptom_index():
+    # 症状选择器 → 证型的倒排表，点选症状时本地即时匹配，不调用模型；知识库解析完成前返回 None
+    return kb_lexical.value.symptom_index if kb_lexical.ready and kb_lexical.value is not None else None
+
+def get_retriever():
+    if kb_loader.ready and kb_loader.value is not None:
+        return kb_loader.value
+    # 向量库就绪前的兜底：纯 BM25 关键词检索（只在检索时等待知识库解析完成）
+    return kb_lexical.result().retriever
+
+if "ZHIPUAI_API_KEY" not in os.environ:
     st.error("❌ 请在Streamlit的Secrets中配置ZHIPUAI_API_KEY。")
     st.stop()
 
-def clean_model_output(text):
-    if text:
-        return text.replace("<|begin_of_box|>", "").replace("<|end_of_box|>", "")
-    return text
-
-def call_zhipu_llm(user_query, history, more_advice=False):
-    related_knowledge = ""
-    if st.session_state.vectorstore:
-        search_k = 8 if more_advice else 4
-        retriever = st.session_state.vectorstore.as_retriever(search_kwargs={"k": search_k})
-        retrieved_docs = retriever.get_relevant_documents(user_query)
-        related_knowledge = "\n".join([doc.page_content for doc in retrieved_docs])
-    
-    # 获取性别和年龄
-    gender = st.session_state.user_gender or "未知"
-    age = st.session_state.user_age or "未知"
-    
-    # 年龄段判断
-    age_category = "未知"
-    if isinstance(age, int):
-        if age <= 14:
-            age_category = "少年期"
-        elif age <= 35:
-            age_category = "青年期"
-        elif age <= 55:
-            age_category = "壮年期"
-        elif age <= 70:
-            age_category = "中年期"
-        else:
-            age_category = "老年期"
-    
-    user_info = f"用户信息：性别 {gender}，年龄 {age}（{age_category}）。"
-    
-    if not history:
-        system_prompt = f"""{user_info}
-作为一名资深的中医专家，你的首要任务是进行严谨的"问诊"。用户刚刚提供了初步症状，你的唯一目标是提出2-3个关键的追问问题，以获取更全面的信息。请遵循以下规则：
-1.  禁止诊断：在这一轮对话中，绝对不允许给出任何形式的证型判断或养生建议。
-2.  聚焦关键问题: 你的问题必须围绕以下核心方面展开：
-    - 过往病史及身体异常指标: 例如："之前有没有严重病史或身体哪些指标不正常如血压血糖？"
-    - 症状持续时间: 例如："这种情况持续多久了？"
-    - 具体表现与诱因: 例如："咳嗽是干咳还是有痰？什么情况下会加重？"
-    - 伴随症状: 根据初步症状，推断并询问可能被忽略的其他相关症状。例如，如果用户说"头痛"，你可以问"是否伴有恶心、畏光或鼻塞？"
-3.  引用知识: 你可以参考以下检索到的资料来构思更专业的问题。
-    --- 检索到的资料 ---
-    {related_knowledge}
-    --- 资料结束 ---
-4.  结尾引导: 在提出问题后，以一句话引导用户回答，例如："请您补充这些信息，以便我能更准确地为您分析。"
-你的回答必须直接以问题开始，简洁明了。"""
-    elif more_advice:
-        system_prompt = f"""{user_info}
-作为一名资深的中医专家，请严格依据以下从本地知识库检索到的资料，为用户提供专业的调理建议。
---- 检索到的资料 ---
-{related_knowledge}
---- 资料结束 ---
-要求：
-1. 内容来源: 你的回答必须完全基于上述"检索到的资料"。
-2. 输出结构: 分"一、膏方建议"、"二、茶饮建议"、"三、药膳建议"、"四、理疗建议"四个部分清晰作答。
-3. 专业性: 语言专业、严谨，给出建议时可简要说明其适应证。
-4. 性别针对性: 根据用户性别（{gender}）结合中医阴阳理论，给出更加针对性的建议。例如，男性属阳，女性属阴，调理方法有所不同。
-5. 年龄特异性: 根据用户年龄段（{age_category}）结合中医盛衰理论，考虑不同年龄段的生理特点。例如，壮年气血充沛，老年气血渐衰，调理方法应有所区别。
-6. 补充原则: 如果资料不全，无法覆盖所有四个方面，请仅就资料中有的部分作答，并明确指出"关于XX方面的建议，资料中暂未提及"。绝不允许自行编撰。
-7. 输出时禁止缩进和多余空格，分层结构请用正常的数字序号和小黑点（•），或直接输出HTML ul/li列表结构，禁止markdown缩进。"""
-    else:
-        system_prompt = f"""{user_info}
-作为一名资深的中医专家，你的任务是基于用户描述的症状及补充信息，结合本地知识库的资料，进行严谨的辨证分析。
---- 检索到的资料 ---
-{related_knowledge}
---- 资料结束 ---
-请遵循以下规则进行回复：
-1. 辨证分析:
-   - 优先引用: 必须优先结合并引用"检索到的资料"进行分析。
-   - 补充诊断: 若资料不足以支撑诊断，你可以结合自身庞大的中医知识库进行补充和推断，但需明确告知用户"根据资料并结合我的知识判断..."。
-   - 性别相关分析: 结合中医阴阳理论，考虑用户性别（{gender}）在辨证中的影响。
-   - 年龄相关分析: 结合中医盛衰理论，考虑用户年龄段（{age_category}）在辨证中的影响。
-2. 养生建议:
-   - 给出3-5条具体、可操作的非药物建议（如饮食、起居、运动、情绪调理）。
-   - 针对性别给出更具针对性的建议，例如：男性阳气更盛，女性阴血更丰等特点。
-   - 针对年龄段给出更精准的建议，例如：青壮年气血旺盛，中老年气血渐衰等特点。
-3. 格式要求:
-   - 回复必须分为"一、辨证分析"和"二、养生建议"两部分。
-   - 语言专业、沉稳、易于理解。"""
-    
-    messages = [{"role": "system", "content": system_prompt}, *history, {"role": "user", "content": user_query}]
+# 进程启动时即在后台解析知识库、预热嵌入模型和向量库，页面首屏不等待语料读取；重跑时不会重复启动
+kb_lexical = startup.background("knowledge_lexical", load_lexical_knowledge)
+kb_loader = startup.background("knowledge_base", load_knowledge_base)
+
+# 流式输出：边生成边渲染，降低用户感知等待；设置 TCM_STREAM=0 可退回整段返回
+STREAM_RESPONSES = os.environ.get("TCM_STREAM", "1") != "0"
+# "获取更多中医建议"的回复缓存，磁盘持久化并在所有会话间共享
+RESPONSE_CACHE_MAX_ENTRIES = 2000
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+# 辨证完成后在后台预取"更多中医建议"，TCM_PREFETCH=0 关闭；同时在途的预取数上限（每个进程）
+PREFETCH_ENABLED = os.environ.get("TCM_PREFETCH", "1") != "0"
+PREFETCH_MAX_INFLIGHT = int(os.environ.get("TCM_PREFETCH_MAX_INFLIGHT", "4"))
+# 点击"获取更多中医建议"时等待仍在生成的预取的最长时间（秒），超时即取消预取、直接调用模型
+PREFETCH_WAIT_SECONDS = float(os.environ.get("TCM_PREFETCH_WAIT", "60"))
+# 流式渲染的最小刷新间隔（秒），避免每个分片都触发一次前端重绘
+STREAM_RENDER_INTERVAL = 0.08
+
+# 模型调用经由异步问诊服务：并发上限、排队背压、限速、重试与熔断都在服务层完成，
+# 服务的事件循环跑在进程级的后台线程里，所有会话共享同一个连接池
+@st.cache_resource
+def get_service_runner():
+    return ServiceRunner()
+
+def build_consultation_service():
+    lexical = kb_lexical.result()
+    config = ServiceConfig.from_env()
+    client = GLMClient(os.environ["ZHIPUAI_API_KEY"], config.base_url, config.request_timeout, config.max_connections)
+    service = ConsultationService(client, get_retriever, lexical.assembler, config, lexical.symptom_index)
+    service.register_metrics()
+    return service
+
+def get_consultation_service():
+    # 进程级单例，由 startup 管理（后台线程中也可调用）；首次调用时等待知识库解析完成，只在需要调用模型时才会用到
+    return startup.background("consultation_service", build_consultation_service).result()
+
+# 指标：TCM_METRICS=1 开启采集，另设 TCM_METRICS_PORT 时在该端口提供 GET /metrics（Prometheus 文本格式）
+METRICS_PORT = int(os.environ.get("TCM_METRICS_PORT", "0"))
+
+@st.cache_resource
+def start_metrics_server():
+    metrics.REGISTRY.gauge("tcm_startup_phase_seconds", "启动各阶段耗时（秒），只记录一次", ("phase",), lambda: [
+        ((phase,), seconds) for phase, seconds in startup.report.as_dict().items()
+    ])
+    return metrics.start_http_server(METRICS_PORT)
+
+if metrics.ENABLED and METRICS_PORT:
+    start_metrics_server()
+
+# TCM_INQUIRY_CACHE_WARMUP=N：在后台用前 N 个常见症状组合预热首轮追问缓存，每个组合按性别 × 年龄段各调用一次模型
+INQUIRY_CACHE_WARMUP = int(os.environ.get("TCM_INQUIRY_CACHE_WARMUP", "0"))
+
+def warm_inquiry_cache(service, runner):
+    # 等向量库就绪后再预热，缓存条目才带有查询向量、可以参与相似匹配；向量库加载失败时只做精确匹配
     try:
-        response = client.chat.completions.create(model="GLM-4.5V", messages=messages, temperature=0.2)
-        cleaned_content = clean_model_output(response.choices[0].message.content)
-        return cleaned_content
-    except Exception as e:
-        return f"❌ API调用失败：{str(e)}"
+        kb_loader.result()
+    except Exception:
+        pass
+    return runner.run(service.warm_inquiry_cache(warmup_queries(INQUIRY_CACHE_WARMUP), warmup_profiles()))
+
+if INQUIRY_CACHE_WARMUP:
+    _runner = get_service_runner()
+    startup.background("inquiry_cache_warmup", lambda: warm_inquiry_cache(get_consultation_service(), _runner))
+
+def retrieve_knowledge(user_query, more_advice=False):
+    return get_consultation_service().retrieve(user_query, more_advice)
+
+def build_llm_messages(user_query, history, more_advice=False, retrieved_docs=None, stats=None):
+    # 性别、年龄和症状摘要来自当前会话，检索与按 token 预算组装由服务层完成
+    messages, prompt_stats = get_consultation_service().build_messages(
+        user_query,
+        history,
+        st.session_state.user_gender or "未知",
+        st.session_state.user_age or "未知",
+        more_advice,
+        retrieved_docs,
+        st.session_state.history_summary,
+    )
+    if stats is not None:
+        stats.update(prompt_stats)
+    return messages
+
+def lookup_inquiry(user_query, history, more_advice=False):
+    # 首轮追问先查语义缓存：性别、年龄段相同且查询相近的首轮回复直接复用，不调用模型
+    if history or more_advice:
+        return None, None
+    return get_consultation_service().lookup_inquiry(
+        user_query, st.session_state.user_gender or "未知", st.session_state.user_age or "未知"
+    )
+
+def cached_inquiry_timings(timings, trace, probe, start):
+    elapsed = time.perf_counter() - start
+    trace.update({"mode": MODE_INQUIRY, "cache": probe.result, "similarity": probe.similarity})
+    if timings is not None:
+        timings.update({"ttft": elapsed, "total": elapsed, "prompt_tokens": 0})
+
+def call_zhipu_llm(user_query, history, more_advice=False, timings=None, retrieved_docs=None):
+    with metrics.trace("consultation_trace", stream=False) as trace:
+        cache_start = time.perf_counter()
+        cached, probe = lookup_inquiry(user_query, history, more_advice)
+        if cached is not None:
+            cached_inquiry_timings(timings, trace, probe, cache_start)
+            return cached
+        prompt_stats, usage = {}, {}
+        messages = build_llm_messages(user_query, history, more_advice, retrieved_docs, prompt_stats)
+        trace["mode"] = prompt_stats["mode"]
+        start = time.perf_counter()
+        try:
+            content = get_service_runner().run(get_consultation_service().complete(messages, prompt_stats["mode"], usage))
+            cleaned_content = clean_model_output(content)
+            get_consultation_service().remember_inquiry(probe, cleaned_content)
+        except Exception as e:
+            cleaned_content = f"❌ API调用失败：{str(e)}"
+        elapsed = time.perf_counter() - start
+        trace.update({"llm": round(elapsed, 4), "usage": usage})
+    if timings is not None:
+        timings.update({"ttft": elapsed, "total": elapsed, "prompt_tokens": prompt_stats["total"]})
+    return cleaned_content
+
+def stream_zhipu_llm(user_query, history, more_advice=False, timings=None, retrieved_docs=None):
+    """逐段产出已清洗的累计文本；timings 中记录首字耗时 ttft、总耗时 total（秒）与提示词估算 token 数。"""
+    timings = {} if timings is None else timings
+    with metrics.trace("consultation_trace", stream=True) as trace:
+        cache_start = time.perf_counter()
+        cached, probe = lookup_inquiry(user_query, history, more_advice)
+        if cached is not None:
+            cached_inquiry_timings(timings, trace, probe, cache_start)
+            yield cached
+            return
+        prompt_stats, usage = {}, {}
+        messages = build_llm_messages(user_query, history, more_advice, retrieved_docs, prompt_stats)
+        trace["mode"] = prompt_stats["mode"]
+        timings["prompt_tokens"] = prompt_stats["total"]
+        start = time.perf_counter()
+        raw = ""
+        try:
+            stream = get_consultation_service().stream(messages, prompt_stats["mode"], usage)
+            for delta in get_service_runner().iterate(stream):
+                if "ttft" not in timings:
+                    timings["ttft"] = time.perf_counter() - start
+                raw += delta
+                yield strip_partial_marker(clean_model_output(raw))
+            final = clean_model_output(raw)
+            get_consultation_service().remember_inquiry(probe, final)
+        except Exception as e:
+            final = f"❌ API调用失败：{str(e)}"
+        timings.setdefault("ttft", time.perf_counter() - start)
+        timings["total"] = time.perf_counter() - start
+        # 生成器与调用方共用同一个 context，调用方在两次取值之间的增量渲染（render_stream）也计入本次 trace
+        trace.update({"llm_ttft": round(timings["ttft"], 4), "llm": round(timings["total"], 4), "usage": usage})
+    yield final
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(os.path.join(CACHE_DIR, "responses.sqlite3"), RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+
+def more_advice_cache_key(user_query, retrieved_docs, gender, age):
+    # 缓存键覆盖模式、规范化后的查询、检索到的记录 ID、性别、年龄段以及该阶段首选模型的参数
+    route = get_consultation_service().config.routes[MODE_MORE_ADVICE][0]
+    return make_cache_key(
+        MODE_MORE_ADVICE,
+        user_query,
+        [doc.metadata.get("record_id") for doc in retrieved_docs],
+        gender or "未知",
+        get_age_category(age),
+        route.model,
+        route.temperature,
+    )
+
+@st.cache_resource
+def get_prefetcher():
+    prefetcher = Prefetcher(get_service_runner(), PREFETCH_MAX_INFLIGHT)
+    metrics.REGISTRY.gauge("tcm_prefetch", "更多建议预取的计数与在途数", ("stat",), lambda: [
+        ((name,), value) for name, value in prefetcher.stats().items()
+    ])
+    return prefetcher
+
+async def prefetch_more_advice(service, cache, user_query, history, gender, age, summary):
+    # 在服务的事件循环上执行，不访问 st.session_state；会话数据由调用方拷贝后传入
+    retrieved_docs = await asyncio.to_thread(service.retrieve, user_query, True)
+    cache_key = more_advice_cache_key(user_query, retrieved_docs, gender, age)
+    cached = await asyncio.to_thread(cache.get, cache_key)
+    if cached is not None:
+        return cached
+    messages, _ = await asyncio.to_thread(
+        service.build_messages, user_query, history, gender or "未知", age or "未知", True, retrieved_docs, summary
+    )
+    advice = clean_model_output(await service.complete(messages, MODE_MORE_ADVICE))
+    await asyncio.to_thread(cache.set, cache_key, advice)
+    return advice
+
+def start_more_advice_prefetch(ai_msg, user_query):
+    """启动成功时把预取键写入 ai_msg 并返回 True。"""
+    if not PREFETCH_ENABLED or ai_msg["html"]["kind"] != "diagnosis" or ai_msg["content"].startswith("❌"):
+        return False
+    key = uuid.uuid4().hex
+    history = st.session_state.chat_history.snapshot()
+    args = (
+        get_consultation_service(),
+        get_response_cache(),
+        user_query,
+        history,
+        st.session_state.user_gender,
+        st.session_state.user_age,
+        copy.deepcopy(st.session_state.history_summary),
+    )
+    if get_prefetcher().start(key, st.session_state.session_id, lambda: prefetch_more_advice(*args)):
+        ai_msg["prefetch_key"] = key
+        return True
+    return False
+
+def cancel_prefetches():
+    # 清空或继续问诊后，之前的预取结果已不再对应当前对话
+    get_prefetcher().cancel_session(st.session_state.session_id)
+
+def get_more_advice(user_query, history, advice_box, prefetch_key=None):
+    with st.spinner("正在检索更多方案..."):
+        advice = get_prefetcher().take(prefetch_key, PREFETCH_WAIT_SECONDS)
+    if advice is not None:
+        return advice
+    retrieved_docs = retrieve_knowledge(user_query, more_advice=True)
+    cache = get_response_cache()
+    cache_key = more_advice_cache_key(user_query, retrieved_docs, st.session_state.user_gender, st.session_state.user_age)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if STREAM_RESPONSES:
+        advice = render_streaming_advice(stream_zhipu_llm(user_query, history, more_advice=True, retrieved_docs=retrieved_docs), advice_box)
+    else:
+        with st.spinner("正在检索更多方案..."):
+            advice = call_zhipu_llm(user_query, history, more_advice=True, retrieved_docs=retrieved_docs)
+    if not advice.startswith("❌"):
+        cache.set(cache_key, advice)
+    return advice
+
+def doctor_block_html(label, color, body_html):
+    return f"""
+        <div class="doctor-avatar-box">
+            <div class="doctor-avatar-img" role="img" aria-label="AI医生头像"></div>
+            <div class="doctor-avatar-content">
+                <span style="color:{color};font-weight:bold;">{label}</span>
+                {body_html}
+            </div>
+        </div>
+        """
+
+def format_latency(timings):
+    if not timings:
+        return ""
+    latency = f" · 首字 {timings['ttft']:.1f}s · 总耗时 {timings['total']:.1f}s"
+    if "prompt_tokens" in timings:
+        latency += f" · 提示词约 {timings['prompt_tokens']} tokens"
+    return latency
+
+def render_streaming_reply(stream):
+    # 增量渲染：每次刷新都对累计文本重新清洗和格式化，出现"二、养生建议"后拆成两个卡片
+    analysis_box = st.empty()
+    suggestion_box = st.empty()
+    analysis_box.markdown(doctor_block_html("🌿 AI专家正在分析...", "#3A5F0B", ""), unsafe_allow_html=True)
+    content = ""
+    last_render = 0.0
+    for content in stream:
+        now = time.perf_counter()
+        if now - last_render < STREAM_RENDER_INTERVAL:
+            continue
+        last_render = now
+        render_reply_sections(content, analysis_box, suggestion_box)
+    render_reply_sections(content, analysis_box, suggestion_box)
+    return content
+
+def advice_card_html(advice):
+    return f"""<div class="success-card">🌟 专业调理方案：<br>{format_ai_content_no_bold(advice)}</div>"""
+
+def render_streaming_advice(stream, advice_box):
+    advice = ""
+    last_render = 0.0
+    for advice in stream:
+        now = time.perf_counter()
+        if now - last_render < STREAM_RENDER_INTERVAL:
+            continue
+        last_render = now
+        advice_box.markdown(advice_card_html(advice), unsafe_allow_html=True)
+    return advice
+
+def reply_blocks_html(rendered):
+    # rendered 为 formatting.render_reply 的结果，只在消息追加时计算一次
+    if rendered["kind"] == "diagnosis":
+        blocks = [doctor_block_html("🌿 中医辨证", "#3A5F0B", rendered["analysis"])]
+        if rendered["suggestions"] is not None:
+            blocks.append(doctor_block_html("🍵 养生建议", "#A0522D", rendered["suggestions"]))
+        return blocks
+    return [doctor_block_html("🤖 AI专家追问", "#3A5F0B", rendered["body"])]
+
+def render_reply_sections(content, analysis_box, suggestion_box):
+    with metrics.timer("render_stream"):
+        blocks = reply_blocks_html(render_reply(content, partial=True))
+    for box, block in zip((analysis_box, suggestion_box), blocks):
+        box.markdown(block, unsafe_allow_html=True)
 
-doctor_avatar_b64 = get_base64_image("images/doctor_avatar.png")
-tcm_logo_b64 = get_base64_image("images/tcm_logo.png")
+# st.fragment（Streamlit 1.37+）让点选症状只重跑选择器这一段；旧版本退回整页重跑
+_picker_fragment = getattr(st, "fragment", None)
+
+def rerun_picker():
+    if _picker_fragment is not None:
+        st.rerun(scope="fragment")
+    st.rerun()
+
+def syndrome_candidates_html(candidates):
+    items = "".join(
+        f"<li><b>{c.name}</b> · 匹配度 {c.score:.0%}（{'、'.join(c.matched)}）</li>" for c in candidates
+    )
+    return f"""<div class="info-card">🩺 <b>按所选症状初步匹配的证型</b>（本地计算，仅供参考，提交后由AI专家进一步问诊）<ul>{items}</ul></div>"""
+
+def symptom_picker():
+    for category, symptoms in SYMPTOM_KEYWORDS.items():
+        with st.expander(f"📌 {category}相关症状"):
+            cols = st.columns(5)
+            for i, symptom in enumerate(symptoms):
+                with cols[i % 5]:
+                    if symptom in st.session_state.selected_symptoms:
+                        if st.button(f"✅ {symptom}", key=f"btn_{symptom}", type="primary"):
+                            st.session_state.selected_symptoms.remove(symptom); save_session(); rerun_picker()
+                    else:
+                        if st.button(f"➕ {symptom}", key=f"btn_{symptom}"):
+                            st.session_state.selected_symptoms.add(symptom); save_session(); rerun_picker()
+    if st.session_state.selected_symptoms:
+        st.markdown("##### 🔍 已选症状：")
+        st.info("、".join(st.session_state.selected_symptoms))
+        symptom_index = get_symptom_index()
+        candidates = symptom_index.match(st.session_state.selected_symptoms, k=3) if symptom_index is not None else []
+        if symptom_index is None:
+            st.caption("📚 知识库加载中，候选证型稍后显示。")
+        elif candidates:
+            st.markdown(syndrome_candidates_html(candidates), unsafe_allow_html=True)
+        if st.button("❌ 清空已选症状"):
+            st.session_state.selected_symptoms = set(); save_session(); rerun_picker()
+
+if _picker_fragment is not None:
+    symptom_picker = _picker_fragment(symptom_picker)
+
+def assistant_message(content, timings=None):
+    with metrics.timer("render"):
+        html = render_reply(content)
+    return {"role": "assistant", "content": content, "timings": timings, "html": html}
+
+def ensure_rendered(ai_msg):
+    # 兼容未缓存 HTML 的旧消息：首次展示时补算并写回
+    if "html" not in ai_msg:
+        ai_msg["html"] = render_reply(ai_msg["content"])
+    if ai_msg.get("more_advice") and "more_advice_html" not in ai_msg:
+        ai_msg["more_advice_html"] = advice_card_html(ai_msg["more_advice"])
+    return ai_msg
 
 if st.session_state.show_constitution_test:
     st.header("🧬 中医体质自测")
     st.markdown('<div class="risk-warning"><strong>⚠️ 风险提示：</strong>本产品仅为AI技术演示，内容仅供参考，不能替代专业医疗诊断。如有健康问题，请及时就医。</div>', unsafe_allow_html=True)
     st.caption("根据您近期的身体感受，选择最符合的选项。")
-    answers = []
-    for i, item in enumerate(CONSTITUTION_QUESTIONS):
-        st.write(f"**{item['q']}**")
-        answer = st.radio(
-            label=f"问题{i+1}",
-            options=item['options'],
-            key=f"test_q_{i}",
-            horizontal=True,
-            label_visibility="collapsed"
-        )
-        answers.append(answer)
-    if st.button("查看我的体质结果", type="primary"):
-        constitution_type, description = judge_constitution(answers)
-        st.success(f"**您的体质类型是：{constitution_type}**")
+    # 标准问卷：湿热质第 6 条按性别二选一，未填写性别时两条都显示
+    with st.form("constitution_test"):
+        answers = {}
+        for i, question in enumerate(constitution.questions_for(st.session_state.user_gender), 1):
+            st.write(f"**{i}. {question.text}**")
+            answer = st.radio(
+                label=question.id,
+                options=constitution.OPTIONS,
+                key=f"test_{question.id}",
+                horizontal=True,
+                label_visibility="collapsed"
+            )
+            answers[question.id] = constitution.OPTIONS.index(answer) + 1
+        submitted = st.form_submit_button("查看我的体质结果", type="primary")
+    if submitted:
+        result = constitution.judge(answers, st.session_state.user_gender)
+        if result.primary is None:
+            constitution_type, description = UNCLEAR_CONSTITUTION
+            st.success(f"**您的体质类型是：{constitution_type}**")
+        else:
+            description = CONSTITUTION_DESCRIPTIONS[result.primary]
+            st.success(f"**您的体质类型是：{result.primary}（{result.primary_result}）**")
         st.info(description)
+        st.table([
+            {"体质": name, "转化分": result.scores[name], "判定": result.results[name]}
+            for name in constitution.CONSTITUTION_TYPES
+        ])
     st.markdown("---")
     if st.button("关闭测试"):
         st.session_state.show_constitution_test = False
@@ -430,7 +745,8 @@ else:
     # 显示页面标题和风险提示
     col_logo, col_main_title, col_main_popup = st.columns([1,5,1])
     with col_logo:
-        st.markdown(f'<img src="data:image/png;base64,{tcm_logo_b64}" width="144" />', unsafe_allow_html=True)
+        # 交给 Streamlit 的媒体服务按 URL 提供，不再内联进页面
+        st.image("images/tcm_logo.png", width=144)
     with col_main_title:
         st.markdown('<h1 class="title">🌿 中医智能小助手</h1>', unsafe_allow_html=True)
         st.markdown('<div class="risk-warning"><strong>⚠️ 风险提示：</strong>本产品仅为AI技术演示，内容仅供参考，不能替代专业医疗诊断。如有健康问题，请及时就医。</div>', unsafe_allow_html=True)
@@ -449,30 +765,18 @@ else:
         with st.expander("⚙️ 个人信息设置"):
             st.write(f"当前信息：{st.session_state.user_gender}，{st.session_state.user_age}岁")
             if st.button("修改个人信息"):
+                cancel_prefetches()
                 st.session_state.info_collected = False
+                save_session()
                 st.rerun()
                 
-        SYMPTOM_KEYWORDS = {
-            "头部": ["头痛", "头晕", "偏头痛", "头重", "头胀"], "呼吸": ["咳嗽", "痰多", "咽痛", "流涕", "鼻塞", "打喷嚏", "呼吸急促"],
-            "消化": ["腹痛", "腹胀", "消化不良", "食欲不振", "恶心", "呕吐"], "睡眠": ["失眠", "多梦", "早醒", "嗜睡", "睡眠质量差"],
-            "情绪": ["焦虑", "抑郁", "烦躁", "易怒", "心神不宁", "心慌", "心悸"], "其他": ["疲劳", "乏力", "手脚冰凉", "出汗异常", "浮肿", "腰酸背痛"]
-        }
-        for category, symptoms in SYMPTOM_KEYWORDS.items():
-            with st.expander(f"📌 {category}相关症状"):
-                cols = st.columns(5)
-                for i, symptom in enumerate(symptoms):
-                    with cols[i % 5]:
-                        if symptom in st.session_state.selected_symptoms:
-                            if st.button(f"✅ {symptom}", key=f"btn_{symptom}", type="primary"):
-                                st.session_state.selected_symptoms.remove(symptom); st.rerun()
-                        else:
-                            if st.button(f"➕ {symptom}", key=f"btn_{symptom}"):
-                                st.session_state.selected_symptoms.add(symptom); st.rerun()
-        if st.session_state.selected_symptoms:
-            st.markdown("##### 🔍 已选症状：")
-            st.info("、".join(st.session_state.selected_symptoms))
-            if st.button("❌ 清空已选症状"):
-                st.session_state.selected_symptoms = set(); st.rerun()
+        symptom_picker()
+        if kb_lexical.error is not None:
+            st.error(f"解析知识库失败：{str(kb_lexical.error)}")
+        elif kb_loader.error is not None:
+            st.warning(f"加载知识库失败：{str(kb_loader.error)}，当前仅使用关键词检索。")
+        elif not kb_loader.ready:
+            st.caption("📚 知识库预热中，当前先使用关键词检索，就绪后自动切换为语义检索。")
         with st.form("input_form", clear_on_submit=True):
             user_input = st.text_area("🌱 补充描述或直接提问：", placeholder="请在此描述您的症状，或回答下方助手提出的问题...所有回答都在该输入框进行", height=120)
             col1, col2 = st.columns(2)
@@ -481,74 +785,66 @@ else:
             with col2:
                 clear_btn = st.form_submit_button("清空记录", type="secondary", use_container_width=True)
         if clear_btn:
-            st.session_state.chat_history = []; st.session_state.selected_symptoms = set(); st.success("✨ 已清空所有记录"); st.rerun()
+            cancel_prefetches()
+            st.session_state.chat_history.clear(); st.session_state.selected_symptoms = set(); st.session_state.history_turns_shown = HISTORY_PAGE_SIZE
+            st.session_state.history_summary.reset(); save_session(); st.success("✨ 已清空所有记录"); st.rerun()
         if submit_btn:
-            symptoms_text = "、".join(st.session_state.selected_symptoms)
+            symptoms_text = "、".join(sorted(st.session_state.selected_symptoms, key=lambda term: PICKER_ORDER.get(term, len(PICKER_ORDER))))
             combined_input = f"{symptoms_text}；{user_input.strip()}" if symptoms_text and user_input.strip() else (symptoms_text or user_input.strip())
             if combined_input:
-                with st.spinner("🌿 AI专家正在分析..."):
-                    ai_response = call_zhipu_llm(combined_input, st.session_state.chat_history)
+                cancel_prefetches()
+                timings = {}
+                if STREAM_RESPONSES:
+                    ai_response = render_streaming_reply(stream_zhipu_llm(combined_input, st.session_state.chat_history, timings=timings))
+                else:
+                    with st.spinner("🌿 AI专家正在分析..."):
+                        ai_response = call_zhipu_llm(combined_input, st.session_state.chat_history, timings=timings)
                 timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                st.session_state.chat_history.append({"role": "user", "content": combined_input, "timestamp": timestamp})
-                st.session_state.chat_history.append({"role": "assistant", "content": ai_response})
+                history = st.session_state.chat_history
+                ai_msg = assistant_message(ai_response, timings)
+                history.extend([{"role": "user", "content": combined_input, "timestamp": timestamp}, ai_msg])
+                if start_more_advice_prefetch(ai_msg, combined_input):
+                    history.save(-1, ai_msg)
                 st.session_state.selected_symptoms = set()
+                save_session()
                 st.rerun()
         if st.session_state.chat_history:
             st.divider()
             st.subheader("📝 问诊记录")
-            for i in range(len(st.session_state.chat_history) - 2, -1, -2):
-                user_msg = st.session_state.chat_history[i]
-                ai_msg = st.session_state.chat_history[i + 1]
-                st.markdown(f'<p class="diagnosis-time">问诊时间：{user_msg["timestamp"]}</p>', unsafe_allow_html=True)
+            history = st.session_state.chat_history
+            total_turns = len(history) // 2
+            shown_turns = min(total_turns, st.session_state.history_turns_shown)
+            oldest_shown = len(history) - 2 * shown_turns
+            # 一次取出本页要展示的消息，超出内存窗口的部分从会话存储批量读取
+            shown = history[oldest_shown:]
+            for i in range(len(history) - 2, oldest_shown - 1, -2):
+                user_msg = shown[i - oldest_shown]
+                ai_msg = shown[i + 1 - oldest_shown]
+                st.markdown(f'<p class="diagnosis-time">问诊时间：{user_msg["timestamp"]}{format_latency(ai_msg.get("timings"))}</p>', unsafe_allow_html=True)
                 st.info(f"👤 您的描述：\n> {user_msg['content']}")
-                content = ai_msg['content']
-                if "一、辨证分析" in content and "二、养生建议" in content:
-                    parts = content.split("二、养生建议")
-                    clean_analysis = parts[0].replace('一、辨证分析', '').strip()
-                    clean_suggestions = parts[1].strip()
-                    st.markdown(
-                        f"""
-                        <div class="doctor-avatar-box">
-                            <img src="data:image/png;base64,{doctor_avatar_b64}" class="doctor-avatar-img" alt="AI医生头像"/>
-                            <div class="doctor-avatar-content">
-                                <span style="color:#3A5F0B;font-weight:bold;">🌿 中医辨证</span>
-                                {format_ai_content(clean_analysis)}
-                            </div>
-                        </div>
-                        """, unsafe_allow_html=True
-                    )
-                    st.markdown(
-                        f"""
-                        <div class="doctor-avatar-box">
-                            <img src="data:image/png;base64,{doctor_avatar_b64}" class="doctor-avatar-img" alt="AI医生头像"/>
-                            <div class="doctor-avatar-content">
-                                <span style="color:#A0522D;font-weight:bold;">🍵 养生建议</span>
-                                {format_ai_content(clean_suggestions)}
-                            </div>
-                        </div>
-                        """, unsafe_allow_html=True
-                    )
+                ensure_rendered(ai_msg)
+                for block in reply_blocks_html(ai_msg["html"]):
+                    st.markdown(block, unsafe_allow_html=True)
+                if ai_msg["html"]["kind"] == "diagnosis":
                     st.markdown("""<div class="continue-card">💡 <b>需要更详细的调理方案？</b><br>点击下方按钮，获取膏方、茶饮、药膳等专业建议。</div>""", unsafe_allow_html=True)
-                    if st.button("获取更多中医建议", key=f"more_{i}"):
-                        with st.spinner("正在检索更多方案..."):
-                            more_advice = call_zhipu_llm(user_msg['content'], st.session_state.chat_history, more_advice=True)
-                        st.markdown(
-                            f"""<div class="success-card">🌟 专业调理方案：<br>{format_ai_content_no_bold(more_advice)}</div>""",
-                            unsafe_allow_html=True
-                        )
-                else:
-                    st.markdown(
-                        f"""
-                        <div class="doctor-avatar-box">
-                            <img src="data:image/png;base64,{doctor_avatar_b64}" class="doctor-avatar-img" alt="AI医生头像"/>
-                            <div class="doctor-avatar-content">
-                                <span style="color:#3A5F0B;font-weight:bold;">🤖 AI专家追问</span>
-                                {format_ai_content(content)}
-                            </div>
-                        </div>
-                        """, unsafe_allow_html=True
-                    )
+                    if ai_msg.get("more_advice_html"):
+                        st.markdown(ai_msg["more_advice_html"], unsafe_allow_html=True)
+                    elif st.button("获取更多中医建议", key=f"more_{i}"):
+                        advice_box = st.empty()
+                        more_advice = get_more_advice(user_msg['content'], history, advice_box, ai_msg.get("prefetch_key"))
+                        advice_box.markdown(advice_card_html(more_advice), unsafe_allow_html=True)
+                        # 写回问诊记录，之后的重绘直接展示，不再请求模型
+                        if not more_advice.startswith("❌"):
+                            ai_msg["more_advice"] = more_advice
+                            ai_msg["more_advice_html"] = advice_card_html(more_advice)
+                            history.save(i + 1, ai_msg)
+                            save_session()
+                            st.rerun()
                 st.divider()
+            if shown_turns < total_turns:
+                if st.button(f"📜 加载更早的记录（还有 {total_turns - shown_turns} 轮）"):
+                    st.session_state.history_turns_shown += HISTORY_PAGE_SIZE
+                    st.rerun()
         with st.expander("💡 使用说明"):
             st.markdown("""
             - **体质测试**: 点击右上角"体质测试"按钮，在弹窗中完成问卷，了解您的基本体质。
@@ -557,3 +853,10 @@ else:
             - **深入调理**: 在获取初步建议后，可点击"获取更多中医建议"得到更详细的方案。
             - **清空记录**: 使用"清空记录"可开始一次全新的问诊。
             """)
+
+# 整页重跑耗时：_import_start 是脚本第一条语句，每次重跑都会重新赋值（以 st.rerun 提前结束的重跑不计）
+metrics.record_stage("rerun", time.perf_counter() - _import_start)
+
+# 首次完整渲染的时间点（相对进程启动），只记录一次，并输出完整的启动报告
+if startup.report.mark("first_paint"):
+    logger.info(json.dumps({"event": "startup_report", **startup.report.as_dict()}, ensure_ascii=False))
@@ -0,0 +1,228 @@
+# ----------- 批量问诊 -----------
+# 离线跑一批预先写好的问诊脚本（如门诊预检的症状描述），不经过 Streamlit 页面。
+# 输入 JSONL 每行一条：{"id": ..., "gender": "女", "age": 42, "turns": [{"query": "..."}, {"query": "...", "more_advice": true}]}，
+# 格式同 benchmarks/consultations.jsonl。每轮走与页面相同的检索 + 提示词组装 + 模型调用，
+# "获取更多中医建议"的轮次不进入对话历史。固定数量的 worker 并发处理，每完成一条即追加写入输出 JSONL。
+# 输出文件同时是断点：重跑时已成功的记录直接跳过，失败的记录重新执行（同一 id 以最后一行为准）；
+# 内容相同的记录只调用一次模型。结束时打印吞吐与延迟统计。
+#
+# 用法：
+#   python batch_runner.py intake.jsonl --output intake.results.jsonl --workers 8
+#   python batch_runner.py benchmarks/consultations.jsonl --output /tmp/out.jsonl --mock     # 进程内模拟模型
+#   TCM_GLM_BASE_URL=http://127.0.0.1:8765 python batch_runner.py ...                       # 本地模拟接口
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+import unicodedata
+
+from consultation_service import ServiceConfig, build_default_service
+from prompting import HistorySummary
+
+logger = logging.getLogger("tcm.batch")
+
+# 每完成多少条输出一次进度
+PROGRESS_EVERY = 20
+
+
+def load_records(path):
+    """返回 [(id, record), ...]；缺少 id 的记录以内容哈希作为 id。"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not record.get("turns") or not all(isinstance(turn.get("query"), str) for turn in record["turns"]):
+                raise ValueError(f"{path}:{line_no} 缺少 turns 或 query")
+            records.append((str(record.get("id") or record_key(record)), record))
+    return records
+
+
+def record_key(record):
+    # 性别、年龄与各轮输入（全角/半角统一、去首尾空白）完全相同的记录视为同一条
+    turns = [
+        [unicodedata.normalize("NFKC", turn["query"]).strip(), bool(turn.get("more_advice"))] for turn in record["turns"]
+    ]
+    payload = json.dumps([record.get("gender"), record.get("age"), turns], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_checkpoint(path):
+    """读取已有输出，返回 {id: 成功的结果行} 与 {key: 成功的结果行}。"""
+    done_ids, done_keys = {}, {}
+    if not os.path.exists(path):
+        return done_ids, done_keys
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次中断时写了一半的行
+                continue
+            if "error" in row:
+                done_ids.pop(row["id"], None)
+            else:
+                done_ids[row["id"]] = row
+                done_keys[row["key"]] = row
+    return done_ids, done_keys
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def percentile(ordered, q):
+    return round(ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)], 4) if ordered else None
+
+
+async def run_record(service, record):
+    history, summary = [], HistorySummary()
+    gender, age = record.get("gender", "未知"), record.get("age", "未知")
+    turns = []
+    start = time.perf_counter()
+    for turn in record["turns"]:
+        more_advice = bool(turn.get("more_advice"))
+        result = await service.consult(turn["query"], history, gender, age, more_advice, summary)
+        turns.append({
+            "query": turn["query"],
+            "more_advice": more_advice,
+            "reply": result["content"],
+            "record_ids": result["record_ids"],
+            "mode": result["prompt"]["mode"],
+            "prompt_tokens": result["prompt"]["total"],
+            "usage": result["usage"],
+            "seconds": result["seconds"],
+        })
+        if not more_advice:
+            history += [{"role": "user", "content": turn["query"]}, {"role": "assistant", "content": result["content"]}]
+    return {"turns": turns, "seconds": round(time.perf_counter() - start, 4)}
+
+
+class BatchRunner:
+    def __init__(self, service, output_path, workers=4):
+        self.service = service
+        self.output_path = output_path
+        self.workers = workers
+        self.stats = {"records": 0, "resumed": 0, "deduplicated": 0, "succeeded": 0, "failed": 0, "llm_calls": 0}
+        self.latencies = []
+        # key → 正在执行或已完成的 Future，内容相同的记录共用一次执行
+        self._results = {}
+
+    def _write(self, out, row):
+        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+
+    async def _execute(self, key, record):
+        try:
+            result = await run_record(self.service, record)
+        except Exception as e:
+            logger.warning("批量问诊 %s 失败：%s", key, e)
+            return {"error": f"{type(e).__name__}: {e}"}
+        self.latencies.append(result["seconds"])
+        return result
+
+    async def _process(self, record_id, record, out):
+        key = record_key(record)
+        future = self._results.get(key)
+        if future is None:
+            future = self._results[key] = asyncio.ensure_future(self._execute(key, record))
+        else:
+            self.stats["deduplicated"] += 1
+        result = await future
+        self._write(out, {"id": record_id, "key": key, "gender": record.get("gender"), "age": record.get("age"), **result})
+        self.stats["failed" if "error" in result else "succeeded"] += 1
+
+    async def run(self, records):
+        done_ids, done_keys = load_checkpoint(self.output_path)
+        pending = asyncio.Queue()
+        for record_id, record in records:
+            self.stats["records"] += 1
+            if record_id in done_ids:
+                self.stats["resumed"] += 1
+                continue
+            key = record_key(record)
+            if key in done_keys:
+                # 之前的运行已有内容相同的成功结果，直接复用
+                self._results[key] = asyncio.get_running_loop().create_future()
+                self._results[key].set_result({name: done_keys[key][name] for name in ("turns", "seconds")})
+            pending.put_nowait((record_id, record))
+        total = pending.qsize()
+        start = time.perf_counter()
+        # 按服务实际发出的上游请求计数：命中首轮追问缓存的轮次不调用模型
+        upstream_start = self.service.upstream_calls
+        with open(self.output_path, "a", encoding="utf-8") as out:
+            if out.tell() and not _ends_with_newline(self.output_path):
+                # 上次中断时写了一半的行：另起一行，新结果不与其拼在一起
+                out.write("\n")
+
+            async def worker():
+                while not pending.empty():
+                    record_id, record = pending.get_nowait()
+                    await self._process(record_id, record, out)
+                    finished = self.stats["succeeded"] + self.stats["failed"]
+                    if finished % PROGRESS_EVERY == 0:
+                        logger.info(json.dumps({"event": "batch_progress", "finished": finished, "total": total}))
+
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+        self.stats["llm_calls"] = self.service.upstream_calls - upstream_start
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        ordered = sorted(self.latencies)
+        return {
+            **self.stats,
+            "seconds": round(elapsed, 3),
+            "records_per_second": round((self.stats["succeeded"] + self.stats["failed"]) / elapsed, 2) if elapsed else None,
+            "llm_calls_per_second": round(self.stats["llm_calls"] / elapsed, 2) if elapsed else None,
+            "consultation_seconds": {f"p{q}": percentile(ordered, q) for q in (50, 95, 99)},
+            "service": self.service.status(),
+        }
+
+
+async def run(args):
+    config = ServiceConfig.from_env()
+    # 排队上限至少容纳所有 worker，批量任务不应被背压拒绝
+    config.max_queue = max(config.max_queue, args.workers)
+    client = None
+    if args.mock:
+        from benchmarks.mock_glm import MockGLMClient
+
+        client = MockGLMClient(args.mock_latency)
+        # 限速是为了保护真实的上游接口，模拟模型不需要
+        config.rate_per_second = 0
+    service = build_default_service(os.environ.get("ZHIPUAI_API_KEY", ""), config, args.vector_index, client)
+    try:
+        return await BatchRunner(service, args.output, args.workers).run(load_records(args.input))
+    finally:
+        await service.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量问诊（JSONL 输入/输出，可断点续跑）")
+    parser.add_argument("input", help="问诊脚本 JSONL")
+    parser.add_argument("--output", required=True, help="结果 JSONL，同时作为断点文件")
+    parser.add_argument("--workers", type=int, default=4, help="同时进行的问诊数")
+    parser.add_argument("--vector-index", help="预编译 NumPy 向量索引目录，不指定时只用 BM25 检索")
+    parser.add_argument("--mock", action="store_true", help="使用进程内的模拟模型，不访问网络")
+    parser.add_argument("--verbose", action="store_true", help="输出每次调用的服务日志")
+    parser.add_argument("--mock-latency", type=float, default=0.05, help="模拟模型的首字延迟（秒）")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if not args.verbose:
+        # 逐轮的 prompt_built 等事件量大，默认只保留进度与告警
+        logging.getLogger("tcm.service").setLevel(logging.WARNING)
+    if not args.mock and "ZHIPUAI_API_KEY" not in os.environ and "TCM_GLM_BASE_URL" not in os.environ:
+        sys.exit("请设置 ZHIPUAI_API_KEY，或使用 --mock / TCM_GLM_BASE_URL 指向本地模拟接口")
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=1))
+
+
+if __name__ == "__main__":
+    main()
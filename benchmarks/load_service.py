@@ -0,0 +1,112 @@
+# ----------- 问诊服务压测 -----------
+# 在同一进程内启动模拟 GLM 接口，再以给定并发向 ConsultationService 发起请求，
+# 输出吞吐、延迟分位数和按类型统计的错误数（JSON）。
+# 用法：python benchmarks/load_service.py --requests 200 --concurrency 50 --stream
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consultation_service import ServiceConfig, build_default_service  # noqa: E402
+from knowledge_base import SYMPTOM_KEYWORDS  # noqa: E402
+from mock_glm import MockGLM  # noqa: E402
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))], 4)
+
+
+def sample_queries(count, seed=0):
+    rng = random.Random(seed)
+    terms = [term for group in SYMPTOM_KEYWORDS.values() for term in group]
+    return ["、".join(rng.sample(terms, rng.randint(1, 3))) for _ in range(count)]
+
+
+async def one_request(service, query, stream):
+    start = time.perf_counter()
+    ttft = None
+    if stream:
+        async for _ in service.consult_stream(query, [], "男", 30):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+    else:
+        await service.consult(query, [], "男", 30)
+    return time.perf_counter() - start, ttft
+
+
+async def run(args):
+    mock = MockGLM(args.latency, args.tokens_per_second, args.error_rate, args.rate_limit)
+    server = await mock.start()
+    port = server.sockets[0].getsockname()[1]
+    config = ServiceConfig(
+        base_url=f"http://127.0.0.1:{port}",
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        rate_per_second=args.rps,
+        burst=args.burst,
+        backoff_base=0.05,
+    )
+    service = build_default_service("mock", config)
+
+    gate = asyncio.Semaphore(args.concurrency)
+    latencies, ttfts, errors = [], [], {}
+
+    async def worker(query):
+        async with gate:
+            try:
+                latency, ttft = await one_request(service, query, args.stream)
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                return
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(query) for query in sample_queries(args.requests)))
+    elapsed = time.perf_counter() - start
+    await service.aclose()
+    server.close()
+    await server.wait_closed()
+
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency": {f"p{q}": percentile(latencies, q) for q in (50, 95, 99)},
+        "ttft": {f"p{q}": percentile(ttfts, q) for q in (50, 95, 99)} if args.stream else None,
+        "errors": errors,
+        "upstream": {"requests": mock.requests, "rate_limited": mock.rejected, "failed": mock.failed},
+        "breaker": service.breaker.state,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="问诊服务压测（模拟 GLM 接口）")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="压测客户端的并发数")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--max-concurrency", type=int, default=ServiceConfig.max_concurrency)
+    parser.add_argument("--max-queue", type=int, default=ServiceConfig.max_queue)
+    parser.add_argument("--rps", type=float, default=ServiceConfig.rate_per_second)
+    parser.add_argument("--burst", type=int, default=ServiceConfig.burst)
+    parser.add_argument("--latency", type=float, default=0.4)
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
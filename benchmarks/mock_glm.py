@@ -0,0 +1,191 @@
+# ----------- 本地模拟 GLM 接口 -----------
+# 实现 /chat/completions 的普通与流式（SSE）两种返回，按参数模拟首字延迟、生成速度、随机 5xx 和 429 限流，
+# 用于离线压测问诊服务的吞吐与尾延迟。回复内容按系统提示词区分问诊、辨证和调理方案三种阶段。
+# MockGLMClient 是不走网络的进程内替身（与 GLMClient 接口相同），延迟固定、没有随机性，供基准测试套件使用。
+# 用法：python benchmarks/mock_glm.py --port 8765 --latency 0.4 --tokens-per-second 80
+#       TCM_GLM_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from http import HTTPStatus
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consultation_service import TokenBucket, http_response, read_http_request, sse_event, sse_headers  # noqa: E402
+from prompting import estimate_tokens  # noqa: E402
+
+INQUIRY_REPLY = "1. 这种情况持续多久了？是否反复发作？\n2. 是否伴有口干口苦、怕冷或出汗异常？\n3. 之前有没有严重病史或血压、血糖等指标异常？\n请您补充这些信息，以便我能更准确地为您分析。"
+DIAGNOSIS_REPLY = """一、辨证分析
+根据资料并结合我的知识判断，您的症状符合**心脾两虚证**的表现。
+1. **病机**：思虑过度，劳伤心脾，气血生化不足，心神失养。
+2. 性别与年龄因素：结合阴阳与盛衰理论，需兼顾气血调养。
+二、养生建议
+1. 饮食调理：
+• 多食山药、大枣、桂圆等健脾养血之品
+• 少吃生冷油腻食物
+2. 起居：规律作息，避免熬夜
+3. 运动：八段锦、散步，每日30分钟
+4. 情绪：保持心情舒畅，避免思虑过度"""
+MORE_ADVICE_REPLY = """一、膏方建议
+• 归脾养心膏（黄芪、龙眼肉、酸枣仁），适用于心脾两虚
+二、茶饮建议
+• 酸枣仁茶，睡前饮用
+三、药膳建议
+• 桂圆莲子粥
+四、理疗建议
+• 按摩神门、三阴交、心俞"""
+
+
+def canned_reply(messages):
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    if "膏方建议" in system:
+        return MORE_ADVICE_REPLY
+    if "辨证分析" in system:
+        return DIAGNOSIS_REPLY
+    return INQUIRY_REPLY
+
+
+def canned_usage(messages, reply):
+    # 与 GLM 返回的 usage 字段同构，token 数按本地估算
+    prompt_tokens = sum(estimate_tokens(msg["content"]) for msg in messages)
+    completion_tokens = estimate_tokens(reply)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+class MockGLMClient:
+    def __init__(self, latency=0.05, tokens_per_second=0.0, chunk_chars=4, model_latency=None):
+        self.latency = latency
+        # 模型名 → 首字延迟，覆盖 latency，用于模拟慢模型触发超时回退
+        self.model_latency = model_latency or {}
+        # 0 表示不模拟生成耗时，只有固定的首字延迟
+        self.tokens_per_second = tokens_per_second
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+
+    def _first_token_delay(self, payload):
+        return self.model_latency.get(payload.get("model"), self.latency)
+
+    def _generation_delay(self, text):
+        return len(text) / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    async def chat(self, payload, usage=None):
+        self.calls += 1
+        reply = canned_reply(payload["messages"])
+        await asyncio.sleep(self._first_token_delay(payload) + self._generation_delay(reply))
+        if usage is not None:
+            usage.update(canned_usage(payload["messages"], reply))
+        return reply
+
+    async def stream_chat(self, payload, usage=None):
+        self.calls += 1
+        reply = canned_reply(payload["messages"])
+        await asyncio.sleep(self._first_token_delay(payload))
+        for start in range(0, len(reply), self.chunk_chars):
+            chunk = reply[start:start + self.chunk_chars]
+            await asyncio.sleep(self._generation_delay(chunk))
+            yield chunk
+        if usage is not None:
+            usage.update(canned_usage(payload["messages"], reply))
+
+    async def aclose(self):
+        pass
+
+
+class MockGLM:
+    def __init__(self, latency=0.4, tokens_per_second=80.0, error_rate=0.0, rate_limit_rps=0.0, chunk_chars=4):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        # 超过该速率的请求返回 429，模拟供应商限流；0 表示不限流
+        self.limiter = TokenBucket(rate_limit_rps, max(1, int(rate_limit_rps)))
+        self.chunk_chars = chunk_chars
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+
+    async def _first_token(self):
+        # 首字延迟带 ±25% 抖动
+        await asyncio.sleep(self.latency * random.uniform(0.75, 1.25))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                method, path, _, body = request
+                if method != "POST" or not path.endswith("/chat/completions"):
+                    writer.write(http_response(HTTPStatus.NOT_FOUND, {"error": "not found"}))
+                    await writer.drain()
+                    continue
+                self.requests += 1
+                payload = json.loads(body)
+                if not self.limiter.try_acquire():
+                    self.rejected += 1
+                    writer.write(http_response(HTTPStatus.TOO_MANY_REQUESTS, {"error": "rate limited"}, {"Retry-After": "1"}))
+                elif random.random() < self.error_rate:
+                    self.failed += 1
+                    writer.write(http_response(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "mock failure"}))
+                elif payload.get("stream"):
+                    await self._stream(payload["messages"], writer)
+                    break
+                else:
+                    reply = canned_reply(payload["messages"])
+                    await self._first_token()
+                    await asyncio.sleep(len(reply) / self.tokens_per_second)
+                    writer.write(http_response(HTTPStatus.OK, {
+                        "id": f"mock-{self.requests}",
+                        "created": int(time.time()),
+                        "model": payload.get("model"),
+                        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": reply}}],
+                        "usage": canned_usage(payload["messages"], reply),
+                    }))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, messages, writer):
+        reply = canned_reply(messages)
+        writer.write(sse_headers())
+        await self._first_token()
+        for start in range(0, len(reply), self.chunk_chars):
+            chunk = reply[start:start + self.chunk_chars]
+            writer.write(sse_event({"choices": [{"index": 0, "delta": {"role": "assistant", "content": chunk}}]}))
+            await writer.drain()
+            await asyncio.sleep(len(chunk) / self.tokens_per_second)
+        writer.write(sse_event({"choices": [{"index": 0, "finish_reason": "stop", "delta": {}}], "usage": canned_usage(messages, reply)}))
+        writer.write(sse_event("[DONE]"))
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """启动服务并返回 asyncio.Server；port=0 时由系统分配端口。"""
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def serve(args):
+    mock = MockGLM(args.latency, args.tokens_per_second, args.error_rate, args.rate_limit)
+    server = await mock.start(args.host, args.port)
+    print(f"模拟 GLM 接口已启动：http://{args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 GLM 接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.4, help="首字延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 500 的比例")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="每秒允许的请求数，超出返回 429；0 表示不限")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# ----------- 问诊记录渲染耗时微基准 -----------
+# 对比每次重跑都重新格式化全部历史消息（旧做法）与追加时渲染一次、重跑只取缓存 HTML 的耗时。
+# 用法：python benchmarks/render_history.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from formatting import render_reply  # noqa: E402
+
+SAMPLE_REPLY = """一、辨证分析
+根据资料并结合我的知识判断，您的症状（头痛、失眠、心烦易怒）符合**肝阳上亢证**的表现。
+1. **病机**：肝阴不足，阳亢于上，上扰清窍。
+2. 性别因素：男性属阳，阳气偏盛，更易肝阳上亢。
+（一）年龄因素：壮年期气血充沛，但工作压力大易致肝郁化火。
+二、养生建议
+1. 饮食调理：
+• 多食芹菜、菊花茶、决明子茶
+• 少吃辛辣刺激及油腻食物
+2. 起居：早睡，避免熬夜，保持情绪稳定
+3. 运动：太极拳、散步，每日30分钟
+"""
+REPEAT = 200
+
+
+def per_rerun_ms(render, history):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        render(history)
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def render_uncached(history):
+    return [render_reply(msg["content"]) for msg in history]
+
+
+def render_cached(history):
+    return [msg["html"] for msg in history]
+
+
+def main():
+    print(f"{'轮数':>6} {'每次重跑全部重新格式化(ms)':>28} {'使用缓存HTML(ms)':>18}")
+    for turns in (1, 5, 10, 20, 40, 80):
+        history = [{"content": SAMPLE_REPLY, "html": render_reply(SAMPLE_REPLY)} for _ in range(turns)]
+        print(f"{turns:>6} {per_rerun_ms(render_uncached, history):>28.3f} {per_rerun_ms(render_cached, history):>18.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+# ----------- 离线基准测试套件 -----------
+# 不启动 Streamlit、不访问网络，直接调用真实代码路径：知识库冷构建/热加载、k=4 与 k=8 检索、
+# 三种问诊阶段的提示词组装、回复格式化，以及按 consultations.jsonl 脚本跑完整的多轮问诊。
+# 模型由 mock_glm.MockGLMClient 代替（固定延迟、确定性回复）。
+# 每个阶段输出 p50/p95/p99 延迟、吞吐与阶段结束时的进程峰值内存，问诊相关阶段另记提示词 token 数；
+# 结果保存为 JSON，可用 --compare 与之前提交的结果对比。
+#
+# 用法：
+#   python benchmarks/suite.py                                   # 结果写入 benchmarks/results/
+#   python benchmarks/suite.py --latency 0.2 --concurrency 8 --stream
+#   python benchmarks/suite.py --compare benchmarks/results/旧结果.json --max-regression 0.2
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from consultation_service import ConsultationService, ServiceConfig, build_prompt_assembler  # noqa: E402
+from formatting import format_ai_content, render_reply  # noqa: E402
+from knowledge_base import KNOWLEDGE_FILE, load_knowledge_entries, load_retriever  # noqa: E402
+from mock_glm import DIAGNOSIS_REPLY, INQUIRY_REPLY, MORE_ADVICE_REPLY, MockGLMClient  # noqa: E402
+from prompting import MODE_DIAGNOSIS, MODE_INQUIRY, MODE_MORE_ADVICE, HistorySummary  # noqa: E402
+
+CORPUS_FILE = os.path.join(BENCH_DIR, "consultations.jsonl")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+CANNED_REPLIES = {MODE_INQUIRY: INQUIRY_REPLY, MODE_DIAGNOSIS: DIAGNOSIS_REPLY, MODE_MORE_ADVICE: MORE_ADVICE_REPLY}
+
+
+def load_corpus(path=CORPUS_FILE):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 计，macOS 以字节计
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(ordered, q):
+    # nearest-rank 分位数
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples, wall_seconds=None):
+    """samples 为单次耗时（秒）；wall_seconds 为并发执行时的总墙钟时间，用于计算吞吐。"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    wall_seconds = wall_seconds or sum(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(1000 * sum(samples) / len(samples), 3),
+        "p50_ms": round(1000 * percentile(ordered, 50), 3),
+        "p95_ms": round(1000 * percentile(ordered, 95), 3),
+        "p99_ms": round(1000 * percentile(ordered, 99), 3),
+        "throughput_per_s": round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+    }
+
+
+def token_summary(counts):
+    if not counts:
+        return None
+    return {"min": min(counts), "mean": round(sum(counts) / len(counts), 1), "max": max(counts)}
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ----------- 各阶段 -----------
+def bench_knowledge_base(args):
+    """bm25：解析 + 倒排索引；chroma / numpy：临时目录中的冷构建与随后的热加载。缺少依赖的后端记为 skipped。"""
+    results = {"bm25:load": summarize(timed(lambda: load_retriever("bm25"), args.repeat))}
+    for backend in ("chroma", "numpy"):
+        workdir = tempfile.mkdtemp(prefix=f"tcm-bench-{backend}-")
+        try:
+            if backend == "chroma":
+                cold = lambda: load_retriever("chroma", persist_dir=os.path.join(workdir, "db"))  # noqa: E731
+                warm = cold
+            else:
+                from vector_index import SentenceTransformerEncoder, build_index
+
+                index_dir = os.path.join(workdir, "index")
+                cold = lambda: build_index(load_knowledge_entries(KNOWLEDGE_FILE), SentenceTransformerEncoder(), index_dir)  # noqa: E731
+                warm = lambda: load_retriever("numpy", index_dir=index_dir)  # noqa: E731
+            results[f"{backend}:cold_build"] = summarize(timed(cold, 1))
+            results[f"{backend}:warm_load"] = summarize(timed(warm, args.kb_repeat))
+        except ImportError as e:
+            results[f"{backend}:cold_build"] = {"skipped": f"缺少依赖：{e.name or e}"}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def bench_retrieval(service, corpus, args):
+    queries = [turn["query"] for item in corpus for turn in item["turns"]]
+    results = {}
+    for more_advice, name in ((False, "k=4"), (True, "k=8")):
+        samples = []
+        for _ in range(args.repeat):
+            for query in queries:
+                start = time.perf_counter()
+                service.retrieve(query, more_advice)
+                samples.append(time.perf_counter() - start)
+        results[name] = summarize(samples)
+    return results
+
+
+def scripted_history(item, mode):
+    # 构造进入该阶段时的对话历史：问诊为空，辨证为一轮追问之后，调理方案为辨证之后
+    turns = item["turns"]
+    if mode == MODE_INQUIRY:
+        return []
+    history = [{"role": "user", "content": turns[0]["query"]}, {"role": "assistant", "content": INQUIRY_REPLY}]
+    if mode == MODE_MORE_ADVICE:
+        history += [{"role": "user", "content": turns[1]["query"]}, {"role": "assistant", "content": DIAGNOSIS_REPLY}]
+    return history
+
+
+def bench_prompts(service, corpus, args):
+    results = {}
+    for mode in (MODE_INQUIRY, MODE_DIAGNOSIS, MODE_MORE_ADVICE):
+        samples, tokens = [], []
+        for _ in range(args.repeat):
+            for item in corpus:
+                history = scripted_history(item, mode)
+                query = item["turns"][-1 if mode == MODE_MORE_ADVICE else 0]["query"]
+                start = time.perf_counter()
+                _, stats = service.build_messages(
+                    query, history, item["gender"], item["age"], mode == MODE_MORE_ADVICE, summary=HistorySummary()
+                )
+                samples.append(time.perf_counter() - start)
+                tokens.append(stats["total"])
+        results[mode] = {**summarize(samples), "prompt_tokens": token_summary(tokens)}
+    return results
+
+
+def bench_formatting(args):
+    results = {}
+    for mode, reply in CANNED_REPLIES.items():
+        results[f"format_ai_content:{mode}"] = summarize(timed(lambda: format_ai_content(reply), args.repeat * 20))
+    results["render_reply:diagnosis"] = summarize(timed(lambda: render_reply(DIAGNOSIS_REPLY), args.repeat * 20))
+    return results
+
+
+async def run_consultation(service, item, stream):
+    """按脚本逐轮问诊，返回 (整次耗时, 每轮耗时, 每轮首字耗时, 每轮提示词 token 数)。"""
+    history, summary = [], HistorySummary()
+    turn_seconds, ttfts, tokens = [], [], []
+    consultation_start = time.perf_counter()
+    for turn in item["turns"]:
+        more_advice = turn.get("more_advice", False)
+        start = time.perf_counter()
+        messages, stats = await asyncio.to_thread(
+            service.build_messages, turn["query"], history, item["gender"], item["age"], more_advice, None, summary
+        )
+        if stream:
+            content, ttft = "", None
+            async for delta in service.stream(messages, stats["mode"]):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                content += delta
+            ttfts.append(ttft)
+        else:
+            content = await service.complete(messages, stats["mode"])
+        render_reply(content)
+        turn_seconds.append(time.perf_counter() - start)
+        tokens.append(stats["total"])
+        # "获取更多中医建议"的结果不进入对话历史，与页面行为一致
+        if not more_advice:
+            history += [{"role": "user", "content": turn["query"]}, {"role": "assistant", "content": content}]
+    return time.perf_counter() - consultation_start, turn_seconds, ttfts, tokens
+
+
+async def bench_consultations(service, corpus, args):
+    gate = asyncio.Semaphore(args.concurrency)
+    consultation_seconds, turn_seconds, ttfts, tokens = [], [], [], []
+
+    async def worker(item):
+        async with gate:
+            total, turns, first_tokens, prompt_tokens = await run_consultation(service, item, args.stream)
+        consultation_seconds.append(total)
+        turn_seconds.extend(turns)
+        ttfts.extend(first_tokens)
+        tokens.extend(prompt_tokens)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(item) for _ in range(args.repeat) for item in corpus))
+    wall = time.perf_counter() - start
+    results = {
+        "consultation": summarize(consultation_seconds, wall),
+        "turn": {**summarize(turn_seconds, wall), "prompt_tokens": token_summary(tokens)},
+    }
+    if args.stream:
+        results["ttft"] = summarize(ttfts, wall)
+    return results
+
+
+def run_suite(args):
+    corpus = load_corpus(args.corpus)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "corpus": {"consultations": len(corpus), "turns": sum(len(item["turns"]) for item in corpus)},
+        },
+        "stages": {},
+    }
+
+    def record(stage, results):
+        for name, summary in results.items():
+            report["stages"][f"{stage}/{name}"] = summary
+        report["stages"][f"{stage}/rss_peak_mb"] = peak_rss_mb()
+        print(f"[{stage}] 完成，峰值内存 {report['stages'][f'{stage}/rss_peak_mb']} MB", file=sys.stderr)
+
+    record("knowledge_base", bench_knowledge_base(args))
+    retriever = load_retriever(args.backend)
+    config = ServiceConfig(
+        rate_per_second=0, max_concurrency=args.concurrency, max_queue=args.concurrency * len(corpus) * args.repeat
+    )
+    client = MockGLMClient(args.latency, args.tokens_per_second)
+    service = ConsultationService(client, lambda: retriever, build_prompt_assembler(retriever.documents), config)
+    record("retrieval", bench_retrieval(service, corpus, args))
+    record("prompt", bench_prompts(service, corpus, args))
+    record("formatting", bench_formatting(args))
+    record("consultations", asyncio.run(bench_consultations(service, corpus, args)))
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def compare(current, baseline_path, max_regression=None):
+    """逐阶段对比 p50/p95，返回超过 max_regression（比例）的回退项。"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"对比基线 {baseline['meta'].get('commit')} → 当前 {current['meta'].get('commit')}")
+    for name, summary in current["stages"].items():
+        before = baseline["stages"].get(name)
+        if not isinstance(summary, dict) or not isinstance(before, dict) or "p50_ms" not in summary or "p50_ms" not in before:
+            continue
+        deltas = {key: (summary[key] - before[key]) / before[key] if before[key] else 0.0 for key in ("p50_ms", "p95_ms")}
+        print(f"  {name:<45} p50 {before['p50_ms']:>10.3f} → {summary['p50_ms']:>10.3f} ms ({deltas['p50_ms']:+.1%})"
+              f"  p95 {deltas['p95_ms']:+.1%}")
+        if max_regression is not None and deltas["p50_ms"] > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试套件")
+    parser.add_argument("--corpus", default=CORPUS_FILE)
+    parser.add_argument("--backend", choices=["bm25", "numpy", "chroma"], default="bm25", help="检索、提示词与问诊阶段使用的检索后端")
+    parser.add_argument("--repeat", type=int, default=20, help="各阶段的重复次数（问诊阶段为整套脚本的重复次数）")
+    parser.add_argument("--kb-repeat", type=int, default=3, help="向量库热加载的重复次数")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟模型的首字延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="模拟模型的生成速度，0 表示不计生成耗时")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的问诊数")
+    parser.add_argument("--stream", action="store_true", help="问诊阶段使用流式输出并统计首字耗时")
+    parser.add_argument("--output", help="结果文件路径，默认 benchmarks/results/<时间>-<提交>.json")
+    parser.add_argument("--compare", help="用于对比的历史结果文件")
+    parser.add_argument("--max-regression", type=float, help="p50 回退超过该比例（如 0.2）时以非零状态退出")
+    args = parser.parse_args()
+
+    report = run_suite(args)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{report['meta']['commit'] or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(json.dumps(report["stages"], ensure_ascii=False, indent=1))
+    print(f"结果已保存到 {output}", file=sys.stderr)
+    if args.compare:
+        regressions = compare(report, args.compare, args.max_regression)
+        if regressions:
+            print(f"以下阶段 p50 回退超过 {args.max_regression:.0%}：{', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
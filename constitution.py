@@ -0,0 +1,351 @@
+# ----------- 中医体质判定 -----------
+# 按中华中医药学会《中医体质分类与判定》（ZYYXH/T157-2009）的标准问卷评分：九种体质共 60 个条目
+# （湿热质第 6 条按性别二选一），部分条目同时计入两种体质，平和质中有 6 条反向计分。
+# 转化分 = (原始分 - 条目数) / (条目数 × 4) × 100；
+# 偏颇体质 ≥40 为"是"、30~39 为"倾向是"；平和质 ≥60 且其余 8 种均 <30 为"是"、均 <40 为"基本是"。
+# 评分写成矩阵运算：答案矩阵（人数 × 条目，未作答为 NaN）乘以条目-体质权重矩阵，一次算出所有人的九项转化分，
+# 页面上的单人测试与社区筛查的批量评分共用这一套引擎。
+#
+# 用法：
+#   python constitution.py questions                          # 列出条目编号与题目（CSV 表头即条目编号）
+#   python constitution.py score answers.csv --output result.csv [--id-column id]
+#   python constitution.py bench --respondents 100000         # 随机答卷的评分耗时
+import argparse
+import csv
+import os
+import sys
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+CONSTITUTION_TYPES = ("平和质", "气虚质", "阳虚质", "阴虚质", "痰湿质", "湿热质", "血瘀质", "气郁质", "特禀质")
+PEACEFUL = 0
+# 答案取值 1~5
+OPTIONS = ("没有（根本不）", "很少（有一点）", "有时（有些）", "经常（相当）", "总是（非常）")
+RESULT_LABELS = ("否", "倾向是", "是")
+PEACEFUL_RESULT_LABELS = ("否", "基本是", "是")
+YES_SCORE = 40
+TENDENCY_SCORE = 30
+PEACEFUL_SCORE = 60
+
+
+@dataclass(frozen=True)
+class Question:
+    id: str
+    text: str
+    # 仅限该性别回答的条目（湿热质第 6 条），None 表示所有人
+    sex: str = None
+
+
+QUESTIONS = (
+    Question("q1", "您手脚发凉吗？"),
+    Question("q2", "您胃脘部、背部或腰膝部怕冷吗？"),
+    Question("q3", "您感到怕冷、衣服比别人穿得多吗？"),
+    Question("q4", "您比一般人耐受不了寒冷（冬天的寒冷，夏天的冷空调、电扇等）吗？"),
+    Question("q5", "您比别人容易患感冒吗？"),
+    Question("q6", "您吃（喝）凉的东西会感到不舒服或者怕吃（喝）凉的东西吗？"),
+    Question("q7", "您受凉或吃（喝）凉的东西后，容易腹泻（拉肚子）吗？"),
+    Question("q8", "您感到手脚心发热吗？"),
+    Question("q9", "您感觉身体、脸上发热吗？"),
+    Question("q10", "您皮肤或口唇干吗？"),
+    Question("q11", "您口唇的颜色比一般人红吗？"),
+    Question("q12", "您容易便秘或大便干燥吗？"),
+    Question("q13", "您面部两颧潮红或偏红吗？"),
+    Question("q14", "您感到眼睛干涩吗？"),
+    Question("q15", "您感到口干咽燥、总想喝水吗？"),
+    Question("q16", "您容易疲乏吗？"),
+    Question("q17", "您容易气短（呼吸短促，接不上气）吗？"),
+    Question("q18", "您容易心慌吗？"),
+    Question("q19", "您容易头晕或站起时晕眩吗？"),
+    Question("q20", "您喜欢安静、懒得说话吗？"),
+    Question("q21", "您说话声音低弱无力吗？"),
+    Question("q22", "您活动量稍大就容易出虚汗吗？"),
+    Question("q23", "您感到胸闷或腹部胀满吗？"),
+    Question("q24", "您感到身体沉重不轻松或不爽快吗？"),
+    Question("q25", "您腹部肥满松软吗？"),
+    Question("q26", "您有额部油脂分泌多的现象吗？"),
+    Question("q27", "您上眼睑比别人肿（上眼睑有轻微隆起的现象）吗？"),
+    Question("q28", "您嘴里有黏黏的感觉吗？"),
+    Question("q29", "您平时痰多，特别是咽喉部总感到有痰堵着吗？"),
+    Question("q30", "您舌苔厚腻或有舌苔厚厚的感觉吗？"),
+    Question("q31", "您面部或鼻部有油腻感或者油亮发光吗？"),
+    Question("q32", "您容易生痤疮或疮疖吗？"),
+    Question("q33", "您感到口苦或嘴里有异味吗？"),
+    Question("q34", "您大便黏滞不爽、有解不尽的感觉吗？"),
+    Question("q35", "您小便时尿道有发热感、尿色浓（深）吗？"),
+    Question("q36", "您带下色黄（白带颜色发黄）吗？", sex="女"),
+    Question("q37", "您的阴囊部位潮湿吗？", sex="男"),
+    Question("q38", "您的皮肤在不知不觉中会出现青紫瘀斑（皮下出血）吗？"),
+    Question("q39", "您两颧部有细微红丝吗？"),
+    Question("q40", "您身体上有哪里疼痛吗？"),
+    Question("q41", "您面色晦黯或容易出现褐斑吗？"),
+    Question("q42", "您容易有黑眼圈吗？"),
+    Question("q43", "您容易忘事（健忘）吗？"),
+    Question("q44", "您口唇颜色偏黯吗？"),
+    Question("q45", "您没有感冒时也会打喷嚏吗？"),
+    Question("q46", "您没有感冒时也会鼻塞、流鼻涕吗？"),
+    Question("q47", "您有因季节变化、温度变化或异味等原因而咳喘的现象吗？"),
+    Question("q48", "您容易过敏（对药物、食物、气味、花粉或在季节交替、气候变化时）吗？"),
+    Question("q49", "您的皮肤容易起荨麻疹（风团、风疹块、风疙瘩）吗？"),
+    Question("q50", "您的皮肤因过敏出现过紫癜（紫红色瘀点、瘀斑）吗？"),
+    Question("q51", "您的皮肤一抓就红，并出现抓痕吗？"),
+    Question("q52", "您感到闷闷不乐、情绪低沉吗？"),
+    Question("q53", "您容易精神紧张、焦虑不安吗？"),
+    Question("q54", "您多愁善感、感情脆弱吗？"),
+    Question("q55", "您容易感到害怕或受到惊吓吗？"),
+    Question("q56", "您胁肋部或乳房胀痛吗？"),
+    Question("q57", "您无缘无故叹气吗？"),
+    Question("q58", "您咽喉部有异物感，且吐之不出、咽之不下吗？"),
+    Question("q59", "您精力充沛吗？"),
+    Question("q60", "您能适应外界自然和社会环境的变化吗？"),
+    Question("q61", "您容易失眠吗？"),
+)
+QUESTION_IDS = tuple(question.id for question in QUESTIONS)
+
+# 体质 → 条目；"-" 前缀表示反向计分（6 - 答案）
+TYPE_ITEMS = {
+    "平和质": ("q59", "-q16", "-q21", "-q52", "-q4", "q60", "-q61", "-q43"),
+    "气虚质": ("q16", "q17", "q18", "q19", "q5", "q20", "q21", "q22"),
+    "阳虚质": ("q1", "q2", "q3", "q4", "q5", "q6", "q7"),
+    "阴虚质": ("q8", "q9", "q10", "q11", "q12", "q13", "q14", "q15"),
+    "痰湿质": ("q23", "q24", "q25", "q26", "q27", "q28", "q29", "q30"),
+    "湿热质": ("q31", "q32", "q33", "q34", "q35", "q36", "q37"),
+    "血瘀质": ("q38", "q39", "q40", "q41", "q42", "q43", "q44"),
+    "气郁质": ("q52", "q53", "q54", "q55", "q56", "q57", "q58"),
+    "特禀质": ("q45", "q46", "q47", "q48", "q49", "q50", "q51"),
+}
+
+
+def _weight_matrices():
+    # weights：正向 +1、反向 -1；reverse：反向条目的指示矩阵，原始分 = 答案 @ weights + 6 × 作答的反向条目数
+    position = {qid: i for i, qid in enumerate(QUESTION_IDS)}
+    weights = np.zeros((len(QUESTIONS), len(CONSTITUTION_TYPES)), dtype=np.float32)
+    reverse = np.zeros_like(weights)
+    for j, name in enumerate(CONSTITUTION_TYPES):
+        for item in TYPE_ITEMS[name]:
+            i = position[item.lstrip("-")]
+            if item.startswith("-"):
+                weights[i, j], reverse[i, j] = -1.0, 1.0
+            else:
+                weights[i, j] = 1.0
+    return weights, reverse, np.abs(weights)
+
+
+WEIGHTS, REVERSE, MEMBERSHIP = _weight_matrices()
+
+
+def questions_for(sex=None):
+    """某一性别需要回答的条目；sex 为空时两个性别限定条目都列出。"""
+    return [question for question in QUESTIONS if question.sex is None or sex is None or question.sex == sex]
+
+
+def score(answers):
+    """answers：人数 × len(QUESTIONS) 的数组，取值 1~5，未作答为 NaN。返回人数 × 9 的转化分（float32）。"""
+    answers = np.asarray(answers, dtype=np.float32)
+    if answers.ndim != 2 or answers.shape[1] != len(QUESTIONS):
+        raise ValueError(f"答案矩阵应为 (人数, {len(QUESTIONS)})，实际为 {answers.shape}")
+    answered = ~np.isnan(answers)
+    invalid = answered & ((answers < 1) | (answers > 5))
+    if invalid.any():
+        row, col = np.argwhere(invalid)[0]
+        raise ValueError(f"答案须为 1~5：第 {row + 1} 行 {QUESTION_IDS[col]} 为 {answers[row, col]:g}")
+    answered = answered.astype(np.float32)
+    raw = np.where(answered > 0, answers, 0) @ WEIGHTS + 6 * (answered @ REVERSE)
+    counts = answered @ MEMBERSHIP
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (raw - counts) / (counts * 4) * 100
+
+
+def classify(scores):
+    """返回人数 × 9 的判定等级：2 = 是，1 = 倾向是（平和质为基本是），0 = 否。"""
+    scores = np.asarray(scores)
+    biased = scores[:, 1:]
+    levels = np.zeros(scores.shape, dtype=np.int8)
+    levels[:, 1:] = (biased >= TENDENCY_SCORE).astype(np.int8) + (biased >= YES_SCORE)
+    others = np.nanmax(np.where(np.isnan(biased), -np.inf, biased), axis=1)
+    peaceful = scores[:, PEACEFUL] >= PEACEFUL_SCORE
+    levels[:, PEACEFUL] = (peaceful & (others < YES_SCORE)).astype(np.int8) + (peaceful & (others < TENDENCY_SCORE))
+    return levels
+
+
+def primary(scores, levels):
+    """每人的主要体质下标与等级：平和质（是/基本是）优先，否则取判定等级最高、转化分最高的偏颇体质；都为否时下标为 -1。"""
+    biased, biased_levels = np.asarray(scores)[:, 1:], levels[:, 1:]
+    top = biased_levels.max(axis=1)
+    masked = np.where(biased_levels == top[:, None], np.nan_to_num(biased, nan=-np.inf), -np.inf)
+    best = masked.argmax(axis=1) + 1
+    is_peaceful = levels[:, PEACEFUL] > 0
+    index = np.where(is_peaceful, PEACEFUL, np.where(top > 0, best, -1))
+    level = np.where(is_peaceful, levels[:, PEACEFUL], top)
+    return index, level
+
+
+def result_label(type_index, level):
+    labels = PEACEFUL_RESULT_LABELS if type_index == PEACEFUL else RESULT_LABELS
+    return labels[level]
+
+
+@dataclass
+class ConstitutionResult:
+    scores: dict
+    results: dict
+    # 主要体质与判定结果（是/倾向是/基本是）；所有体质都为"否"时为 None
+    primary: str = None
+    primary_result: str = None
+
+
+def judge(answers, sex=None):
+    """单人评分：answers 为 {条目编号: 1~5}，只需包含该性别要回答的条目。"""
+    row = np.full((1, len(QUESTIONS)), np.nan, dtype=np.float32)
+    for i, qid in enumerate(QUESTION_IDS):
+        if qid in answers and answers[qid] is not None:
+            row[0, i] = answers[qid]
+    scores = score(row)
+    levels = classify(scores)
+    index, level = primary(scores, levels)
+    result = ConstitutionResult(
+        scores={name: round(float(scores[0, j]), 1) for j, name in enumerate(CONSTITUTION_TYPES)},
+        results={name: result_label(j, int(levels[0, j])) for j, name in enumerate(CONSTITUTION_TYPES)},
+    )
+    if index[0] >= 0:
+        result.primary = CONSTITUTION_TYPES[index[0]]
+        result.primary_result = result_label(int(index[0]), int(level[0]))
+    return result
+
+
+# ----------- 批量评分：CSV / Parquet -----------
+def read_answers(path, id_column="id"):
+    """返回 (ids, 答案矩阵)；表头中的条目编号列为答案，缺少的列与空白单元格视为未作答。"""
+    if path.endswith(".parquet"):
+        columns = _read_parquet(path)
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+        # 先整体转成字符串数组再按列取值，避免逐个单元格调用 float()
+        table = np.array(rows, dtype=str) if rows else np.empty((0, len(header)), dtype=str)
+        columns = {name: table[:, i] for i, name in enumerate(header)}
+    count = len(next(iter(columns.values()))) if columns else 0
+    answers = np.full((count, len(QUESTIONS)), np.nan, dtype=np.float32)
+    for i, qid in enumerate(QUESTION_IDS):
+        if qid in columns:
+            answers[:, i] = _to_float(columns[qid])
+    ids = columns[id_column] if id_column in columns else np.arange(1, count + 1)
+    return np.asarray(ids).astype(str), answers
+
+
+def _to_float(column):
+    column = np.asarray(column)
+    if column.dtype.kind in "US":
+        column = np.where(np.char.strip(column) == "", "nan", column)
+    return column.astype(np.float32)
+
+
+def _read_parquet(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("读取 Parquet 需要安装 pyarrow") from None
+    table = pq.read_table(path)
+    return {
+        name: table.column(name).to_numpy(zero_copy_only=False)
+        if name not in QUESTION_IDS
+        else table.column(name).cast("float32").fill_null(float("nan")).to_numpy()
+        for name in table.column_names
+    }
+
+
+def result_columns(ids, scores, levels):
+    """评分结果按列组织：id、各体质转化分与判定、主要体质。"""
+    index, level = primary(scores, levels)
+    columns = {"id": ids}
+    for j, name in enumerate(CONSTITUTION_TYPES):
+        labels = np.array(PEACEFUL_RESULT_LABELS if j == PEACEFUL else RESULT_LABELS)
+        columns[f"{name}_转化分"] = np.round(scores[:, j].astype(np.float64), 1)
+        columns[f"{name}_判定"] = labels[levels[:, j]]
+    names = np.array((*CONSTITUTION_TYPES, ""))
+    result_names = np.array(RESULT_LABELS)
+    columns["主要体质"] = names[index]
+    columns["主要体质_判定"] = np.where(index == PEACEFUL, np.array(PEACEFUL_RESULT_LABELS)[level], result_names[level])
+    columns["主要体质_判定"] = np.where(index < 0, "", columns["主要体质_判定"])
+    return columns
+
+
+def write_results(path, columns):
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("写入 Parquet 需要安装 pyarrow") from None
+        pq.write_table(pa.table({name: np.asarray(values) for name, values in columns.items()}), path)
+        return
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*(np.asarray(values).tolist() for values in columns.values())))
+
+
+def score_file(input_path, output_path, id_column="id"):
+    timings = {}
+    start = time.perf_counter()
+    ids, answers = read_answers(input_path, id_column)
+    timings["read"] = time.perf_counter() - start
+    start = time.perf_counter()
+    scores = score(answers)
+    levels = classify(scores)
+    columns = result_columns(ids, scores, levels)
+    timings["score"] = time.perf_counter() - start
+    start = time.perf_counter()
+    write_results(output_path, columns)
+    timings["write"] = time.perf_counter() - start
+    return len(ids), timings
+
+
+def random_answers(respondents, seed=0):
+    """随机答卷（每人随机性别，另一性别的限定条目为 NaN），用于评分性能测试。"""
+    rng = np.random.default_rng(seed)
+    answers = rng.integers(1, 6, size=(respondents, len(QUESTIONS))).astype(np.float32)
+    female = rng.random(respondents) < 0.5
+    answers[female, QUESTION_IDS.index("q37")] = np.nan
+    answers[~female, QUESTION_IDS.index("q36")] = np.nan
+    return answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="中医体质问卷评分")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("questions", help="列出条目编号、限定性别与题目")
+    score_parser = sub.add_parser("score", help="批量评分 CSV / Parquet（按扩展名识别）")
+    score_parser.add_argument("input")
+    score_parser.add_argument("--output", required=True)
+    score_parser.add_argument("--id-column", default="id")
+    bench_parser = sub.add_parser("bench", help="随机答卷的评分耗时")
+    bench_parser.add_argument("--respondents", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == "questions":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["id", "sex", "question", "types"])
+        for question in QUESTIONS:
+            types = [name for name, items in TYPE_ITEMS.items() if question.id in (item.lstrip("-") for item in items)]
+            writer.writerow([question.id, question.sex or "", question.text, "、".join(types)])
+    elif args.command == "score":
+        if not os.path.exists(args.input):
+            sys.exit(f"找不到输入文件：{args.input}")
+        count, timings = score_file(args.input, args.output, args.id_column)
+        print(f"已评分 {count} 人，结果写入 {args.output}（读取 {timings['read']:.2f}s，评分 {timings['score']:.2f}s，写入 {timings['write']:.2f}s）")
+    else:
+        answers = random_answers(args.respondents)
+        start = time.perf_counter()
+        scores = score(answers)
+        levels = classify(scores)
+        primary(scores, levels)
+        elapsed = time.perf_counter() - start
+        print(f"{args.respondents} 人评分与判定耗时 {elapsed * 1000:.1f} ms（{args.respondents / elapsed:,.0f} 人/秒）")
+
+
+if __name__ == "__main__":
+    main()
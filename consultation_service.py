@@ -0,0 +1,1039 @@
+# ----------- 异步问诊服务 -----------
+# 检索 + 提示词组装 + GLM 调用放在独立的 asyncio 服务层：Streamlit 通过 ServiceRunner 把协程提交到
+# 后台事件循环，脚本线程只等待结果；也可以用 python consultation_service.py serve 单独起 HTTP 接口。
+# 每次访问上游依次经过：排队与背压 → 并发上限 → 令牌桶限速 → 熔断器 → 带抖动的指数退避重试，
+# HTTP 连接由 httpx.AsyncClient 的连接池复用。
+#
+# 用法：
+#   python consultation_service.py serve --port 8600
+#   curl -X POST localhost:8600/v1/consult -d '{"query": "头痛、失眠", "gender": "男", "age": 30}'
+#   TCM_METRICS=1 时 GET /metrics 以 Prometheus 文本格式导出各阶段耗时与 token 数
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from http import HTTPStatus
+
+import metrics
+from knowledge_base import (
+    KNOWLEDGE_PATH,
+    KNOWLEDGE_SHARDS,
+    SYMPTOM_KEYWORDS,
+    HybridRetriever,
+    KnowledgeDocument,
+    SymptomIndex,
+    knowledge_sources,
+    load_knowledge_documents,
+    picker_queries,
+)
+from prompting import (
+    MODE_DIAGNOSIS,
+    MODE_INQUIRY,
+    MODE_MORE_ADVICE,
+    PromptAssembler,
+    estimate_tokens,
+    pack_context,
+    prompt_mode,
+)
+from semantic_cache import SemanticCache, warmup_profiles, warmup_queries
+
+logger = logging.getLogger("tcm.service")
+
+GLM_BASE_URL = os.environ.get("TCM_GLM_BASE_URL", "https://open.bigmodel.cn/api/paas/v4")
+LLM_MODEL = "GLM-4.5V"
+LLM_TEMPERATURE = 0.2
+# 单次请求的提示词 token 预算（估算值）与原样保留的最近对话轮数
+PROMPT_TOKEN_BUDGET = int(os.environ.get("TCM_PROMPT_TOKEN_BUDGET", "4000"))
+PROMPT_RECENT_TURNS = 2
+# HTTP 接口接受的最大请求体（字节），超出时返回 413
+MAX_REQUEST_BYTES = int(os.environ.get("TCM_MAX_REQUEST_BYTES", str(1024 * 1024)))
+# 模型回复中需要去掉的标记
+MODEL_MARKERS = ("<|begin_of_box|>", "<|end_of_box|>")
+# 首轮问诊用症状选择器的本地匹配结果代替检索：候选证型数与最低匹配度
+FAST_PATH_CANDIDATES = 4
+FAST_PATH_MIN_SCORE = 0.5
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    model: str
+    # 非流式调用为整次调用的超时，流式调用为首字超时（秒）；超时后换下一个模型
+    timeout: float = 90.0
+    max_tokens: int = 2048
+    temperature: float = LLM_TEMPERATURE
+
+
+# 各问诊阶段按顺序尝试的模型：首轮追问只需提两三个问题，交给快速的文本模型；
+# 辨证与调理方案仍以 GLM-4.5V 为主，失败或超时后退到文本模型
+DEFAULT_ROUTES = {
+    MODE_INQUIRY: (ModelRoute("glm-4-flash", timeout=15.0, max_tokens=512), ModelRoute(LLM_MODEL, timeout=60.0, max_tokens=512)),
+    MODE_DIAGNOSIS: (ModelRoute(LLM_MODEL), ModelRoute("glm-4-air", timeout=60.0)),
+    MODE_MORE_ADVICE: (ModelRoute(LLM_MODEL), ModelRoute("glm-4-air", timeout=60.0)),
+}
+
+
+def load_routes(spec):
+    """解析 TCM_MODEL_ROUTES：{"inquiry": [{"model": "glm-4-flash", "timeout": 15}, ...], ...}，未给出的阶段用默认路由。"""
+    routes = dict(DEFAULT_ROUTES)
+    if spec:
+        for mode, entries in json.loads(spec).items():
+            if mode not in DEFAULT_ROUTES:
+                raise ValueError(f"未知的问诊阶段：{mode}")
+            routes[mode] = tuple(ModelRoute(**entry) for entry in entries)
+    return routes
+
+
+@dataclass
+class ServiceConfig:
+    base_url: str = GLM_BASE_URL
+    # 问诊阶段 → 依次尝试的 ModelRoute
+    routes: dict = field(default_factory=lambda: dict(DEFAULT_ROUTES))
+    # 同时在途的上游请求数，以及等待空位的请求数上限（超出即拒绝，而不是无限堆积）
+    max_concurrency: int = 8
+    max_queue: int = 32
+    # 令牌桶：平均每秒请求数与允许的突发量；rate_per_second <= 0 表示不限速
+    rate_per_second: float = 5.0
+    burst: int = 10
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    # 连续失败 failure_threshold 次后熔断，reset_timeout 秒后放行一个探测请求
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    request_timeout: float = 120.0
+    max_connections: int = 20
+    # 首轮追问的语义缓存：条目数上限（0 表示关闭）与命中所需的余弦相似度
+    inquiry_cache_size: int = 1000
+    inquiry_cache_threshold: float = 0.95
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrency=int(os.environ.get("TCM_GLM_CONCURRENCY", cls.max_concurrency)),
+            max_queue=int(os.environ.get("TCM_GLM_QUEUE", cls.max_queue)),
+            rate_per_second=float(os.environ.get("TCM_GLM_RPS", cls.rate_per_second)),
+            burst=int(os.environ.get("TCM_GLM_BURST", cls.burst)),
+            max_retries=int(os.environ.get("TCM_GLM_RETRIES", cls.max_retries)),
+            routes=load_routes(os.environ.get("TCM_MODEL_ROUTES")),
+            inquiry_cache_size=int(os.environ.get("TCM_INQUIRY_CACHE_SIZE", cls.inquiry_cache_size)),
+            inquiry_cache_threshold=float(os.environ.get("TCM_INQUIRY_CACHE_THRESHOLD", cls.inquiry_cache_threshold)),
+        )
+
+
+class ServiceError(Exception):
+    status = HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+class ServiceOverloaded(ServiceError):
+    status = HTTPStatus.TOO_MANY_REQUESTS
+
+
+class CircuitOpenError(ServiceError):
+    status = HTTPStatus.SERVICE_UNAVAILABLE
+
+
+class UpstreamError(ServiceError):
+    status = HTTPStatus.BAD_GATEWAY
+
+    def __init__(self, message, status_code=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def clean_model_output(text):
+    if text:
+        for marker in MODEL_MARKERS:
+            text = text.replace(marker, "")
+    return text
+
+
+def strip_partial_marker(text):
+    """去掉末尾可能是某个标记开头的部分：流式输出时标记可能被拆在两个分片之间，先扣住，等后续分片到达再清洗。"""
+    for size in range(min(len(text), max(map(len, MODEL_MARKERS)) - 1), 0, -1):
+        tail = text[-size:]
+        if any(marker.startswith(tail) for marker in MODEL_MARKERS):
+            return text[:-size]
+    return text
+
+
+def get_age_category(age):
+    # 年龄段判断
+    if not isinstance(age, int):
+        return "未知"
+    if age <= 14:
+        return "少年期"
+    elif age <= 35:
+        return "青年期"
+    elif age <= 55:
+        return "壮年期"
+    elif age <= 70:
+        return "中年期"
+    return "老年期"
+
+
+def build_prompt_assembler(documents, token_budget=PROMPT_TOKEN_BUDGET, recent_turns=PROMPT_RECENT_TURNS):
+    syndrome_names = [doc.metadata["syndrome"] for doc in documents if doc.metadata.get("syndrome")]
+    symptom_terms = [term for terms in SYMPTOM_KEYWORDS.values() for term in terms]
+    return PromptAssembler(token_budget, recent_turns, symptom_terms, syndrome_names)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        # 加锁保证等待者按先来后到取令牌
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self):
+        state = self.state
+        if state == self.OPEN:
+            raise CircuitOpenError("模型服务暂时不可用，请稍后再试")
+        if state == self.HALF_OPEN:
+            # 半开状态每个冷却周期只放行一个探测请求；探测请求被取消时下个周期自动重新放行
+            now = time.monotonic()
+            if self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+                raise CircuitOpenError("模型服务暂时不可用，请稍后再试")
+            self._probe_at = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = self._probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._probe_at = None
+            logger.warning(json.dumps({"event": "circuit_open", "failures": self.failures}))
+
+
+class _RouteStats:
+    __slots__ = ("latency", "samples", "updated", "failures", "last_failure")
+
+    def __init__(self):
+        self.latency = None
+        self.samples = 0
+        self.updated = 0.0
+        self.failures = 0
+        self.last_failure = 0.0
+
+
+class ModelRouter:
+    """按问诊阶段选择模型，并在线跟踪每个（阶段, 模型, 计时方式）的延迟。
+
+    延迟用指数滑动平均：流式调用记首字耗时，非流式记整次耗时，超时按超时时长计入。
+    平均延迟接近超时（slow_fraction）或连续失败的模型在 recovery 秒内排到后面，之后重新按配置顺序尝试。
+    """
+
+    def __init__(self, routes, alpha=0.3, slow_fraction=0.8, recovery=60.0):
+        self.routes = routes
+        self.alpha = alpha
+        self.slow_fraction = slow_fraction
+        self.recovery = recovery
+        self._stats = {}
+        self.fallbacks = {}
+
+    def _get(self, mode, route, stream):
+        key = (mode, route.model, "ttft" if stream else "total")
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _RouteStats()
+        return stats
+
+    def _degraded(self, mode, route, stream, now):
+        stats = self._stats.get((mode, route.model, "ttft" if stream else "total"))
+        if stats is None or now - max(stats.updated, stats.last_failure) > self.recovery:
+            return False
+        slow = stats.latency is not None and stats.latency > self.slow_fraction * route.timeout
+        return slow or stats.failures >= 2
+
+    def resolve(self, mode):
+        # 未标明阶段的调用按辨证路由
+        return mode if mode in self.routes else MODE_DIAGNOSIS
+
+    def plan(self, mode, stream=False):
+        routes = self.routes[mode]
+        now = time.monotonic()
+        # 稳定排序：未降级的在前，组内保持配置顺序
+        return sorted(routes, key=lambda route: self._degraded(mode, route, stream, now))
+
+    def record_latency(self, mode, route, stream, seconds):
+        stats = self._get(mode, route, stream)
+        stats.latency = seconds if stats.latency is None else self.alpha * seconds + (1 - self.alpha) * stats.latency
+        stats.samples += 1
+        stats.updated = time.monotonic()
+
+    def record_success(self, mode, route, stream, seconds):
+        self.record_latency(mode, route, stream, seconds)
+        self._get(mode, route, stream).failures = 0
+
+    def record_failure(self, mode, route, stream, error):
+        stats = self._get(mode, route, stream)
+        stats.failures += 1
+        stats.last_failure = time.monotonic()
+        if error.status_code == HTTPStatus.GATEWAY_TIMEOUT:
+            self.record_latency(mode, route, stream, route.timeout)
+
+    def record_fallback(self, mode, route, error):
+        reason = "timeout" if error.status_code == HTTPStatus.GATEWAY_TIMEOUT else "error"
+        key = (mode, route.model, reason)
+        self.fallbacks[key] = self.fallbacks.get(key, 0) + 1
+        metrics.record_fallback(mode, route.model, reason)
+        logger.info(json.dumps(
+            {"event": "llm_fallback", "mode": mode, "model": route.model, "reason": reason, "error": str(error)},
+            ensure_ascii=False,
+        ))
+
+    def latencies(self):
+        return [(key, stats.latency) for key, stats in list(self._stats.items())]
+
+    @staticmethod
+    def outcome(plan, attempt):
+        if attempt == 0:
+            return "ok"
+        return "fallback_ok" if plan[attempt % len(plan)] != plan[0] else "retry_ok"
+
+    def stats(self):
+        """各阶段、各模型的平均延迟、样本数与回退次数，用于 /healthz。"""
+        report = {}
+        for (mode, model, kind), stats in self._stats.items():
+            entry = report.setdefault(mode, {}).setdefault(model, {})
+            entry[f"{kind}_ewma"] = round(stats.latency, 4) if stats.latency is not None else None
+            entry[f"{kind}_samples"] = stats.samples
+        for (mode, model, reason), count in self.fallbacks.items():
+            report.setdefault(mode, {}).setdefault(model, {})[f"fallback_{reason}"] = count
+        return report
+
+
+def _upstream_error(response, body):
+    retryable = response.status_code == 429 or response.status_code >= 500
+    try:
+        retry_after = float(response.headers.get("retry-after", ""))
+    except ValueError:
+        retry_after = None
+    message = f"GLM 接口返回 {response.status_code}：{body[:200]}"
+    return UpstreamError(message, response.status_code, retryable, retry_after)
+
+
+def _malformed_error(body, error):
+    # 状态码正常但内容无法解析（网关错误页、截断的 JSON 等）：按可重试处理，由路由切换到备用模型
+    return UpstreamError(f"GLM 接口返回的内容无法解析（{error!r}）：{body[:200]}", retryable=True)
+
+
+def _timeout_error(route):
+    return UpstreamError(f"{route.model} 响应超时（{route.timeout:g}s）", HTTPStatus.GATEWAY_TIMEOUT, retryable=True)
+
+
+class GLMClient:
+    """智谱 GLM 的 OpenAI 兼容接口，所有请求共用一个带连接池的 httpx.AsyncClient。"""
+
+    def __init__(self, api_key, base_url=GLM_BASE_URL, timeout=120.0, max_connections=20):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._http = None
+
+    def _client(self):
+        # 在事件循环内首次使用时创建，连接池绑定在该循环上
+        if self._http is None:
+            import httpx
+
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self._http
+
+    async def chat(self, payload, usage=None):
+        """返回回复文本；传入 usage 字典时写入上游返回的 token 用量。"""
+        import httpx
+
+        try:
+            response = await self._client().post("/chat/completions", json=payload)
+        except httpx.TransportError as e:
+            raise UpstreamError(f"GLM 接口连接失败：{e!r}", retryable=True) from e
+        if response.status_code >= 400:
+            raise _upstream_error(response, response.text)
+        try:
+            data = response.json()
+            content = data["choices"][0]["message"]["content"]
+        except (ValueError, LookupError, TypeError, AttributeError) as e:
+            raise _malformed_error(response.text, e) from e
+        if usage is not None and isinstance(data.get("usage"), dict):
+            usage.update(data["usage"])
+        return content
+
+    async def stream_chat(self, payload, usage=None):
+        import httpx
+
+        try:
+            async with self._client().stream("POST", "/chat/completions", json={**payload, "stream": True}) as response:
+                if response.status_code >= 400:
+                    raise _upstream_error(response, (await response.aread()).decode("utf-8", "replace"))
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                        choices = chunk.get("choices")
+                        delta = choices[0].get("delta", {}).get("content") if choices else None
+                    except (ValueError, LookupError, TypeError, AttributeError) as e:
+                        raise _malformed_error(data, e) from e
+                    # 流式返回时 token 用量附在最后一个分片上
+                    if usage is not None and isinstance(chunk.get("usage"), dict):
+                        usage.update(chunk["usage"])
+                    if delta:
+                        yield delta
+        except httpx.TransportError as e:
+            raise UpstreamError(f"GLM 接口连接失败：{e!r}", retryable=True) from e
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class ConsultationService:
+    """问诊服务：同步的检索与提示词组装 + 异步、受保护的模型调用。
+
+    get_retriever 是返回当前检索器的函数，便于在向量库预热完成后自动切换到混合检索；
+    提供 symptom_index 时，首轮问诊直接使用症状→证型的本地匹配结果，不做检索。
+    """
+
+    def __init__(self, client, get_retriever, assembler, config=None, symptom_index=None):
+        self.client = client
+        self.get_retriever = get_retriever
+        self.assembler = assembler
+        self.symptom_index = symptom_index
+        self.config = config or ServiceConfig()
+        self.limiter = TokenBucket(self.config.rate_per_second, self.config.burst)
+        self.breaker = CircuitBreaker(self.config.failure_threshold, self.config.reset_timeout)
+        self.router = ModelRouter(self.config.routes)
+        self.inquiry_cache = (
+            SemanticCache(self.config.inquiry_cache_size, self.config.inquiry_cache_threshold)
+            if self.config.inquiry_cache_size > 0
+            else None
+        )
+        self._slots = asyncio.Semaphore(self.config.max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        # 实际发往上游的请求数（含重试与换模型），缓存命中的问诊不计
+        self.upstream_calls = 0
+
+    def match_syndromes(self, query, k=FAST_PATH_CANDIDATES):
+        if self.symptom_index is None:
+            return []
+        return self.symptom_index.match(self.symptom_index.terms_in(query), k)
+
+    def retrieve(self, query, more_advice=False, first_turn=False):
+        if first_turn and not more_advice:
+            with metrics.timer("symptom_match"):
+                candidates = [c for c in self.match_syndromes(query) if c.score >= FAST_PATH_MIN_SCORE]
+            if candidates:
+                summary = "、".join(f"{c.name}（匹配度 {c.score:.0%}）" for c in candidates)
+                header = KnowledgeDocument(f"按所选症状匹配的候选证型：{summary}", {"disease": "候选证型"})
+                return [header, *(c.document for c in candidates)]
+        search_k = 8 if more_advice else 4
+        # MMR 重排，避免结果集中在同一疾病的几个证型上
+        with metrics.timer("retrieve"):
+            return self.get_retriever().max_marginal_relevance_search(query, k=search_k)
+
+    def _inquiry_partition(self, gender, age):
+        # 首轮回复取决于查询、性别、年龄段与首选模型；检索结果由查询本身决定，不需要进入分区
+        route = self.config.routes[MODE_INQUIRY][0]
+        return (gender, get_age_category(age), route.model, route.temperature)
+
+    def lookup_inquiry(self, query, gender="未知", age="未知"):
+        """首轮追问的缓存查找，返回 (缓存的回复或 None, CacheProbe)；未启用缓存时返回 (None, None)。"""
+        if self.inquiry_cache is None:
+            return None, None
+        embed = getattr(self.get_retriever(), "embed_query", None)
+        with metrics.timer("inquiry_cache"):
+            return self.inquiry_cache.lookup(self._inquiry_partition(gender, age), query, embed)
+
+    def remember_inquiry(self, probe, content):
+        if probe is not None and content:
+            self.inquiry_cache.store(probe, content)
+
+    def build_messages(self, query, history, gender="未知", age="未知", more_advice=False, retrieved_docs=None, summary=None):
+        """返回 (messages, stats)；summary 为会话级的 HistorySummary，会被增量更新。"""
+        if retrieved_docs is None:
+            retrieved_docs = self.retrieve(query, more_advice, first_turn=not history)
+        age_category = get_age_category(age)
+        user_info = f"用户信息：性别 {gender}，年龄 {age}（{age_category}）。"
+        # 同一疾病的证型合并成一段、重复的症状/调理行只保留一次
+        with metrics.timer("pack_context"):
+            packed_docs, packing_stats = pack_context(retrieved_docs)
+        # 按 token 预算组装：最近几轮原样保留，更早的对话合并进症状摘要，资料按相关度裁剪
+        with metrics.timer("assemble_prompt"):
+            messages, stats = self.assembler.assemble(
+                prompt_mode(history, more_advice),
+                user_info,
+                gender,
+                age_category,
+                packed_docs,
+                history,
+                query,
+                summary,
+            )
+        stats["packing"] = packing_stats
+        logger.info(json.dumps({"event": "prompt_built", **stats}, ensure_ascii=False))
+        return messages, stats
+
+    def register_metrics(self, registry=metrics.REGISTRY):
+        """把排队、在途请求数与熔断状态作为 gauge 导出。"""
+        registry.gauge("tcm_service_requests", "上游请求数，state=in_flight/queued", ("state",), lambda: [
+            (("in_flight",), self.in_flight),
+            (("queued",), self.waiting),
+        ])
+        registry.gauge("tcm_model_latency_ewma_seconds", "各阶段各模型的滑动平均延迟（秒）", ("mode", "model", "phase"), self.router.latencies)
+        if self.inquiry_cache is not None:
+            registry.gauge("tcm_inquiry_cache_entries", "首轮追问语义缓存的条目数", (), lambda: [((), len(self.inquiry_cache))])
+        registry.gauge("tcm_service_breaker_open", "熔断器是否打开（half_open 记为 0.5）", (), lambda: [
+            ((), {"closed": 0, "half_open": 0.5, "open": 1}.get(self.breaker.state, 1)),
+        ])
+
+    def status(self):
+        return {
+            "breaker": self.breaker.state,
+            "in_flight": self.in_flight,
+            "queued": self.waiting,
+            "max_concurrency": self.config.max_concurrency,
+            "max_queue": self.config.max_queue,
+            "upstream_calls": self.upstream_calls,
+            "models": self.router.stats(),
+            "inquiry_cache": self.inquiry_cache.status() if self.inquiry_cache is not None else None,
+            "retrieval_cache": getattr(self.get_retriever(), "cache_status", dict)(),
+        }
+
+    @asynccontextmanager
+    async def _admit(self):
+        if self.waiting >= self.config.max_queue:
+            raise ServiceOverloaded("当前咨询人数较多，请稍后再试")
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        metrics.record_stage("queue_wait", time.perf_counter() - start)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def _payload(self, route, messages):
+        return {"model": route.model, "messages": messages, "temperature": route.temperature, "max_tokens": route.max_tokens}
+
+    async def _chat(self, route, messages, usage):
+        try:
+            return await asyncio.wait_for(self.client.chat(self._payload(route, messages), usage), route.timeout)
+        except asyncio.TimeoutError:
+            raise _timeout_error(route) from None
+
+    async def _stream_chat(self, route, messages, usage):
+        # 只限制首字耗时；开始输出后由 httpx 的读超时兜底
+        chunks = self.client.stream_chat(self._payload(route, messages), usage)
+        try:
+            first = await asyncio.wait_for(anext(chunks), route.timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise _timeout_error(route) from None
+        yield first
+        async for delta in chunks:
+            yield delta
+
+    def _backoff(self, attempt, retry_after=None):
+        # full jitter：在 [0, base * 2^attempt] 内均匀取值，避免大量请求同时重试
+        delay = random.uniform(0, min(self.config.backoff_max, self.config.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    async def _failed(self, error, attempt, plan, mode, stream, started=False):
+        # 只有上游故障（限流、5xx、网络错误、超时）计入熔断并退避重试；
+        # 4xx（模型不存在或未开通、max_tokens 超出该模型上限等）只针对当前模型，换下一个模型，备选用完即抛出
+        route = plan[attempt % len(plan)]
+        self.router.record_failure(mode, route, stream, error)
+        if not error.retryable:
+            if started or attempt >= self.config.max_retries or attempt + 1 >= len(plan):
+                raise error
+            self.router.record_fallback(mode, route, error)
+            return
+        self.breaker.record_failure()
+        if started or attempt >= self.config.max_retries:
+            raise error
+        if (attempt + 1) % len(plan):
+            # 还有备选模型：立即换下一个，不做退避
+            self.router.record_fallback(mode, route, error)
+            return
+        logger.info(json.dumps({"event": "llm_retry", "attempt": attempt + 1, "error": str(error)}, ensure_ascii=False))
+        await asyncio.sleep(self._backoff(attempt // len(plan), error.retry_after))
+
+    def _record_call(self, mode, model, messages, content, usage, outcome, start, ttft=None):
+        # 上游没有返回用量时按提示词和回复文本估算
+        if outcome == "ok":
+            usage.setdefault("prompt_tokens", sum(estimate_tokens(msg["content"]) for msg in messages))
+            usage.setdefault("completion_tokens", estimate_tokens(content))
+        total = time.perf_counter() - start
+        metrics.record_llm_call(mode, model, outcome, ttft if ttft is not None else total, total, usage)
+
+    async def complete(self, messages, mode=None, usage=None):
+        """返回模型回复；mode 为问诊阶段（决定模型路由），传入 usage 字典时写入 token 用量。"""
+        usage = {} if usage is None else usage
+        async with self._admit():
+            start = time.perf_counter()
+            mode = self.router.resolve(mode)
+            plan = self.router.plan(mode)
+            for attempt in range(self.config.max_retries + 1):
+                route = plan[attempt % len(plan)]
+                await self.limiter.acquire()
+                self.breaker.before_call()
+                self.upstream_calls += 1
+                call_start = time.perf_counter()
+                try:
+                    content = await self._chat(route, messages, usage)
+                except UpstreamError as e:
+                    try:
+                        await self._failed(e, attempt, plan, mode, False)
+                    except ServiceError:
+                        self._record_call(mode, route.model, messages, None, usage, "error", start)
+                        raise
+                else:
+                    self.breaker.record_success()
+                    self.router.record_success(mode, route, False, time.perf_counter() - call_start)
+                    self._record_call(mode, route.model, messages, content, usage, self.router.outcome(plan, attempt), start)
+                    return content
+
+    async def stream(self, messages, mode=None, usage=None):
+        """逐段产出模型输出的增量文本；已经输出过内容后不再重试或换模型，避免重复文本。"""
+        usage = {} if usage is None else usage
+        async with self._admit():
+            start = time.perf_counter()
+            mode = self.router.resolve(mode)
+            plan = self.router.plan(mode, stream=True)
+            ttft = None
+            content = ""
+            for attempt in range(self.config.max_retries + 1):
+                route = plan[attempt % len(plan)]
+                await self.limiter.acquire()
+                self.breaker.before_call()
+                self.upstream_calls += 1
+                call_start = time.perf_counter()
+                try:
+                    async for delta in self._stream_chat(route, messages, usage):
+                        if ttft is None:
+                            ttft = time.perf_counter() - start
+                            self.router.record_success(mode, route, True, time.perf_counter() - call_start)
+                        content += delta
+                        yield delta
+                except UpstreamError as e:
+                    try:
+                        await self._failed(e, attempt, plan, mode, True, ttft is not None)
+                    except ServiceError:
+                        self._record_call(mode, route.model, messages, content, usage, "error", start, ttft)
+                        raise
+                else:
+                    self.breaker.record_success()
+                    self._record_call(mode, route.model, messages, content, usage, self.router.outcome(plan, attempt), start, ttft)
+                    return
+
+    async def consult(self, query, history=(), gender="未知", age="未知", more_advice=False, summary=None):
+        """一次完整的问诊调用，返回清洗后的回复、检索到的记录 ID 与耗时。"""
+        history = list(history)
+        probe = None
+        if not history and not more_advice:
+            cached, probe = await asyncio.to_thread(self.lookup_inquiry, query, gender, age)
+            if cached is not None:
+                return {
+                    "content": cached,
+                    "record_ids": [],
+                    "prompt": {"mode": MODE_INQUIRY, "total": 0},
+                    "usage": {},
+                    "seconds": 0.0,
+                    "cache": probe.result,
+                }
+        retrieved_docs = await asyncio.to_thread(self.retrieve, query, more_advice, not history)
+        messages, stats = await asyncio.to_thread(
+            self.build_messages, query, history, gender, age, more_advice, retrieved_docs, summary
+        )
+        start = time.perf_counter()
+        usage = {}
+        content = clean_model_output(await self.complete(messages, stats["mode"], usage))
+        self.remember_inquiry(probe, content)
+        return {
+            "content": content,
+            "record_ids": [doc.metadata["record_id"] for doc in retrieved_docs if "record_id" in doc.metadata],
+            "prompt": stats,
+            "usage": usage,
+            "seconds": round(time.perf_counter() - start, 4),
+        }
+
+    async def consult_stream(self, query, history=(), gender="未知", age="未知", more_advice=False, summary=None):
+        probe = None
+        if not history and not more_advice:
+            cached, probe = await asyncio.to_thread(self.lookup_inquiry, query, gender, age)
+            if cached is not None:
+                yield cached
+                return
+        messages, stats = await asyncio.to_thread(
+            self.build_messages, query, list(history), gender, age, more_advice, None, summary
+        )
+        content = ""
+        async for delta in self.stream(messages, stats["mode"]):
+            content += delta
+            yield delta
+        self.remember_inquiry(probe, clean_model_output(content))
+
+    async def warm_inquiry_cache(self, queries, profiles, concurrency=2):
+        """为每个 (性别, 年龄) 与常见症状组合生成首轮追问并写入缓存，已缓存的直接命中；返回新写入的条数。
+
+        并发数保持较低，预热请求与用户请求共用限速和排队，不会挤占在线问诊。
+        """
+        if self.inquiry_cache is None:
+            return 0
+        pending = deque(itertools.product(profiles, queries))
+        stored = 0
+
+        async def worker():
+            nonlocal stored
+            while pending:
+                (gender, age), query = pending.popleft()
+                try:
+                    result = await self.consult(query, (), gender, age)
+                except ServiceError as e:
+                    logger.warning(json.dumps({"event": "inquiry_warmup_failed", "query": query, "error": str(e)}, ensure_ascii=False))
+                    continue
+                stored += "cache" not in result
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        logger.info(json.dumps({"event": "inquiry_cache_warmed", "stored": stored, **self.inquiry_cache.status()}, ensure_ascii=False))
+        return stored
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ServiceRunner:
+    """在守护线程里运行一个事件循环，供 Streamlit 的同步脚本线程提交协程。"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="consultation-service", daemon=True)
+        self._thread.start()
+
+    def run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def iterate(self, agen):
+        """把异步生成器转成同步生成器；调用方提前停止迭代时取消后台任务。"""
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((True, item))
+                items.put((False, None))
+            except Exception as e:
+                items.put((False, e))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                more, value = items.get()
+                if not more:
+                    if value is not None:
+                        raise value
+                    return
+                yield value
+        finally:
+            future.cancel()
+
+
+# ----------- 最小 HTTP/1.1 接口 -----------
+# 只依赖 asyncio，请求体为 JSON；stream=true 时以 Server-Sent Events 逐段返回。
+class RequestTooLarge(ValueError):
+    pass
+
+
+async def read_http_request(reader, max_body=None):
+    """读取一个请求，返回 (method, path, headers, body)；连接已关闭时返回 None。
+
+    Content-Length 不合法时抛出 ValueError，超过 max_body（默认 MAX_REQUEST_BYTES）时抛出 RequestTooLarge，请求体不读取。
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0) or 0)
+    if length < 0:
+        raise ValueError(f"invalid Content-Length: {length}")
+    if length > (MAX_REQUEST_BYTES if max_body is None else max_body):
+        raise RequestTooLarge(f"request body of {length} bytes exceeds the limit")
+    body = await reader.readexactly(length)
+    return method, path, headers, body
+
+
+def http_response(status, payload, headers=None, content_type="application/json; charset=utf-8"):
+    """payload 为 str 时原样作为响应体（如 Prometheus 文本），否则序列化为 JSON。"""
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+    body = text.encode("utf-8")
+    status = HTTPStatus(status)
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+def sse_headers():
+    return b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n"
+
+
+def sse_event(payload):
+    return f"data: {payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+CONSULT_FIELDS = ("query", "history", "gender", "age", "more_advice")
+
+
+def parse_consult_request(body):
+    """解析 /v1/consult 的请求体，返回 (consult 参数, 是否流式)；格式或字段类型不对时抛出 ValueError。"""
+    try:
+        payload = json.loads(body or b"{}")
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"请求体不是合法的 JSON：{e}") from None
+    if not isinstance(payload, dict):
+        raise ValueError("请求体应为 JSON 对象")
+    params = {key: payload[key] for key in CONSULT_FIELDS if key in payload}
+    if not isinstance(params.get("query"), str):
+        raise ValueError("缺少 query")
+    history = params.get("history", [])
+    if not isinstance(history, list) or not all(
+        isinstance(msg, dict) and isinstance(msg.get("role"), str) and isinstance(msg.get("content"), str) for msg in history
+    ):
+        raise ValueError("history 应为 [{\"role\": ..., \"content\": ...}, ...]")
+    if not isinstance(params.get("gender", ""), str):
+        raise ValueError("gender 应为字符串")
+    if isinstance(params.get("age"), bool) or not isinstance(params.get("age", ""), (int, str)):
+        raise ValueError("age 应为整数或字符串")
+    if not isinstance(params.get("more_advice", False), bool):
+        raise ValueError("more_advice 应为布尔值")
+    return params, bool(payload.get("stream"))
+
+
+async def _write_consult_stream(service, params, writer):
+    stream = service.consult_stream(**params)
+    try:
+        # 先取到第一段再发响应头，排队/熔断等错误仍能以状态码返回
+        first = await anext(stream)
+    except StopAsyncIteration:
+        first = ""
+    except ServiceError as e:
+        writer.write(http_response(e.status, {"error": str(e)}, {"Connection": "close"}))
+        return
+    except Exception:
+        logger.exception("流式问诊失败")
+        writer.write(http_response(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal error"}, {"Connection": "close"}))
+        return
+    # 标记可能被拆在相邻分片之间：清洗累计的全文，只发出新增的部分，可能是标记开头的尾部留到下一段
+    raw = first
+    sent = len(strip_partial_marker(clean_model_output(raw)))
+    writer.write(sse_headers())
+    writer.write(sse_event({"delta": clean_model_output(raw)[:sent]}))
+    try:
+        async for delta in stream:
+            raw += delta
+            text = strip_partial_marker(clean_model_output(raw))
+            if len(text) > sent:
+                writer.write(sse_event({"delta": text[sent:]}))
+                sent = len(text)
+            await writer.drain()
+    except ServiceError as e:
+        writer.write(sse_event({"error": str(e)}))
+    except ConnectionError:
+        raise
+    except Exception:
+        logger.exception("流式问诊失败")
+        writer.write(sse_event({"error": "internal error"}))
+    rest = clean_model_output(raw)[sent:]
+    if rest:
+        writer.write(sse_event({"delta": rest}))
+    writer.write(sse_event("[DONE]"))
+    await writer.drain()
+
+
+async def handle_connection(service, reader, writer):
+    try:
+        while True:
+            try:
+                request = await read_http_request(reader)
+            except RequestTooLarge:
+                # 请求体未读取，连接上剩余的字节无法作为下一个请求解析
+                writer.write(
+                    http_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "request too large"}, {"Connection": "close"})
+                )
+                await writer.drain()
+                break
+            except ValueError:
+                # 请求行或 Content-Length 格式不对：无法确定下一个请求的边界，回复后关闭连接
+                writer.write(http_response(HTTPStatus.BAD_REQUEST, {"error": "malformed request"}, {"Connection": "close"}))
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+            if method == "GET" and path == "/healthz":
+                writer.write(http_response(HTTPStatus.OK, service.status()))
+            elif method == "GET" and path == "/metrics":
+                writer.write(http_response(HTTPStatus.OK, metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE))
+            elif method == "POST" and path == "/v1/consult":
+                try:
+                    params, stream = parse_consult_request(body)
+                except ValueError as e:
+                    writer.write(http_response(HTTPStatus.BAD_REQUEST, {"error": str(e)}))
+                else:
+                    if stream:
+                        await _write_consult_stream(service, params, writer)
+                        break
+                    try:
+                        result = await service.consult(**params)
+                    except ServiceError as e:
+                        writer.write(http_response(e.status, {"error": str(e)}))
+                    except Exception:
+                        logger.exception("问诊失败")
+                        writer.write(http_response(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal error"}))
+                    else:
+                        writer.write(http_response(HTTPStatus.OK, result))
+            else:
+                writer.write(http_response(HTTPStatus.NOT_FOUND, {"error": "not found"}))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(service, host="127.0.0.1", port=8600):
+    return await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+
+
+def build_default_service(api_key, config=None, vector_index_dir=None, client=None):
+    """独立部署时使用：BM25 检索，指定预编译索引目录时再融合 NumPy 向量检索；client 可替换为模拟客户端。"""
+    documents = load_knowledge_documents()
+    vectorstore = None
+    if vector_index_dir and os.path.exists(os.path.join(vector_index_dir, "shards.json")):
+        # python ingest.py 生成的分片目录，按 TCM_KNOWLEDGE / TCM_KNOWLEDGE_SHARDS 选择分片
+        from ingest import load_sharded_vectorstore
+
+        vectorstore = load_sharded_vectorstore(knowledge_sources(KNOWLEDGE_PATH, KNOWLEDGE_SHARDS), "numpy", vector_index_dir)
+    elif vector_index_dir:
+        from vector_index import NumpyVectorStore, load_query_encoder
+
+        vectorstore = NumpyVectorStore(vector_index_dir, load_query_encoder(vector_index_dir))
+    retriever = HybridRetriever(documents, vectorstore)
+    retriever.warm_query_embeddings(picker_queries())
+    config = config or ServiceConfig.from_env()
+    client = client or GLMClient(api_key, config.base_url, config.request_timeout, config.max_connections)
+    return ConsultationService(client, lambda: retriever, build_prompt_assembler(documents), config, SymptomIndex(documents))
+
+
+async def serve(host, port, vector_index_dir=None, warmup=0):
+    service = build_default_service(os.environ.get("ZHIPUAI_API_KEY", ""), vector_index_dir=vector_index_dir)
+    service.register_metrics()
+    server = await start_http_server(service, host, port)
+    logger.info(json.dumps({"event": "service_started", "host": host, "port": port, "base_url": service.config.base_url}))
+    if warmup:
+        # 边提供服务边在后台预热首轮追问缓存
+        warmup_task = asyncio.ensure_future(service.warm_inquiry_cache(warmup_queries(warmup), warmup_profiles()))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if warmup:
+            warmup_task.cancel()
+        await service.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="异步问诊服务")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--vector-index", help="预编译 NumPy 向量索引目录（python vector_index.py build 或 ingest.py 生成）")
+    parser.add_argument("--warm-inquiry-cache", type=int, default=0, metavar="N", help="启动后用前 N 个常见症状组合预热首轮追问缓存")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    asyncio.run(serve(args.host, args.port, args.vector_index, args.warm_inquiry_cache))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# ----------- 回复内容格式化 -----------
+# 把模型输出转换成 HTML：修复残缺的 <b>/<br> 标签、Markdown 加粗转 <b>、
+# 序号和中文标题前换行、• 列表转 <ul><li>、去掉孤立的 < 与换行。
+# 规则按原有顺序逐条替换（正则预编译）；每条回复只在追加消息时渲染一次，结果随消息保存（见 render_reply）。
+# 结果以 unsafe_allow_html 展示，最后只保留格式化产生的几种标签，其余 "<" 一律转义，模型输出中的脚本、事件属性不会生效。
+import re
+
+_CN_NUMERALS = "一二三四五六七八九十"
+
+# 修复残缺标签与加粗：bold=False 时只保留文字，不加 <b>
+_BOLD_RULES = {
+    True: ((re.compile(r"b>([^<]+?)/b>"), r"<b>\1</b>"), (re.compile(r"br>"), "<br>"), (re.compile(r"\*\*(.*?)\*\*"), r"<b>\1</b>")),
+    False: ((re.compile(r"b>([^<]+?)/b>"), r"\1"), (re.compile(r"br>"), "<br>"), (re.compile(r"\*\*(.*?)\*\*"), r"\1")),
+}
+_LAYOUT_RULES = (
+    # 数字序号和中文序号前加换行
+    (re.compile(r"(\d+\.)"), r"<br>\1"),
+    (re.compile(rf"（[{_CN_NUMERALS}]）"), r"<br>\g<0>"),
+    # 主标题
+    (re.compile(rf"([{_CN_NUMERALS}])、([^\n<]+)"), r"<br>\1、\2"),
+    # 列表点转 HTML
+    (re.compile(r"•\s*(.+)"), r"<ul><li>\1</li></ul>"),
+    # 独立的 <，不破坏 HTML 标签
+    (re.compile(r"(?<!<)(<)(?![a-z/])"), ""),
+)
+
+# 允许出现在回复 HTML 中的标签（不带属性）；其它以 "<" 开头的内容都按文本显示
+_UNSAFE_LT = re.compile(r"<(?!(?:/?(?:b|ul|li)|br/?)>)")
+
+# 不含任何规则会匹配的字符时原样返回，省去逐条扫描
+_NEEDS_RENDER = re.compile(rf"[<b*\d（{_CN_NUMERALS}•\n]").search
+
+
+def render_ai_content(content, bold=True):
+    """bold=False 时去掉加粗（用于"专业调理方案"卡片）。"""
+    if not _NEEDS_RENDER(content):
+        return content
+    for pattern, replacement in _BOLD_RULES[bold] + _LAYOUT_RULES:
+        content = pattern.sub(replacement, content)
+    # 去掉多余空行
+    return _UNSAFE_LT.sub("&lt;", content.replace("\n", ""))
+
+
+def format_ai_content(content):
+    return render_ai_content(content, bold=True)
+
+
+def format_ai_content_no_bold(content):
+    return render_ai_content(content, bold=False)
+
+
+def split_diagnosis(content):
+    # 按"二、养生建议"拆成（辨证分析，养生建议）两段；尚未出现时养生建议为 None
+    parts = content.split("二、养生建议", 1)
+    analysis = parts[0].replace('一、辨证分析', '').strip()
+    suggestions = parts[1].strip() if len(parts) > 1 else None
+    return analysis, suggestions
+
+
+def render_reply(content, partial=False):
+    """把一条助手回复渲染成展示用的 HTML 片段，追加消息时调用一次并随消息保存。
+
+    完整回复同时包含"一、辨证分析"和"二、养生建议"时拆成两段；
+    partial=True 用于流式渲染，只要出现"一、辨证分析"就按辨证展示。
+    """
+    if "一、辨证分析" in content and (partial or "二、养生建议" in content):
+        analysis, suggestions = split_diagnosis(content)
+        return {
+            "kind": "diagnosis",
+            "analysis": format_ai_content(analysis),
+            "suggestions": format_ai_content(suggestions) if suggestions is not None else None,
+        }
+    return {"kind": "inquiry", "body": format_ai_content(content)}
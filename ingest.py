@@ -0,0 +1,510 @@
+# ----------- 多文件知识库批量导入 -----------
+# 把一个目录下的知识库文件（整本教材，总量可达数百 MB）导入向量库，每个文件一个分片：
+# NumPy 后端为 vector_index/shards/<分片名>/（格式同 vector_index.py build），Chroma 后端为 chroma_db/shards 中以分片名开头的集合（当前版本记录在 shards.json 中，重新导入时写入新集合再切换）。
+# 流水线：逐行读取文件，在 "## 分类" / "### 疾病" 标题处（标题稀少时在证型处，再不行在空行处）切成有界大小的文本块 → 进程池并行解析 →
+# 按批计算向量 → 按批写入（NumPy 顺序追加，Chroma 每批一次 upsert）。
+# 在途的文本块数与批大小都有上限，内存占用不随语料规模增长；内容未变化的文件（按 SHA-256）直接跳过。
+# 检索时由 knowledge_base.ShardedVectorStore 在所选分片间汇总。
+#
+# 用法：
+#   python ingest.py knowledge/ --workers 8                        # NumPy 分片（默认 float16）
+#   python ingest.py knowledge/ --backend chroma --batch-size 128
+#   python ingest.py knowledge/ --tune                             # 先在样本上比较几种批大小，取吞吐最高的
+#   TCM_KNOWLEDGE=knowledge/ TCM_VECTOR_BACKEND=numpy streamlit run app.py
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+import uuid
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+
+from knowledge_base import (
+    EMBEDDING_MODEL,
+    KNOWLEDGE_PATH,
+    KNOWLEDGE_SUFFIXES,
+    PROJECT_DIR,
+    REMEDY_HEADING,
+    SPLITTER_CONFIG,
+    ShardedVectorStore,
+    knowledge_sources,
+    parse_knowledge,
+    shard_name,
+    source_label,
+    unique_record_ids,
+)
+from metrics import TimedEmbeddings
+from vector_index import INDEX_DIR, NumpyVectorStore, load_query_encoder, quantize
+
+logger = logging.getLogger("tcm.ingest")
+
+SHARD_INDEX_DIR = os.path.join(INDEX_DIR, "shards")
+CHROMA_SHARD_DIR = os.path.join(PROJECT_DIR, "chroma_db", "shards")
+SHARDS_MANIFEST = "shards.json"
+# 文本块的目标字符数；进程池中同时在途的块不超过 2 × workers
+BLOCK_CHARS = 512 * 1024
+DEFAULT_BATCH_SIZE = 64
+TUNE_CANDIDATES = (16, 32, 64, 128, 256)
+# 临时向量文件拷贝成 .npy 时每次搬运的行数
+COPY_BLOCK_ROWS = 65536
+
+
+def default_root(backend):
+    return SHARD_INDEX_DIR if backend == "numpy" else CHROMA_SHARD_DIR
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # Linux 上 ru_maxrss 以 KB 计，macOS 以字节计
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# ----------- 切块与并行解析 -----------
+def iter_blocks(path, block_chars=BLOCK_CHARS):
+    """逐行读取并切成约 block_chars 字符的块，新块开头补上所属的 "## " / "### " 行。
+
+    超过 block_chars 后优先在标题处切开，其次在新证型（【…】，【改善措施】除外）处切开，这两种切法解析结果与整体解析一致；
+    超过 2 × block_chars 仍没有这样的位置（标题与证型都很少的大文件）时在空行处切开，
+    此时跨块的那一段会被拆成两条记录，但块的大小始终有界。
+    """
+    lines, size, section, disease, emitted = [], 0, None, None, False
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            text = line.strip()
+            is_section, is_disease = text.startswith("## "), text.startswith("### ")
+            is_record = text.startswith("【") and text.endswith("】") and text != REMEDY_HEADING
+            if size >= block_chars and (is_section or is_disease or is_record or (not text and size >= 2 * block_chars)):
+                yield "".join(lines)
+                emitted = True
+                lines, size = [header for header in (section, None if is_disease else disease) if header and not is_section], 0
+            if is_section:
+                section, disease = (line if line.endswith("\n") else line + "\n"), None
+            elif is_disease:
+                disease = line if line.endswith("\n") else line + "\n"
+            lines.append(line)
+            size += len(line)
+    if lines or not emitted:
+        yield "".join(lines)
+
+
+def _entries(records, path, seen):
+    source = source_label(path)
+    ids = unique_record_ids(records, source, seen)
+    return [(record.text, record.to_metadata(record_id, source)) for record_id, record in zip(ids, records)]
+
+
+def iter_parsed(sources, pool, workers, block_chars=BLOCK_CHARS):
+    """按文件顺序产出 (source, [(page_content, metadata), ...])；文件内与文件间的块都提前提交给进程池。"""
+    pending, seen = deque(), {}
+
+    def drain(limit):
+        while len(pending) > limit:
+            source, future = pending.popleft()
+            yield source, _entries(future.result(), source, seen.setdefault(source, Counter()))
+
+    for source in sources:
+        for text in iter_blocks(source, block_chars):
+            pending.append((source, pool.submit(parse_knowledge, text)))
+            yield from drain(2 * workers - 1)
+    yield from drain(0)
+
+
+def tune_batch_size(encoder, texts, candidates=TUNE_CANDIDATES):
+    """在样本上依次尝试各批大小，返回 (吞吐最高的批大小, {批大小: 条/秒})。"""
+    encoder.embed_documents(texts[:2])  # 预热，避免第一个候选承担模型初始化
+    results = {}
+    for size in candidates:
+        sample = texts[:2 * size]
+        if len(sample) < size:
+            break
+        if hasattr(encoder, "batch_size"):
+            encoder.batch_size = size
+        start = time.perf_counter()
+        for i in range(0, len(sample), size):
+            encoder.embed_documents(sample[i:i + size])
+        results[size] = round(len(sample) / (time.perf_counter() - start), 1)
+    best = max(results, key=results.get) if results else DEFAULT_BATCH_SIZE
+    if hasattr(encoder, "batch_size"):
+        encoder.batch_size = best
+    return best, results
+
+
+# ----------- 分片写入 -----------
+class NumpyShardWriter:
+    """按批追加写入一个 NumPy 分片：向量顺序写入临时文件，结束时分块拷贝成可内存映射的 .npy；
+    记录元数据边写边输出到 metadata.json。写在 <分片>.tmp 目录中，完成后整体替换旧分片。"""
+
+    def __init__(self, root, name, source, source_hash, dtype="float16"):
+        self.final_dir = os.path.join(root, name)
+        self.dir = f"{self.final_dir}.tmp"
+        self.dtype = dtype
+        self.count = 0
+        self.dim = 0
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir)
+        self._raw_path = os.path.join(self.dir, "embeddings.raw")
+        self._vectors = open(self._raw_path, "wb")
+        self._sq_norms, self._scales = [], []
+        self._meta = open(os.path.join(self.dir, "metadata.json"), "w", encoding="utf-8")
+        header = {
+            "embedding_model": EMBEDDING_MODEL,
+            "splitter": SPLITTER_CONFIG,
+            "dtype": dtype,
+            "source": source,
+            "source_hash": source_hash,
+        }
+        # 记录逐条写入 "records" 数组，dim 与 count 在结尾补上（JSON 对象的键顺序无关紧要）
+        self._meta.write(json.dumps(header, ensure_ascii=False)[:-1] + ', "records": [')
+
+    def add(self, entries, vectors):
+        stored, scales, sq_norms = quantize(vectors, self.dtype)
+        self.dim = stored.shape[1]
+        self._vectors.write(stored.tobytes())
+        self._sq_norms.append(sq_norms)
+        if scales is not None:
+            self._scales.append(scales)
+        for text, metadata in entries:
+            record = json.dumps({"page_content": text, "metadata": metadata}, ensure_ascii=False)
+            self._meta.write(("," if self.count else "") + record)
+            self.count += 1
+
+    def close(self):
+        self._meta.write(f'], "dim": {self.dim}, "count": {self.count}}}')
+        self._meta.close()
+        self._vectors.close()
+        dtype = np.int8 if self.dtype == "int8" else np.float16
+        shape = (self.count, self.dim)
+        matrix = np.lib.format.open_memmap(os.path.join(self.dir, "embeddings.npy"), mode="w+", dtype=dtype, shape=shape)
+        if self.count:
+            raw = np.memmap(self._raw_path, dtype=dtype, mode="r", shape=shape)
+            for start in range(0, self.count, COPY_BLOCK_ROWS):
+                matrix[start:start + COPY_BLOCK_ROWS] = raw[start:start + COPY_BLOCK_ROWS]
+            del raw
+        matrix.flush()
+        del matrix
+        os.remove(self._raw_path)
+        np.save(os.path.join(self.dir, "sq_norms.npy"), np.concatenate(self._sq_norms or [np.zeros(0, np.float32)]))
+        if self.dtype == "int8":
+            np.save(os.path.join(self.dir, "scales.npy"), np.concatenate(self._scales or [np.zeros(0, np.float32)]))
+        shutil.rmtree(self.final_dir, ignore_errors=True)
+        os.replace(self.dir, self.final_dir)
+
+    def abort(self):
+        self._meta.close()
+        self._vectors.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def chroma_client(root):
+    import chromadb
+
+    return chromadb.PersistentClient(path=root)
+
+
+def chroma_collections(client):
+    # chromadb 0.6 起 list_collections 只返回集合名，之前的版本返回集合对象
+    return {getattr(collection, "name", collection) for collection in client.list_collections()}
+
+
+class ChromaShardWriter:
+    """一个分片的一次导入写入 Chroma 中一个新的集合（<分片名>-<随机后缀>），每批向量一次 upsert。
+
+    旧集合在导入期间保持可用：Ingester 在 close() 之后把清单指向新集合，再调用 drop_previous() 删除旧集合；
+    中途失败或进程被杀时清单仍指向旧集合，未完成的新集合在下次导入该分片时清理。
+    """
+
+    def __init__(self, root, name):
+        self.client = chroma_client(root)
+        self.shard = name
+        self.collection_name = f"{name}-{uuid.uuid4().hex[:8]}"
+        self.collection = self.client.create_collection(self.collection_name)
+        self.count = 0
+        self._closed = False
+
+    def add(self, entries, vectors):
+        # 向量已按批算好，直接 upsert，不再经过嵌入函数
+        self.collection.upsert(
+            ids=[metadata["record_id"] for _, metadata in entries],
+            embeddings=vectors.tolist(),
+            metadatas=[metadata for _, metadata in entries],
+            documents=[text for text, _ in entries],
+        )
+        self.count += len(entries)
+
+    def close(self):
+        self._closed = True
+
+    def drop_previous(self):
+        """删除该分片的其它集合（被替换的旧版本与中断遗留的半成品），清单已指向本次写入的集合后调用。"""
+        for name in chroma_collections(self.client):
+            if name != self.collection_name and name.startswith(f"{self.shard}-"):
+                self.client.delete_collection(name)
+
+    def abort(self):
+        if not self._closed:
+            self.client.delete_collection(self.collection_name)
+
+
+# ----------- 分片清单 -----------
+# <root>/shards.json 记录每个分片的来源文件、内容哈希、嵌入模型与切分参数，每完成一个分片写一次；
+# 同时记下来源文件的 (mtime, size)，两者都没变时直接沿用记录的哈希，启动时不必重读整个语料
+def load_shard_manifest(root):
+    try:
+        with open(os.path.join(root, SHARDS_MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_shard_manifest(root, manifest):
+    path = os.path.join(root, SHARDS_MANIFEST)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def source_stat(path):
+    stat = os.stat(path)
+    return {"source_mtime_ns": stat.st_mtime_ns, "source_size": stat.st_size}
+
+
+def source_digest(path, info, stat=None):
+    """来源文件的内容哈希：(mtime, size) 与清单记录一致时沿用记录的哈希，否则重新计算。"""
+    stat = stat or source_stat(path)
+    if info and info.get("source_hash") and all(info.get(key) == value for key, value in stat.items()):
+        return info["source_hash"]
+    return file_digest(path)
+
+
+def is_shard_current(info, source_hash, dtype=None):
+    return (
+        bool(info)
+        and info.get("source_hash") == source_hash
+        and info.get("embedding_model") == EMBEDDING_MODEL
+        and info.get("splitter") == SPLITTER_CONFIG
+        and (dtype is None or info.get("dtype") == dtype)
+    )
+
+
+class Ingester:
+    """把一组知识库文件导入分片向量库；encoder 需提供 embed_documents(texts)。"""
+
+    def __init__(self, encoder, backend="numpy", root=None, workers=None, batch_size=DEFAULT_BATCH_SIZE, dtype="float16",
+                 block_chars=BLOCK_CHARS):
+        self.encoder = encoder
+        self.backend = backend
+        self.root = root or default_root(backend)
+        self.workers = max(1, workers or min(8, os.cpu_count() or 1))
+        self.batch_size = batch_size
+        self.dtype = dtype if backend == "numpy" else None
+        self.block_chars = block_chars
+        self.stats = {"files": 0, "skipped_files": 0, "chunks": 0, "bytes": 0, "embed_seconds": 0.0, "write_seconds": 0.0}
+        self.shards = {}
+
+    def _open(self, source, source_hash):
+        name = shard_name(source)
+        if self.backend == "numpy":
+            return NumpyShardWriter(self.root, name, source, source_hash, self.dtype)
+        return ChromaShardWriter(self.root, name)
+
+    def _flush(self, writer, entries):
+        start = time.perf_counter()
+        vectors = np.asarray(self.encoder.embed_documents([text for text, _ in entries]), dtype=np.float32)
+        self.stats["embed_seconds"] += time.perf_counter() - start
+        start = time.perf_counter()
+        writer.add(entries, vectors)
+        self.stats["write_seconds"] += time.perf_counter() - start
+        self.stats["chunks"] += len(entries)
+
+    def _exists(self, name, info):
+        if self.backend == "numpy":
+            return os.path.isdir(os.path.join(self.root, name))
+        return bool(info) and info.get("collection") in chroma_collections(chroma_client(self.root))
+
+    def pending(self, sources, digests, force=False):
+        manifest = load_shard_manifest(self.root)
+        return [
+            source for source in sources
+            if force or not is_shard_current(manifest.get(shard_name(source)), digests[source], self.dtype)
+            or not self._exists(shard_name(source), manifest.get(shard_name(source)))
+        ]
+
+    def run(self, sources, force=False):
+        os.makedirs(self.root, exist_ok=True)
+        start = time.perf_counter()
+        manifest = load_shard_manifest(self.root)
+        # 先取 stat 再算哈希：哈希期间文件被改写时记下的是旧的 mtime，下次会重新计算
+        stats = {source: source_stat(source) for source in sources}
+        digests = {source: source_digest(source, manifest.get(shard_name(source)), stats[source]) for source in sources}
+        todo = self.pending(sources, digests, force)
+        self.stats["skipped_files"] = len(sources) - len(todo)
+        touched = False
+        for source in set(sources) - set(todo):
+            info = manifest.get(shard_name(source))
+            if any(info.get(key) != value for key, value in stats[source].items()):
+                # 内容未变但 mtime 变了（如被 touch 或重新检出）：更新记录，下次启动不再重算哈希
+                info.update(stats[source])
+                touched = True
+        if touched:
+            save_shard_manifest(self.root, manifest)
+        writer, current, buffer = None, None, []
+
+        def finish():
+            while buffer:
+                self._flush(writer, buffer[:self.batch_size])
+                del buffer[:self.batch_size]
+            write_start = time.perf_counter()
+            writer.close()
+            self.stats["write_seconds"] += time.perf_counter() - write_start
+            self.stats["files"] += 1
+            self.stats["bytes"] += os.path.getsize(current)
+            name = shard_name(current)
+            manifest[name] = {
+                "source": current,
+                "source_hash": digests[current],
+                **stats[current],
+                "embedding_model": EMBEDDING_MODEL,
+                "splitter": SPLITTER_CONFIG,
+                "dtype": self.dtype,
+                "count": writer.count,
+            }
+            if self.backend == "chroma":
+                manifest[name]["collection"] = writer.collection_name
+            save_shard_manifest(self.root, manifest)
+            if self.backend == "chroma":
+                writer.drop_previous()
+            self.shards[name] = {"source": current, "chunks": writer.count}
+            logger.info(json.dumps({"event": "shard_ingested", "shard": name, **self.shards[name]}, ensure_ascii=False))
+
+        # 在 Streamlit 的后台线程中也会调用，用 spawn 启动子进程，避免 fork 带走其它线程持有的锁
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            try:
+                for source, entries in iter_parsed(todo, pool, self.workers, self.block_chars):
+                    if source != current:
+                        if writer is not None:
+                            finish()
+                        writer, current = self._open(source, digests[source]), source
+                    buffer.extend(entries)
+                    while len(buffer) >= self.batch_size:
+                        self._flush(writer, buffer[:self.batch_size])
+                        del buffer[:self.batch_size]
+                if writer is not None:
+                    finish()
+            except BaseException:
+                if writer is not None:
+                    writer.abort()
+                raise
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        stats = {key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()}
+        return {
+            **stats,
+            "seconds": round(elapsed, 3),
+            "chunks_per_second": round(self.stats["chunks"] / elapsed, 1) if elapsed else None,
+            "mb_per_second": round(self.stats["bytes"] / 1024 / 1024 / elapsed, 2) if elapsed else None,
+            "batch_size": self.batch_size,
+            "workers": self.workers,
+            "peak_rss_mb": peak_rss_mb(),
+            # 已退出的解析子进程中峰值最高的一个
+            "worker_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "shards": self.shards,
+        }
+
+
+# ----------- 检索时加载 -----------
+def load_sharded_vectorstore(sources, backend="chroma", root=None, phase=None):
+    """返回所选文件对应分片的 ShardedVectorStore。
+
+    numpy：分片需事先用 python ingest.py 导入，缺失或过期时与单文件的 numpy 后端一样退回 Chroma；
+    chroma：缺失或过期的分片在这里增量导入，未变化的直接打开。
+    """
+    phase = phase or (lambda name: nullcontext())
+    if backend == "numpy":
+        root = root or SHARD_INDEX_DIR
+        manifest = load_shard_manifest(root)
+        stale = [
+            source for source in sources
+            if not is_shard_current(manifest.get(shard_name(source)), source_digest(source, manifest.get(shard_name(source))))
+            or not os.path.isdir(os.path.join(root, shard_name(source)))
+        ]
+        if not stale:
+            shards = {shard_name(source): NumpyVectorStore(os.path.join(root, shard_name(source))) for source in sources}
+            # 导出的 ONNX 查询编码器放在分片目录的上一级（默认即 vector_index/onnx）
+            encoder = TimedEmbeddings(load_query_encoder(os.path.dirname(os.path.abspath(root))))
+            return ShardedVectorStore(shards, encoder)
+        logger.warning("%d 个分片的 NumPy 索引缺失或已过期，请重新运行 python ingest.py，暂时改用 Chroma。", len(stale))
+        root = None
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from langchain_community.vectorstores import Chroma
+
+    root = root or CHROMA_SHARD_DIR
+    with phase("warmup:embedding_model"):
+        embeddings = TimedEmbeddings(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL))
+    with phase("warmup:vectorstore"):
+        report = Ingester(embeddings, "chroma", root).run(sources)
+        if report["files"]:
+            logger.info(json.dumps({"event": "ingest_finished", **report}, ensure_ascii=False))
+        manifest = load_shard_manifest(root)
+        shards = {
+            shard_name(source): Chroma(
+                collection_name=manifest[shard_name(source)]["collection"], persist_directory=root, embedding_function=embeddings
+            )
+            for source in sources
+        }
+    return ShardedVectorStore(shards, embeddings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多文件知识库并行导入（每个文件一个分片）")
+    parser.add_argument("path", nargs="?", default=KNOWLEDGE_PATH, help="知识库目录或单个文件")
+    parser.add_argument("--backend", choices=["numpy", "chroma"], default="numpy")
+    parser.add_argument("--root", help="分片存放目录，默认 vector_index/shards 或 chroma_db/shards")
+    parser.add_argument("--shard", action="append", help="只导入指定的分片名或文件名，可重复指定")
+    parser.add_argument("--workers", type=int, help="解析进程数，默认 min(8, CPU 核数)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="每批嵌入并写入的记录数")
+    parser.add_argument("--tune", action="store_true", help="先在样本上比较几种批大小，取吞吐最高的")
+    parser.add_argument("--dtype", choices=["float16", "int8"], default="float16", help="NumPy 分片的向量精度")
+    parser.add_argument("--force", action="store_true", help="忽略内容哈希，全部重新导入")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    sources = knowledge_sources(args.path, args.shard)
+    if not sources:
+        sys.exit(f"{args.path} 下没有知识库文件（{'、'.join(KNOWLEDGE_SUFFIXES)}）")
+    if args.backend == "numpy":
+        from vector_index import SentenceTransformerEncoder
+
+        encoder = SentenceTransformerEncoder(batch_size=args.batch_size)
+    else:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        encoder = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, encode_kwargs={"batch_size": args.batch_size})
+    batch_size = args.batch_size
+    if args.tune:
+        sample = [record.text for record in parse_knowledge(next(iter_blocks(sources[0])))][:2 * max(TUNE_CANDIDATES)]
+        batch_size, results = tune_batch_size(encoder, sample)
+        print(json.dumps({"event": "batch_size_tuned", "batch_size": batch_size, "records_per_second": results}))
+    ingester = Ingester(encoder, args.backend, args.root, args.workers, batch_size, args.dtype)
+    print(json.dumps(ingester.run(sources, args.force), ensure_ascii=False, indent=1))
+
+
+if __name__ == "__main__":
+    main()
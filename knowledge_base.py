@@ -0,0 +1,710 @@
+# ----------- 知识库解析、增量构建与混合检索 -----------
+# knowledge.txt 的层级是 "## 分类" → "### 疾病" → "【证型】" 症状行 → "【改善措施】" ■ 调理行。
+# 这里按"疾病/证型"整条切分，保证症状和对应的改善措施总在同一条记录里，
+# 再在内存中建立字符 n-gram 的 BM25 倒排索引，与向量检索的得分融合。
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+import metrics
+from metrics import TimedEmbeddings, timer
+
+# 默认的数据目录按项目目录解析，从其他工作目录运行脚本（如批量问诊、定时任务）也能找到
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+KNOWLEDGE_FILE = os.path.join(PROJECT_DIR, "knowledge", "knowledge.txt")
+# 也可以指向一个目录：其中每个知识库文件是一个分片，由 python ingest.py 并行导入，检索时在所选分片间汇总
+KNOWLEDGE_PATH = os.environ.get("TCM_KNOWLEDGE", KNOWLEDGE_FILE)
+# 逗号分隔的分片名或文件名，为空时使用目录下的全部文件
+KNOWLEDGE_SHARDS = [name for name in os.environ.get("TCM_KNOWLEDGE_SHARDS", "").split(",") if name.strip()]
+KNOWLEDGE_SUFFIXES = (".txt", ".md")
+# 按证型切分后的索引与旧的定长切分索引不兼容，使用独立的持久化目录
+CHROMA_PERSIST_DIR = os.path.join(PROJECT_DIR, "chroma_db", "syndromes")
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# 切分方式的标识，修改 parse_knowledge 的切分规则时需同步提升 version 以触发全量重建
+SPLITTER_CONFIG = {"name": "syndrome", "version": 1}
+MANIFEST_FILE = "manifest.json"
+# 检索器的进程级缓存：查询向量（每条约 1.5 KB）与 MMR 排序结果的条目数上限
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("TCM_QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+RANKING_CACHE_SIZE = int(os.environ.get("TCM_RANKING_CACHE_SIZE", "512"))
+# 同一查询一次排出的条数：辨证取 k=4、"更多中医建议"取 k=8，前者直接取后者的前缀
+RANKING_PREFIX_K = 8
+# 向量检索后端：chroma、numpy（需先运行 python vector_index.py build 预编译索引）或 bm25（不做向量检索）
+VECTOR_BACKENDS = ("chroma", "numpy", "bm25")
+
+logger = logging.getLogger("tcm.knowledge_base")
+
+# 症状选择器的词表，按身体部位分组
+SYMPTOM_KEYWORDS = {
+    "头部": ["头痛", "头晕", "偏头痛", "头重", "头胀"], "呼吸": ["咳嗽", "痰多", "咽痛", "流涕", "鼻塞", "打喷嚏", "呼吸急促"],
+    "消化": ["腹痛", "腹胀", "消化不良", "食欲不振", "恶心", "呕吐"], "睡眠": ["失眠", "多梦", "早醒", "嗜睡", "睡眠质量差"],
+    "情绪": ["焦虑", "抑郁", "烦躁", "易怒", "心神不宁", "心慌", "心悸"], "其他": ["疲劳", "乏力", "手脚冰凉", "出汗异常", "浮肿", "腰酸背痛"]
+}
+
+# 选择器症状在知识库症状行中的其它说法（症状本身总会参与匹配）
+SYMPTOM_SYNONYMS = {
+    "头痛": ["头目胀痛"], "头晕": ["眩晕", "头晕目眩"], "偏头痛": ["头痛", "头目胀痛"], "头重": ["困重"], "头胀": ["头目胀痛"],
+    "咳嗽": ["干咳", "咳声"], "痰多": ["痰黄", "痰白", "痰鸣"], "咽痛": ["咽喉干痛", "喉痒咽痛"], "流涕": ["流清涕"],
+    "呼吸急促": ["喘促", "气急", "喘甚", "气短"],
+    "腹痛": ["胃脘隐痛", "胃脘胀痛", "经行腹痛"], "腹胀": ["脘腹胀满", "脘闷", "右胁胀满"], "消化不良": ["纳呆", "嗳腐", "不思乳食", "嗳气"],
+    "食欲不振": ["纳呆", "饥不欲食", "不思乳食"], "恶心": ["呕吐"],
+    "失眠": ["不寐", "易醒"], "早醒": ["易醒"], "嗜睡": ["神疲", "肢倦"], "睡眠质量差": ["不寐", "多梦", "易醒"],
+    "焦虑": ["急躁", "心烦"], "抑郁": ["情绪低落", "善太息", "多愁善感"], "烦躁": ["心烦", "急躁", "烦热"], "易怒": ["急躁"],
+    "心神不宁": ["心悸不宁", "健忘"], "心慌": ["心悸"],
+    "疲劳": ["神疲", "肢倦", "乏力"], "乏力": ["无力", "神疲"], "手脚冰凉": ["畏寒肢冷", "手足不温", "四肢不温"],
+    "出汗异常": ["汗出", "盗汗", "自汗"], "浮肿": ["水肿"], "腰酸背痛": ["腰膝酸软", "腰背酸痛", "腰腿", "腰部"],
+}
+
+
+
+def picker_queries(keywords=SYMPTOM_KEYWORDS):
+    """只由选择器症状组成的常见查询：单个症状与同一部位内的两两组合，按选择器中的顺序以"、"连接（与页面拼接方式一致）。"""
+    queries = [term for terms in keywords.values() for term in terms]
+    queries += ["、".join(pair) for terms in keywords.values() for pair in itertools.combinations(terms, 2)]
+    return queries
+
+
+def query_key(query):
+    # 缓存键只做全角/半角统一与去首尾空白，不改变词序（词序会影响查询向量）
+    return unicodedata.normalize("NFKC", query).strip()
+
+
+REMEDY_HEADING = "【改善措施】"
+# 用于把查询拆成独立症状词的分隔符
+TERM_SEPARATORS = re.compile(r"[、，,；;。.\s/]+")
+# n-gram 只在连续的汉字/字母数字片段内生成，标点不参与
+TOKEN_SEGMENTS = re.compile(r"[一-鿿A-Za-z0-9]+")
+
+
+@dataclass
+class KnowledgeDocument:
+    # 字段与 langchain 的 Document 一致，可直接交给 Chroma.add_documents，无需在启动时导入 langchain
+    page_content: str
+    metadata: dict = field(default_factory=dict)
+
+
+@dataclass
+class SyndromeRecord:
+    section: str
+    disease: str
+    syndrome: str
+    symptoms: list = field(default_factory=list)
+    remedies: list = field(default_factory=list)
+    notes: list = field(default_factory=list)
+
+    @property
+    def text(self):
+        lines = [f"{self.disease}【{self.syndrome}】" if self.syndrome else self.disease]
+        lines += self.notes
+        lines += [f"- {line}" for line in self.symptoms]
+        if self.remedies:
+            lines.append(REMEDY_HEADING)
+            lines += [f"■ {line}" for line in self.remedies]
+        return "\n".join(lines)
+
+    def to_metadata(self, record_id, source):
+        # Chroma 的 metadata 只接受标量，列表字段按行拼接
+        metadata = {
+            "record_id": record_id,
+            "source": source,
+            "section": self.section,
+            "disease": self.disease,
+            "syndrome": self.syndrome,
+            "symptoms": "\n".join(self.symptoms),
+            "remedies": "\n".join(self.remedies),
+        }
+        metadata["content_hash"] = content_hash(self.text, metadata)
+        return metadata
+
+
+def parse_knowledge(text):
+    """按 疾病/证型 解析知识库文本，每个证型一条记录；没有证型的小节整体作为一条记录。"""
+    records = []
+    section = disease = ""
+    current = None
+
+    def start(syndrome):
+        nonlocal current
+        current = SyndromeRecord(section=section, disease=disease, syndrome=syndrome)
+        records.append(current)
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith("# "):
+            continue
+        if line.startswith("### "):
+            disease = line[4:].strip()
+            current = None
+        elif line.startswith("## "):
+            section = disease = line[3:].strip()
+            current = None
+        elif line == REMEDY_HEADING:
+            if current is None:
+                start("")
+        elif line.startswith("【") and line.endswith("】"):
+            syndrome = line[1:-1]
+            # "判断要点"之类的小标题不是证型，沿用疾病名
+            start("" if syndrome == "判断要点" else syndrome)
+        else:
+            if current is None:
+                start("")
+            if line.startswith("■"):
+                current.remedies.append(line.lstrip("■ ").strip())
+            elif line.startswith("-"):
+                current.symptoms.append(line.lstrip("- ").strip())
+            else:
+                current.notes.append(line)
+    return records
+
+
+def record_key(record):
+    # 以"疾病/证型"作为稳定 ID，文件中插入新条目不会让其它记录的 ID 漂移
+    return f"{record.disease}/{record.syndrome}" if record.syndrome else record.disease
+
+
+def unique_record_ids(records, source, seen=None):
+    # seen 由调用方传入时可跨多次调用累计，分块解析同一个文件时 ID 与整体解析一致
+    ids, seen = [], Counter() if seen is None else seen
+    for record in records:
+        key = f"{source}#{record_key(record)}"
+        seen[key] += 1
+        ids.append(key if seen[key] == 1 else f"{key}~{seen[key]}")
+    return ids
+
+
+def content_hash(text, metadata):
+    payload = json.dumps([text, metadata], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# ----------- 增量构建清单 -----------
+# manifest.json 记录嵌入模型、切分参数以及每条记录的内容哈希；
+# 启动时与当前知识库比对，只嵌入新增或修改的记录，删除已移除的记录。
+def load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(path, embedding_model, splitter, documents):
+    manifest = {
+        "embedding_model": embedding_model,
+        "splitter": splitter,
+        "chunks": {doc.metadata["record_id"]: doc.metadata["content_hash"] for doc in documents},
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class IndexPlan:
+    rebuild: bool
+    to_add: list
+    to_delete: list
+
+    @property
+    def changed(self):
+        return self.rebuild or bool(self.to_add or self.to_delete)
+
+
+def plan_index_update(manifest, documents, embedding_model, splitter):
+    """对比清单与当前文档，给出需要新增/删除的记录；模型或切分参数变化时要求全量重建。"""
+    if (
+        not manifest
+        or manifest.get("embedding_model") != embedding_model
+        or manifest.get("splitter") != splitter
+    ):
+        return IndexPlan(rebuild=True, to_add=list(documents), to_delete=[])
+    indexed = manifest.get("chunks", {})
+    current = {doc.metadata["record_id"]: doc for doc in documents}
+    to_add = [doc for key, doc in current.items() if indexed.get(key) != doc.metadata["content_hash"]]
+    # 内容变化的记录先删后加，Chroma 不会因同 ID 自动覆盖向量
+    to_delete = [key for key, digest in indexed.items() if key not in current or current[key].metadata["content_hash"] != digest]
+    return IndexPlan(rebuild=False, to_add=to_add, to_delete=to_delete)
+
+
+def source_label(path):
+    """记录 ID 与分片名中的来源：项目目录下的绝对路径换成相对项目目录的路径，
+    默认知识库的记录 ID 不随部署目录变化，已有的索引与缓存仍然有效。"""
+    if os.path.isabs(path):
+        relative = os.path.relpath(path, PROJECT_DIR)
+        if not relative.startswith(os.pardir):
+            return relative.replace(os.sep, "/")
+    return path
+
+
+def load_knowledge_entries(path, source=None):
+    """读取知识库文件，返回 (page_content, metadata) 列表，供向量库构建与检索共用。"""
+    source = source or source_label(path)
+    with open(path, encoding="utf-8") as f:
+        records = parse_knowledge(f.read())
+    ids = unique_record_ids(records, source)
+    return [(record.text, record.to_metadata(record_id, source)) for record_id, record in zip(ids, records)]
+
+
+def shard_name(source):
+    """分片名（Chroma 集合名与索引子目录名）：文件名中的 ASCII 部分加路径哈希，中文文件名也能得到合法名称。"""
+    stem = re.sub(r"[^A-Za-z0-9_-]+", "-", os.path.splitext(os.path.basename(source))[0]).strip("-_")[:40]
+    digest = hashlib.sha1(os.path.normpath(source_label(source)).replace(os.sep, "/").encode("utf-8")).hexdigest()[:8]
+    return f"{stem or 'kb'}-{digest}"
+
+
+def knowledge_sources(path=KNOWLEDGE_PATH, shards=None):
+    """path 为文件时返回 [path]；为目录时返回其中（含子目录）的知识库文件，shards 可按分片名或文件名筛选。"""
+    if not os.path.isdir(path):
+        return [path]
+    sources = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(path)
+        for name in names
+        if name.endswith(KNOWLEDGE_SUFFIXES)
+    )
+    if shards:
+        wanted = {name.strip() for name in shards}
+        sources = [source for source in sources if {shard_name(source), os.path.basename(source)} & wanted]
+    return sources
+
+
+def load_knowledge_documents(path=KNOWLEDGE_PATH, shards=KNOWLEDGE_SHARDS):
+    return [
+        KnowledgeDocument(text, metadata)
+        for source in knowledge_sources(path, shards)
+        for text, metadata in load_knowledge_entries(source)
+    ]
+
+
+# ----------- 向量库加载 -----------
+# 重依赖（langchain、Chroma、sentence-transformers）只在这里按需导入，可在后台线程或基准测试中直接调用。
+def sync_vectorstore(documents, embeddings, persist_dir=CHROMA_PERSIST_DIR):
+    from langchain_community.vectorstores import Chroma
+
+    manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+    plan = plan_index_update(load_manifest(manifest_path), documents, EMBEDDING_MODEL, SPLITTER_CONFIG)
+    vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embeddings)
+    if not plan.changed:
+        return vectorstore
+    if plan.rebuild:
+        logger.info("首次运行或嵌入模型/切分参数变化，正在全量构建向量数据库...")
+        vectorstore.delete_collection()
+        vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embeddings)
+    else:
+        logger.info("知识库有更新，正在增量同步：新增或修改 %d 条，删除 %d 条...", len(plan.to_add), len(plan.to_delete))
+    if plan.to_delete:
+        vectorstore.delete(ids=plan.to_delete)
+    if plan.to_add:
+        vectorstore.add_documents(plan.to_add, ids=[doc.metadata["record_id"] for doc in plan.to_add])
+    vectorstore.persist()
+    save_manifest(manifest_path, EMBEDDING_MODEL, SPLITTER_CONFIG, documents)
+    logger.info("知识库构建完成并已持久化！")
+    return vectorstore
+
+
+def load_numpy_vectorstore(documents, index_dir=None):
+    from vector_index import INDEX_DIR, NumpyVectorStore, is_index_current, load_query_encoder
+
+    index_dir = index_dir or INDEX_DIR
+    if not os.path.exists(os.path.join(index_dir, "metadata.json")):
+        logger.warning("未找到预编译的向量索引，请先运行 python vector_index.py build，暂时改用 Chroma。")
+        return None
+    store = NumpyVectorStore(index_dir)
+    if not is_index_current(store, documents):
+        logger.warning("预编译的向量索引与知识库不一致，请重新运行 python vector_index.py build，暂时改用 Chroma。")
+        return None
+    store.encoder = TimedEmbeddings(load_query_encoder(index_dir))
+    return store
+
+
+def search_by_vector(store, vector, k=4):
+    """按查询向量检索，返回 [(文档, 平方 L2 距离)]；store 为 NumpyVectorStore、ShardedVectorStore 或 Chroma。"""
+    if hasattr(store, "search_by_vector"):
+        return store.search_by_vector(vector, k)
+    vector = vector.tolist() if hasattr(vector, "tolist") else list(vector)
+    return store.similarity_search_by_vector_with_relevance_scores(vector, k=k)
+
+
+def query_encoder(store):
+    # NumpyVectorStore / ShardedVectorStore 的 encoder，Chroma 的 embeddings（即 embedding_function）
+    return getattr(store, "encoder", None) or getattr(store, "embeddings", None)
+
+
+class ShardedVectorStore:
+    """多个分片的向量库：查询向量只计算一次，在各分片上分别取 top-k，再按距离合并。
+
+    shards 为 {分片名: 向量库}，向量库为 NumpyVectorStore（search_by_vector）或 Chroma
+    （similarity_search_by_vector_with_relevance_scores，返回的同样是平方 L2 距离）；
+    相关度按与单一向量库相同的 1 - d/√2 换算，融合检索的排序不受分片方式影响。
+    """
+
+    def __init__(self, shards, encoder):
+        self.shards = dict(shards)
+        self.encoder = encoder
+
+    def search_by_vector(self, vector, k=4):
+        hits = [hit for store in self.shards.values() for hit in search_by_vector(store, vector, k)]
+        return sorted(hits, key=lambda hit: hit[1])[:k]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.search_by_vector(self.encoder.embed_query(query), k)
+
+    def similarity_search_with_relevance_scores(self, query, k=4):
+        return [(doc, 1.0 - distance / math.sqrt(2)) for doc, distance in self.similarity_search_with_score(query, k)]
+
+    def similarity_search(self, query, k=4):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+
+def load_retriever(
+    backend="chroma", path=KNOWLEDGE_PATH, persist_dir=CHROMA_PERSIST_DIR, index_dir=None, phase=None, shards=KNOWLEDGE_SHARDS,
+    lexical=None,
+):
+    """解析知识库并接上向量库，返回 HybridRetriever；phase(name) 为可选的计时上下文管理器。
+
+    path 为目录时按分片加载（见 ingest.py），persist_dir / index_dir 不指定时使用分片的默认目录。
+    lexical 为同一知识库已建好的纯 BM25 检索器时直接复用其文档与倒排索引，语料只解析、索引一次。
+    """
+    phase = phase or (lambda name: nullcontext())
+    if lexical is None:
+        lexical = HybridRetriever(load_knowledge_documents(path, shards))
+    documents = lexical.documents
+    if backend == "bm25":
+        return lexical
+    if os.path.isdir(path):
+        from ingest import load_sharded_vectorstore
+
+        sources = knowledge_sources(path, shards)
+        root = index_dir if backend == "numpy" else (None if persist_dir == CHROMA_PERSIST_DIR else persist_dir)
+        vectorstore = load_sharded_vectorstore(sources, backend, root, phase)
+    else:
+        vectorstore = load_numpy_vectorstore(documents, index_dir) if backend == "numpy" else None
+    if vectorstore is None:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        with phase("warmup:embedding_model"):
+            embeddings = TimedEmbeddings(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL))
+        with phase("warmup:vectorstore"):
+            vectorstore = sync_vectorstore(documents, embeddings, persist_dir)
+    retriever = lexical.with_vectorstore(vectorstore)
+    # 选择器症状组成的查询是固定词表的组合，启动时批量算好向量，点选症状后的检索不再现场嵌入
+    with phase("warmup:query_embeddings"):
+        retriever.warm_query_embeddings(picker_queries())
+    return retriever
+
+
+def char_ngrams(text, n=2):
+    grams = []
+    for segment in TOKEN_SEGMENTS.findall(text):
+        if len(segment) < n:
+            grams.append(segment)
+        else:
+            grams.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return grams
+
+
+class BM25Index:
+    """字符 n-gram 上的 BM25 倒排索引，语料只有几十到几百条，全部放在内存里。"""
+
+    def __init__(self, texts, k1=1.5, b=0.75, ngram=2):
+        self.k1 = k1
+        self.b = b
+        self.ngram = ngram
+        self.postings = defaultdict(list)
+        self.doc_len = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(char_ngrams(text, ngram))
+            self.doc_len.append(sum(counts.values()))
+            for gram, tf in counts.items():
+                self.postings[gram].append((doc_id, tf))
+        self.size = len(self.doc_len)
+        self.avg_len = (sum(self.doc_len) / self.size) if self.size else 0.0
+        self.idf = {
+            gram: math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            for gram, docs in self.postings.items()
+        }
+
+    def search(self, query, k=4):
+        scores = defaultdict(float)
+        for gram in set(char_ngrams(query, self.ngram)):
+            idf = self.idf.get(gram)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[gram]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / self.avg_len)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class LRUCache:
+    """线程安全的定长 LRU，按最近使用淘汰；name 用于 tcm_cache_lookups_total 的 cache 标签。"""
+
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        metrics.record_cache_lookup(self.name, "miss" if value is None else "hit")
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def status(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+def _min_max(scores):
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {key: 1.0 for key in scores}
+    return {key: (value - low) / (high - low) for key, value in scores.items()}
+
+
+class HybridRetriever:
+    """BM25 与向量检索的融合检索器。
+
+    documents 需带有 metadata["record_id"]，与向量库中的文档一一对应。
+    查询若全部由知识库症状行中原样出现的词组成（如"痰多黄稠"），直接走 BM25，不做向量嵌入。
+    检索器在进程内所有会话间共享：每个不同的查询只嵌入一次（LRU 缓存查询向量），
+    默认参数下的 MMR 结果一次排出前 RANKING_PREFIX_K 条并缓存，k=4 与 k=8 共用同一次检索。
+    """
+
+    def __init__(self, documents, vectorstore=None, alpha=0.5, fetch_k=12, lambda_mult=0.7,
+                 embedding_cache_size=QUERY_EMBEDDING_CACHE_SIZE, ranking_cache_size=RANKING_CACHE_SIZE):
+        self.documents = list(documents)
+        self.vectorstore = vectorstore
+        self.encoder = query_encoder(vectorstore)
+        self.embedding_cache = LRUCache("query_embedding", embedding_cache_size)
+        self.ranking_cache = LRUCache("ranking", ranking_cache_size)
+        self.alpha = alpha
+        self.fetch_k = fetch_k
+        self.lambda_mult = lambda_mult
+        self.bm25 = BM25Index([doc.page_content for doc in self.documents])
+        self._positions = {doc.metadata["record_id"]: i for i, doc in enumerate(self.documents)}
+        self._symptom_text = "\n".join(doc.metadata.get("symptoms", "") for doc in self.documents)
+        # MMR 用症状行的 n-gram 集合衡量两条记录的相似度，没有症状行时用全文
+        self._gram_sets = [
+            frozenset(char_ngrams(doc.metadata.get("symptoms") or doc.page_content)) for doc in self.documents
+        ]
+
+    def with_vectorstore(self, vectorstore):
+        """返回接上向量库的检索器，文档、BM25 倒排索引与 MMR 用的 n-gram 集合与本对象共用，不重新构建。"""
+        retriever = copy.copy(self)
+        retriever.vectorstore = vectorstore
+        retriever.encoder = query_encoder(vectorstore)
+        retriever.embedding_cache = LRUCache("query_embedding", self.embedding_cache.max_entries)
+        retriever.ranking_cache = LRUCache("ranking", self.ranking_cache.max_entries)
+        return retriever
+
+    def embed_query(self, query):
+        """查询向量（检索与首轮追问的语义缓存共用），命中缓存时不再计算；没有向量库时返回 None。"""
+        if self.encoder is None:
+            return None
+        key = query_key(query)
+        vector = self.embedding_cache.get(key)
+        if vector is None:
+            vector = self.encoder.embed_query(key)
+            self.embedding_cache.put(key, vector)
+        return vector
+
+    def warm_query_embeddings(self, queries, batch_size=64):
+        """批量计算并缓存一组查询的向量（已缓存的跳过），返回新计算的条数。"""
+        if self.encoder is None:
+            return 0
+        todo = [key for key in dict.fromkeys(query_key(query) for query in queries) if key not in self.embedding_cache]
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            for key, vector in zip(batch, self.encoder.embed_documents(batch)):
+                self.embedding_cache.put(key, vector)
+        return len(todo)
+
+    def cache_status(self):
+        return {"query_embedding": self.embedding_cache.status(), "ranking": self.ranking_cache.status()}
+
+    def is_exact_symptom_query(self, query):
+        terms = [term for term in TERM_SEPARATORS.split(query) if term]
+        return bool(terms) and all(len(term) >= 2 and term in self._symptom_text for term in terms)
+
+    def lexical_search(self, query, k=4):
+        return [(self.documents[i], score) for i, score in self.bm25.search(query, k)]
+
+    def get_relevant_documents(self, query, k=4):
+        return [doc for doc, _ in self.search_with_scores(query, k)]
+
+    def search_with_scores(self, query, k=4):
+        if self.vectorstore is None or self.is_exact_symptom_query(query):
+            with timer("bm25"):
+                return self.lexical_search(query, k)
+        fetch_k = max(k, self.fetch_k)
+        with timer("bm25"):
+            lexical = _min_max(dict(self.bm25.search(query, fetch_k)))
+        if self.encoder is None:
+            # 无法取得编码器的向量库：由向量库自行嵌入查询
+            with timer("vector_search"):
+                hits = self.vectorstore.similarity_search_with_relevance_scores(query, k=fetch_k)
+        else:
+            # 嵌入只在缓存未命中时发生，另计为 embed_query；这里只计向量检索本身
+            vector = self.embed_query(query)
+            with timer("vector_search"):
+                hits = [
+                    (doc, 1.0 - distance / math.sqrt(2)) for doc, distance in search_by_vector(self.vectorstore, vector, fetch_k)
+                ]
+        semantic = _min_max({
+            self._positions[doc.metadata["record_id"]]: score
+            for doc, score in hits
+            if doc.metadata.get("record_id") in self._positions
+        })
+        fused = {
+            i: self.alpha * semantic.get(i, 0.0) + (1 - self.alpha) * lexical.get(i, 0.0)
+            for i in lexical.keys() | semantic.keys()
+        }
+        ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[i], score) for i, score in ranked]
+
+    def similarity(self, i, j):
+        # 同名证型（如不同疾病下的"气阴两虚证"）视为重复，其余按症状 n-gram 的 Jaccard 系数
+        syndrome = self.documents[i].metadata.get("syndrome")
+        if syndrome and syndrome == self.documents[j].metadata.get("syndrome"):
+            return 1.0
+        a, b = self._gram_sets[i], self._gram_sets[j]
+        return len(a & b) / len(a | b) if a or b else 0.0
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=None, lambda_mult=None):
+        """先按融合得分取 fetch_k 条候选，再用 MMR 选出 k 条，让结果分散到不同的证型上。
+
+        MMR 逐条贪心选取，候选集相同时前 4 条就是前 8 条的前缀：默认参数下按 RANKING_PREFIX_K 排一次并缓存，
+        同一查询的辨证（k=4）与"更多中医建议"（k=8）共用这一次检索。
+        k 不超过 RANKING_PREFIX_K 时候选池一律按 RANKING_PREFIX_K 计算，缓存与否结果都相同。
+        """
+        if k <= RANKING_PREFIX_K and fetch_k is None and lambda_mult is None:
+            key = query_key(query)
+            ranked = self.ranking_cache.get(key)
+            if ranked is None:
+                ranked = self._mmr(query, RANKING_PREFIX_K, None, self.lambda_mult)
+                self.ranking_cache.put(key, ranked)
+            return ranked[:k]
+        return self._mmr(query, k, fetch_k, self.lambda_mult if lambda_mult is None else lambda_mult)
+
+    def _mmr(self, query, k, fetch_k, lambda_mult):
+        candidates = self.search_with_scores(query, max(2 * max(k, RANKING_PREFIX_K), fetch_k or self.fetch_k))
+        relevance = _min_max({self._positions[doc.metadata["record_id"]]: score for doc, score in candidates})
+        selected = []
+        while relevance and len(selected) < k:
+            best = max(
+                relevance,
+                key=lambda i: lambda_mult * relevance[i]
+                - (1 - lambda_mult) * max((self.similarity(i, j) for j in selected), default=0.0),
+            )
+            selected.append(best)
+            del relevance[best]
+        return [self.documents[i] for i in selected]
+
+
+@dataclass
+class SyndromeCandidate:
+    document: KnowledgeDocument
+    score: float
+    matched: tuple
+
+    @property
+    def name(self):
+        metadata = self.document.metadata
+        return f"{metadata['disease']}·{metadata['syndrome']}" if metadata.get("syndrome") else metadata["disease"]
+
+
+class SymptomIndex:
+    """选择器症状（含同义说法）→ 症状行中提到它的证型记录。
+
+    匹配度为所选症状中被该证型覆盖的比例，按症状的区分度（IDF）加权，
+    只涉及几十个集合的查表与求和，可在每次点选症状时直接计算。
+    文本中的症状按最长说法优先匹配，匹配到的片段不再参与较短说法的匹配（"偏头痛"不再算作"头痛"）。
+    """
+
+    def __init__(self, documents, vocabulary=None, synonyms=SYMPTOM_SYNONYMS):
+        vocabulary = vocabulary or [term for terms in SYMPTOM_KEYWORDS.values() for term in terms]
+        self.vocabulary = list(dict.fromkeys(vocabulary))
+        # 说法 → 对应的症状（同一说法可能是几个症状的同义词），按说法长度降序
+        variants = defaultdict(set)
+        for term in self.vocabulary:
+            for variant in (term, *synonyms.get(term, ())):
+                variants[variant].add(term)
+        self._variants = sorted(variants.items(), key=lambda item: (-len(item[0]), item[0]))
+        self.documents = [doc for doc in documents if doc.metadata.get("symptoms")]
+        postings = defaultdict(set)
+        for i, doc in enumerate(self.documents):
+            for term in self._scan(doc.metadata["symptoms"]):
+                postings[term].add(i)
+        self.postings = {term: frozenset(postings[term]) for term in self.vocabulary if term in postings}
+        size = len(self.documents)
+        self.weights = {term: math.log(1 + size / len(hits)) for term, hits in self.postings.items()}
+        # 没有任何证型提到的症状按只出现一次计权：仍计入匹配度的分母，不会因为无人覆盖而被忽略
+        self.default_weight = math.log(1 + size) if size else 1.0
+
+    def _scan(self, text):
+        found = set()
+        for variant, terms in self._variants:
+            if variant in text:
+                found |= terms
+                # 换成分隔符而不是删除，避免前后文字拼出新的说法
+                text = text.replace(variant, "\0")
+        return found
+
+    def terms_in(self, text):
+        found = self._scan(text)
+        return [term for term in self.vocabulary if term in found]
+
+    def match(self, terms, k=3):
+        terms = list(dict.fromkeys(terms))
+        total = sum(self.weights.get(term, self.default_weight) for term in terms)
+        if not total:
+            return []
+        scores, matched = defaultdict(float), defaultdict(list)
+        for term in terms:
+            for i in self.postings.get(term, ()):
+                scores[i] += self.weights[term]
+                matched[i].append(term)
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))[:k]
+        return [SyndromeCandidate(self.documents[i], round(scores[i] / total, 3), tuple(matched[i])) for i in ranked]
@@ -0,0 +1,82 @@
+# ----------- 模型回复缓存 -----------
+# 基于 SQLite 的磁盘缓存：进程重启后仍然有效，多个会话/进程共享同一个文件。
+# 按最近访问时间做 LRU 淘汰，条目数超过上限时删除最久未用的；超过 TTL 的条目视为失效。
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+from contextlib import contextmanager
+
+from knowledge_base import TERM_SEPARATORS
+
+
+def normalize_query(query):
+    # 全角/半角统一、去空白；症状词顺序不影响含义（已选症状来自集合，顺序本就不固定），排序后再拼接
+    text = unicodedata.normalize("NFKC", query).strip().lower()
+    return "、".join(sorted(term for term in TERM_SEPARATORS.split(text) if term))
+
+
+def make_cache_key(mode, query, doc_ids, gender, age_category, model, temperature):
+    payload = json.dumps(
+        [mode, normalize_query(query), list(doc_ids), gender, age_category, model, temperature],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_entries=2000, ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)")
+
+    @contextmanager
+    def _connect(self):
+        # 每次操作单独建连接，Streamlit 的多个脚本线程可以安全并发访问
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if now - created > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
@@ -0,0 +1,268 @@
+# ----------- 性能指标 -----------
+# 热路径各阶段（检索、向量嵌入、上下文打包、提示词组装、模型调用、HTML 渲染、整页重跑）的耗时直方图与
+# 各阶段的提示词/生成 token 数，以 Prometheus 文本格式导出；一次问诊内各阶段的耗时另外汇总成一行 JSON 日志。
+# 默认关闭（TCM_METRICS=1 开启）：关闭时 timer() 返回共享的空上下文，不计时、不加锁，开销可以忽略。
+# 用法：TCM_METRICS=1 TCM_METRICS_PORT=9464 streamlit run app.py；curl localhost:9464/metrics
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("tcm.metrics")
+
+ENABLED = os.environ.get("TCM_METRICS", "0") != "0"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_NOOP = nullcontext()
+# 当前问诊的 trace（阶段名 → 累计秒数），asyncio.to_thread 会带上调用方的 context
+_current_trace = contextvars.ContextVar("tcm_trace", default=None)
+
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = flag
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # 标签值 → [各桶计数（不累计）, 总和, 次数]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                label_text = _label_text((*self.labelnames, "le"), (*labels, bound))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _label_text(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {round(total, 6)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        lines += [f"{self.name}{_label_text(self.labelnames, labels)} {value}" for labels, value in sorted(values.items())]
+        return lines
+
+
+class CallbackGauge:
+    """导出时才调用 collect()，返回 [(标签值元组, 数值), ...]；用于连接池、预取等已有的内部计数。"""
+
+    def __init__(self, name, help, labelnames, collect):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            samples = list(self.collect())
+        except Exception:
+            logger.exception("采集指标 %s 失败", self.name)
+            samples = []
+        lines += [
+            f"{self.name}{_label_text(self.labelnames, labels)} {value}" for labels, value in samples if value is not None
+        ]
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        # 同名指标只注册一次（Streamlit 重跑时重复注册直接返回已有的）
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames, collect):
+        return self._register(CallbackGauge(name, help, labelnames, collect))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("tcm_stage_seconds", "问诊热路径各阶段耗时（秒）", ("stage",))
+LLM_SECONDS = REGISTRY.histogram(
+    "tcm_llm_seconds", "模型调用耗时（秒），phase=ttft 为首字、total 为整次调用", ("mode", "model", "phase")
+)
+LLM_TOKENS = REGISTRY.histogram(
+    "tcm_llm_tokens", "每次模型调用的 token 数，kind=prompt/completion", ("mode", "model", "kind"), TOKEN_BUCKETS
+)
+LLM_CALLS = REGISTRY.counter("tcm_llm_calls_total", "模型调用次数（按结果）", ("mode", "model", "outcome"))
+LLM_FALLBACKS = REGISTRY.counter("tcm_llm_fallbacks_total", "因超时或出错换用备选模型的次数（model 为失败的模型）", ("mode", "model", "reason"))
+CACHE_LOOKUPS = REGISTRY.counter("tcm_cache_lookups_total", "缓存的查找次数，result=exact/semantic/miss（回复缓存）或 hit/miss（查询向量、检索结果）", ("cache", "result"))
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def timer(stage):
+    """计时上下文管理器：记入 tcm_stage_seconds，并累加到当前问诊的 trace。"""
+    return _Timer(stage) if ENABLED else _NOOP
+
+
+def record_stage(stage, seconds):
+    if not ENABLED:
+        return
+    STAGE_SECONDS.observe(seconds, stage)
+    stages = _current_trace.get()
+    if stages is not None:
+        stages[stage] = round(stages.get(stage, 0.0) + seconds, 6)
+
+
+def record_llm_call(mode, model, outcome, ttft=None, total=None, usage=None):
+    if not ENABLED:
+        return
+    mode = mode or "unknown"
+    LLM_CALLS.inc(mode, model, outcome)
+    if ttft is not None:
+        LLM_SECONDS.observe(ttft, mode, model, "ttft")
+    if total is not None:
+        LLM_SECONDS.observe(total, mode, model, "total")
+    for kind in ("prompt", "completion"):
+        if usage and usage.get(f"{kind}_tokens") is not None:
+            LLM_TOKENS.observe(usage[f"{kind}_tokens"], mode, model, kind)
+
+
+def record_fallback(mode, model, reason):
+    if ENABLED:
+        LLM_FALLBACKS.inc(mode, model, reason)
+
+
+def record_cache_lookup(cache, result):
+    if ENABLED:
+        CACHE_LOOKUPS.inc(cache, result)
+
+
+@contextmanager
+def trace(event, **fields):
+    """收集一次问诊内所有 timer() 的耗时，结束时输出一行 JSON 日志；fields 可在过程中继续补充。"""
+    if not ENABLED:
+        yield fields
+        return
+    stages = {}
+    token = _current_trace.set(stages)
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        _current_trace.reset(token)
+        fields["seconds"] = round(time.perf_counter() - start, 4)
+        logger.info(json.dumps({"event": event, **fields, "stages": stages}, ensure_ascii=False))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """在守护线程中提供 GET /metrics，返回 ThreadingHTTPServer。"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(json.dumps({"event": "metrics_server_started", "host": host, "port": port}))
+    return server
+
+
+class TimedEmbeddings:
+    """包装 LangChain 风格的嵌入对象，查询向量的计算计入 embed_query 阶段，其余属性原样转发。"""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def embed_query(self, text):
+        with timer("embed_query"):
+            return self.inner.embed_query(text)
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
@@ -0,0 +1,101 @@
+# ----------- 推测式预取 -----------
+# 辨证回复完成后，大多数用户会接着点"获取更多中医建议"。Prefetcher 在服务的后台事件循环上提前执行这次调用，
+# 结果按键（对应一条问诊记录）保存；用户点击时直接取走，仍在生成时等待剩余部分即可。
+# 会话清空或继续问诊后，该会话未取走的预取会被取消；每个进程同时在途的预取数有上限。
+import asyncio
+import json
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import CancelledError, TimeoutError
+from dataclasses import dataclass
+
+logger = logging.getLogger("tcm.prefetch")
+
+
+@dataclass
+class _Entry:
+    session_id: str
+    future: object
+
+
+class Prefetcher:
+    """计数含义：hit 点击时已生成完，hit_inflight 点击时仍在生成（等待后命中），miss 没有可用的预取，
+    skipped 因在途上限未启动，failed 预取出错，cancelled 生成途中被取消，wasted 生成完但未被使用。"""
+
+    def __init__(self, runner, max_inflight=4, max_entries=256):
+        self.runner = runner
+        self.max_inflight = max_inflight
+        self.max_entries = max_entries
+        self.counters = Counter()
+        self._entries = {}
+        self._inflight = 0
+        # 取消任务时完成回调会在当前线程同步执行并再次加锁，因此用可重入锁
+        self._lock = threading.RLock()
+
+    def start(self, key, session_id, make_coro):
+        """启动一个预取任务；达到在途上限时放弃并返回 False。"""
+        with self._lock:
+            if self._inflight >= self.max_inflight:
+                self.counters["skipped"] += 1
+                return False
+            self._inflight += 1
+            self.counters["started"] += 1
+            future = asyncio.run_coroutine_threadsafe(make_coro(), self.runner.loop)
+            self._entries[key] = _Entry(session_id, future)
+            # 会话直接关掉页面时预取不会被取走，超过条数上限后从最早的开始丢弃
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+        future.add_done_callback(self._finished)
+        return True
+
+    def _finished(self, future):
+        with self._lock:
+            self._inflight -= 1
+
+    def _discard(self, key):
+        # 调用方持有锁
+        entry = self._entries.pop(key)
+        if not entry.future.done():
+            entry.future.cancel()
+            self.counters["cancelled"] += 1
+        elif not entry.future.cancelled() and entry.future.exception() is None:
+            self.counters["wasted"] += 1
+
+    def take(self, key, timeout=None):
+        """取走预取结果；没有预取、预取失败或超时时返回 None，调用方按常规路径重新请求。"""
+        with self._lock:
+            entry = self._entries.pop(key, None) if key else None
+        if entry is None:
+            outcome, result = "miss", None
+        else:
+            outcome = "hit" if entry.future.done() else "hit_inflight"
+            try:
+                result = entry.future.result(timeout)
+            except TimeoutError:
+                entry.future.cancel()
+                outcome, result = "miss", None
+            except (CancelledError, Exception):
+                outcome, result = "failed", None
+        with self._lock:
+            self.counters[outcome] += 1
+        logger.info(json.dumps({"event": "prefetch", "outcome": outcome, **self.stats()}, ensure_ascii=False))
+        return result
+
+    def cancel_session(self, session_id):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry.session_id == session_id]:
+                self._discard(key)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            in_flight, pending = self._inflight, len(self._entries)
+        hits = counters.get("hit", 0) + counters.get("hit_inflight", 0)
+        lookups = hits + counters.get("miss", 0) + counters.get("failed", 0)
+        return {
+            **counters,
+            "in_flight": in_flight,
+            "pending": pending,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+        }
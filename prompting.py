@@ -0,0 +1,281 @@
+# ----------- 提示词组装 -----------
+# 三种问诊阶段的系统提示词模板，以及按 token 预算组装消息的 PromptAssembler：
+# 最近几轮对话原样保留，更早的轮次压缩成结构化的症状摘要（增量更新、随会话缓存），
+# 检索到的知识按相关度从高到低放入，超出预算的部分丢弃。
+# 放入之前先做上下文打包：同一疾病下的多个证型合并成一段，重复或近似重复的行只保留一次。
+import math
+import re
+import unicodedata
+from dataclasses import dataclass, field
+
+from knowledge_base import REMEDY_HEADING, KnowledgeDocument, char_ngrams
+
+MODE_INQUIRY = "inquiry"
+MODE_DIAGNOSIS = "diagnosis"
+MODE_MORE_ADVICE = "more_advice"
+
+INQUIRY_PROMPT = """{user_info}
+作为一名资深的中医专家，你的首要任务是进行严谨的"问诊"。用户刚刚提供了初步症状，你的唯一目标是提出2-3个关键的追问问题，以获取更全面的信息。请遵循以下规则：
+1.  禁止诊断：在这一轮对话中，绝对不允许给出任何形式的证型判断或养生建议。
+2.  聚焦关键问题: 你的问题必须围绕以下核心方面展开：
+    - 过往病史及身体异常指标: 例如："之前有没有严重病史或身体哪些指标不正常如血压血糖？"
+    - 症状持续时间: 例如："这种情况持续多久了？"
+    - 具体表现与诱因: 例如："咳嗽是干咳还是有痰？什么情况下会加重？"
+    - 伴随症状: 根据初步症状，推断并询问可能被忽略的其他相关症状。例如，如果用户说"头痛"，你可以问"是否伴有恶心、畏光或鼻塞？"
+3.  引用知识: 你可以参考以下检索到的资料来构思更专业的问题。
+    --- 检索到的资料 ---
+    {related_knowledge}
+    --- 资料结束 ---
+4.  结尾引导: 在提出问题后，以一句话引导用户回答，例如："请您补充这些信息，以便我能更准确地为您分析。"
+你的回答必须直接以问题开始，简洁明了。"""
+
+MORE_ADVICE_PROMPT = """{user_info}
+作为一名资深的中医专家，请严格依据以下从本地知识库检索到的资料，为用户提供专业的调理建议。
+--- 检索到的资料 ---
+{related_knowledge}
+--- 资料结束 ---
+要求：
+1. 内容来源: 你的回答必须完全基于上述"检索到的资料"。
+2. 输出结构: 分"一、膏方建议"、"二、茶饮建议"、"三、药膳建议"、"四、理疗建议"四个部分清晰作答。
+3. 专业性: 语言专业、严谨，给出建议时可简要说明其适应证。
+4. 性别针对性: 根据用户性别（{gender}）结合中医阴阳理论，给出更加针对性的建议。例如，男性属阳，女性属阴，调理方法有所不同。
+5. 年龄特异性: 根据用户年龄段（{age_category}）结合中医盛衰理论，考虑不同年龄段的生理特点。例如，壮年气血充沛，老年气血渐衰，调理方法应有所区别。
+6. 补充原则: 如果资料不全，无法覆盖所有四个方面，请仅就资料中有的部分作答，并明确指出"关于XX方面的建议，资料中暂未提及"。绝不允许自行编撰。
+7. 输出时禁止缩进和多余空格，分层结构请用正常的数字序号和小黑点（•），或直接输出HTML ul/li列表结构，禁止markdown缩进。"""
+
+DIAGNOSIS_PROMPT = """{user_info}
+作为一名资深的中医专家，你的任务是基于用户描述的症状及补充信息，结合本地知识库的资料，进行严谨的辨证分析。
+--- 检索到的资料 ---
+{related_knowledge}
+--- 资料结束 ---
+请遵循以下规则进行回复：
+1. 辨证分析:
+   - 优先引用: 必须优先结合并引用"检索到的资料"进行分析。
+   - 补充诊断: 若资料不足以支撑诊断，你可以结合自身庞大的中医知识库进行补充和推断，但需明确告知用户"根据资料并结合我的知识判断..."。
+   - 性别相关分析: 结合中医阴阳理论，考虑用户性别（{gender}）在辨证中的影响。
+   - 年龄相关分析: 结合中医盛衰理论，考虑用户年龄段（{age_category}）在辨证中的影响。
+2. 养生建议:
+   - 给出3-5条具体、可操作的非药物建议（如饮食、起居、运动、情绪调理）。
+   - 针对性别给出更具针对性的建议，例如：男性阳气更盛，女性阴血更丰等特点。
+   - 针对年龄段给出更精准的建议，例如：青壮年气血旺盛，中老年气血渐衰等特点。
+3. 格式要求:
+   - 回复必须分为"一、辨证分析"和"二、养生建议"两部分。
+   - 语言专业、沉稳、易于理解。"""
+
+PROMPT_TEMPLATES = {
+    MODE_INQUIRY: INQUIRY_PROMPT,
+    MODE_DIAGNOSIS: DIAGNOSIS_PROMPT,
+    MODE_MORE_ADVICE: MORE_ADVICE_PROMPT,
+}
+
+_CJK_CHARS = re.compile(r"[一-鿿　-〿＀-￯]")
+# 摘要中保留的补充描述条数与单条长度上限，保证摘要本身不随对话增长
+SUMMARY_MAX_NOTES = 6
+SUMMARY_NOTE_CHARS = 80
+SUMMARY_MAX_SYMPTOMS = 30
+# 两行的字符 n-gram Jaccard 系数达到该值即视为近似重复
+NEAR_DUPLICATE_THRESHOLD = 0.8
+_LINE_NOISE = re.compile(r"[\s\-■•，,。.；;：:、（）()]+")
+
+
+def prompt_mode(history, more_advice=False):
+    if not history:
+        return MODE_INQUIRY
+    return MODE_MORE_ADVICE if more_advice else MODE_DIAGNOSIS
+
+
+def estimate_tokens(text):
+    # 本地没有 GLM 的分词器，按偏保守的经验值估算：每个中文字符约 1 token，其余约 4 个字符 1 token
+    if not text:
+        return 0
+    cjk = len(_CJK_CHARS.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class _LineDeduper:
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.seen = set()
+        self.gram_sets = []
+
+    def is_duplicate(self, line):
+        key = _LINE_NOISE.sub("", unicodedata.normalize("NFKC", line))
+        if not key:
+            return False
+        if key in self.seen:
+            return True
+        grams = set(char_ngrams(key))
+        for other in self.gram_sets:
+            if len(grams & other) >= self.threshold * len(grams | other):
+                return True
+        self.seen.add(key)
+        self.gram_sets.append(grams)
+        return False
+
+
+def pack_context(documents):
+    """把检索结果打包成更紧凑的资料段，返回 (documents, stats)。
+
+    同一疾病的证型合并为一段（疾病名只出现一次，证型按源文件的"【证型】"格式列出），
+    段落顺序取该疾病最相关的一条记录的位置；已出现过的症状/调理行及其近似重复行被丢弃。
+    """
+    groups, seen_ids = {}, set()
+    for doc in documents:
+        # 同一条记录被多路检索重复召回时只保留第一次
+        record_id = doc.metadata.get("record_id") or doc.page_content
+        if record_id in seen_ids:
+            continue
+        seen_ids.add(record_id)
+        groups.setdefault(doc.metadata.get("disease") or doc.page_content.split("\n", 1)[0], []).append(doc)
+
+    deduper = _LineDeduper()
+    packed, dropped_lines = [], 0
+    for disease, docs in groups.items():
+        lines = [] if len(docs) == 1 else [disease]
+        for doc in docs:
+            header, *body = doc.page_content.split("\n")
+            syndrome = doc.metadata.get("syndrome")
+            if len(docs) > 1 and syndrome:
+                header = f"【{syndrome}】"
+            kept = []
+            for line in body:
+                if line != REMEDY_HEADING and deduper.is_duplicate(line):
+                    dropped_lines += 1
+                else:
+                    kept.append(line)
+            if kept and kept[-1] == REMEDY_HEADING:
+                kept.pop()
+            if len(docs) > 1 and not syndrome:
+                lines.extend(kept)
+            else:
+                lines.extend([header, *kept])
+        metadata = {"disease": disease, "record_ids": [doc.metadata.get("record_id") for doc in docs]}
+        packed.append(KnowledgeDocument("\n".join(lines), metadata))
+
+    before = sum(estimate_tokens(doc.page_content) for doc in documents)
+    after = sum(estimate_tokens(doc.page_content) for doc in packed)
+    stats = {
+        "records": len(documents),
+        "duplicate_records": len(documents) - len(seen_ids),
+        "sections": len(packed),
+        "dropped_lines": dropped_lines,
+        "tokens_before": before,
+        "tokens_saved": before - after,
+    }
+    return packed, stats
+
+
+def _append_unique(items, values, limit):
+    for value in values:
+        if value not in items:
+            items.append(value)
+    del items[:-limit]
+
+
+@dataclass
+class HistorySummary:
+    """较早轮次对话的结构化摘要，只对新移出"最近轮次"窗口的消息做增量合并。"""
+
+    compacted_upto: int = 0
+    anchor: str = ""
+    symptoms: list = field(default_factory=list)
+    notes: list = field(default_factory=list)
+    syndromes: list = field(default_factory=list)
+
+    def reset(self):
+        self.compacted_upto = 0
+        self.anchor = ""
+        self.symptoms, self.notes, self.syndromes = [], [], []
+
+    def matches(self, history):
+        # 历史被清空或替换（新一次问诊）后摘要失效
+        return self.compacted_upto <= len(history) and (
+            not self.compacted_upto or history[self.compacted_upto - 1]["content"] == self.anchor
+        )
+
+    def update(self, history, upto, symptom_terms=(), syndrome_names=()):
+        if not self.matches(history) or upto < self.compacted_upto:
+            self.reset()
+        for msg in history[self.compacted_upto:upto]:
+            content = msg["content"]
+            if msg["role"] == "user":
+                _append_unique(self.symptoms, [term for term in symptom_terms if term in content], SUMMARY_MAX_SYMPTOMS)
+                # 已选症状与补充描述以"；"连接，补充描述部分原样（截断后）保留
+                note = content.split("；", 1)[-1].strip()
+                if note and not all(term in symptom_terms for term in note.split("、")):
+                    _append_unique(self.notes, [note[:SUMMARY_NOTE_CHARS]], SUMMARY_MAX_NOTES)
+            else:
+                _append_unique(self.syndromes, [name for name in syndrome_names if name in content], SUMMARY_MAX_SYMPTOMS)
+        if upto > self.compacted_upto:
+            self.compacted_upto = upto
+            self.anchor = history[upto - 1]["content"]
+        return self
+
+    def render(self):
+        if not self.compacted_upto:
+            return ""
+        lines = [f"【既往问诊摘要】（较早的 {self.compacted_upto // 2} 轮对话已压缩）"]
+        if self.symptoms:
+            lines.append(f"- 已述症状：{'、'.join(self.symptoms)}")
+        if self.notes:
+            lines.append(f"- 补充信息：{'；'.join(self.notes)}")
+        if self.syndromes:
+            lines.append(f"- 既往辨证：{'、'.join(self.syndromes)}")
+        return "\n".join(lines)
+
+
+class PromptAssembler:
+    def __init__(self, token_budget=4000, recent_turns=2, symptom_terms=(), syndrome_names=()):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.symptom_terms = tuple(symptom_terms)
+        # 较长的证型名优先匹配，避免"气虚证"抢先命中"脾气虚证"之类的子串
+        self.syndrome_names = tuple(sorted(set(syndrome_names), key=len, reverse=True))
+
+    def assemble(self, mode, user_info, gender, age_category, documents, history, user_query, summary=None):
+        """返回 (messages, stats)；stats 记录各部分的估算 token 数与被裁掉的资料条数。"""
+        summary = summary if summary is not None else HistorySummary()
+        template = PROMPT_TEMPLATES[mode]
+        fields = {"user_info": user_info, "gender": gender, "age_category": age_category}
+        base_tokens = estimate_tokens(template.format(related_knowledge="", **fields))
+        query_tokens = estimate_tokens(user_query)
+
+        recent_start = max(0, len(history) - 2 * self.recent_turns)
+        if summary.matches(history):
+            # 已压缩过的轮次不再回到原文，保证摘要只做增量合并
+            recent_start = max(recent_start, summary.compacted_upto)
+        while True:
+            summary.update(history, recent_start, self.symptom_terms, self.syndrome_names)
+            summary_text = summary.render()
+            history_tokens = sum(estimate_tokens(msg["content"]) for msg in history[recent_start:])
+            remaining = self.token_budget - base_tokens - query_tokens - history_tokens - estimate_tokens(summary_text)
+            # 最近轮次本身就超出预算时，继续把最早的一轮并入摘要，至少保留最后一轮
+            if remaining >= 0 or len(history) - recent_start <= 2:
+                break
+            recent_start += 2
+
+        kept, knowledge_tokens = [], 0
+        for doc in documents:
+            cost = estimate_tokens(doc.page_content)
+            if cost <= remaining - knowledge_tokens:
+                kept.append(doc.page_content)
+                knowledge_tokens += cost
+
+        system_prompt = template.format(related_knowledge="\n".join(kept), **fields)
+        if summary_text:
+            system_prompt = f"{system_prompt}\n{summary_text}"
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend({"role": msg["role"], "content": msg["content"]} for msg in history[recent_start:])
+        messages.append({"role": "user", "content": user_query})
+        stats = {
+            "mode": mode,
+            "system": base_tokens,
+            "knowledge": knowledge_tokens,
+            "summary": estimate_tokens(summary_text),
+            "history": history_tokens,
+            "query": query_tokens,
+            "dropped_docs": len(documents) - len(kept),
+            "compacted_messages": recent_start,
+        }
+        stats["total"] = sum(stats[key] for key in ("system", "knowledge", "summary", "history", "query"))
+        return messages, stats
@@ -0,0 +1,133 @@
+# ----------- 首轮追问的语义缓存 -----------
+# 首轮问诊（没有对话历史）只让模型提两三个追问，常见的症状组合（如"头痛、失眠"）在性别、年龄段相同时
+# 得到的追问几乎一样。这里按 (性别, 年龄段, 模型, 温度) 分区缓存首轮回复：
+# 先按规范化后的查询（与 llm_cache.normalize_query 相同，症状词顺序无关）精确匹配，
+# 再用查询向量与同分区已缓存查询的余弦相似度匹配，超过阈值即直接返回，不调用模型。
+# 条目数有上限，按最近使用淘汰；向量存成一个预分配的矩阵，一次矩阵乘完成全部相似度计算。
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+import metrics
+from knowledge_base import SYMPTOM_KEYWORDS, picker_queries
+from llm_cache import normalize_query
+
+# 各年龄段预热时使用的代表年龄（与 consultation_service.get_age_category 的分段一致）
+WARMUP_AGES = (10, 25, 45, 60, 75)
+WARMUP_GENDERS = ("男", "女")
+
+
+@dataclass
+class CacheProbe:
+    """一次查找的上下文，未命中时原样交给 store()，查询向量只计算一次。"""
+    partition: tuple
+    key: str
+    vector: object = None
+    # exact / semantic / miss
+    result: str = "miss"
+    similarity: float = None
+
+
+class SemanticCache:
+    def __init__(self, max_entries=1000, threshold=0.95):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        # 槽位 → (分区, 规范化查询, 回复)，按最近使用排序
+        self._entries = OrderedDict()
+        # (分区, 规范化查询) → 槽位
+        self._exact = {}
+        self._partitions = {}
+        self._vectors = None
+        # 每个槽位所属分区的编号，-1 表示空槽或没有向量（只参与精确匹配）
+        self._codes = np.full(max_entries, -1, dtype=np.int32)
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+        self.stats = {"exact": 0, "semantic": 0, "miss": 0, "stored": 0, "evicted": 0}
+
+    def _code(self, partition):
+        return self._partitions.setdefault(partition, len(self._partitions))
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def lookup(self, partition, query, embed=None):
+        """返回 (缓存的回复或 None, CacheProbe)；embed(query) 返回查询向量，为空或返回 None 时只做精确匹配。"""
+        probe = CacheProbe(partition, normalize_query(query))
+        with self._lock:
+            slot = self._exact.get((partition, probe.key))
+            if slot is not None:
+                return self._hit(probe, slot, "exact", 1.0)
+        vector = embed(query) if embed is not None else None
+        probe.vector = self._normalize(vector) if vector is not None else None
+        with self._lock:
+            code = self._partitions.get(partition)
+            if probe.vector is not None and code is not None and self._vectors is not None:
+                if len(probe.vector) == self._vectors.shape[1]:
+                    scores = self._vectors @ probe.vector
+                    scores[self._codes != code] = -np.inf
+                    slot = int(np.argmax(scores))
+                    if scores[slot] >= self.threshold:
+                        return self._hit(probe, slot, "semantic", float(scores[slot]))
+            self.stats["miss"] += 1
+        metrics.record_cache_lookup("inquiry", "miss")
+        return None, probe
+
+    def _hit(self, probe, slot, result, similarity):
+        # 调用方持有锁
+        self._entries.move_to_end(slot)
+        probe.result, probe.similarity = result, round(similarity, 4)
+        self.stats[result] += 1
+        metrics.record_cache_lookup("inquiry", result)
+        return self._entries[slot][2], probe
+
+    def store(self, probe, response):
+        with self._lock:
+            slot = self._exact.get((probe.partition, probe.key))
+            if slot is None:
+                if not self._free:
+                    slot, (partition, key, _) = self._entries.popitem(last=False)
+                    del self._exact[(partition, key)]
+                    self._codes[slot] = -1
+                    self.stats["evicted"] += 1
+                else:
+                    slot = self._free.pop()
+                self._exact[(probe.partition, probe.key)] = slot
+            if probe.vector is not None:
+                if self._vectors is None:
+                    self._vectors = np.zeros((self.max_entries, len(probe.vector)), dtype=np.float32)
+                if len(probe.vector) == self._vectors.shape[1]:
+                    self._vectors[slot] = probe.vector
+                    self._codes[slot] = self._code(probe.partition)
+            self._entries[slot] = (probe.partition, probe.key, response)
+            self._entries.move_to_end(slot)
+            self.stats["stored"] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def status(self):
+        with self._lock:
+            hits = self.stats["exact"] + self.stats["semantic"]
+            lookups = hits + self.stats["miss"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hit_rate": round(hits / lookups, 4) if lookups else None,
+            }
+
+
+def warmup_queries(limit=None, keywords=SYMPTOM_KEYWORDS):
+    """预热用的症状组合：先是每个选择器症状，再是同一部位内的两两组合，按选择器中的顺序排列。"""
+    queries = picker_queries(keywords)
+    return queries[:limit] if limit is not None else queries
+
+
+def warmup_profiles(genders=WARMUP_GENDERS, ages=WARMUP_AGES):
+    return [(gender, age) for gender in genders for age in ages]
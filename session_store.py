@@ -0,0 +1,406 @@
+# ----------- 会话存储 -----------
+# 问诊记录、已选症状、个人信息和历史摘要按会话 ID 存在进程外（默认 SQLite 文件），进程重启后可恢复，
+# 多个副本指向同一个文件时无需粘性会话。消息用短键 JSON 序列化，较长的再做 zlib 压缩；渲染用的 HTML 不落盘。
+# 超过空闲 TTL 的会话被淘汰，会话数超过上限时删除最久未访问的；进程内实现另按编码后的字节数设内存上限。
+# 进程内只保留每个会话最近的一段消息（SessionHistory），更早的按需分页读取，内存占用不随问诊轮数增长。
+# 会话 ID 由服务端生成，带 HMAC 签名交给浏览器保存（issue_session_token / verify_session_token），
+# 伪造或篡改的令牌验证不通过，调用方应为其新开会话。
+import copy
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Sequence
+from contextlib import contextmanager
+
+# 消息字段 → 存储用的短键；html、more_advice_html 等可由内容重新计算的字段不保存
+MESSAGE_FIELDS = {
+    "role": "r",
+    "content": "c",
+    "timestamp": "t",
+    "timings": "l",
+    "more_advice": "m",
+    "prefetch_key": "k",
+}
+_FIELD_NAMES = {short: name for name, short in MESSAGE_FIELDS.items()}
+# 序列化后超过该字节数才压缩，短消息压缩反而更大
+COMPRESS_MIN_BYTES = 256
+# 两次淘汰扫描的最小间隔（秒）
+EVICT_INTERVAL = 60
+# 进程内存储的默认内存上限（字节，按编码后的个人信息与消息计）
+MEMORY_MAX_BYTES = 64 * 1024 * 1024
+_SESSION_ID_LENGTH = 32
+
+
+def load_session_secret(path):
+    """读取签名密钥文件，不存在时生成；多个副本指向同一文件即可互认会话令牌。"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read()
+    secret = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+
+def new_session_id():
+    return secrets.token_hex(_SESSION_ID_LENGTH // 2)
+
+
+def _sign(session_id, secret):
+    return hmac.new(secret, session_id.encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def issue_session_token(session_id, secret):
+    return f"{session_id}.{_sign(session_id, secret)}"
+
+
+def verify_session_token(token, secret):
+    """返回令牌中的会话 ID；格式不对或签名不符时返回 None。"""
+    session_id, _, signature = (token or "").partition(".")
+    if len(session_id) != _SESSION_ID_LENGTH or not session_id.isalnum() or not session_id.isascii():
+        return None
+    return session_id if hmac.compare_digest(signature, _sign(session_id, secret)) else None
+
+
+def _pack(obj):
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+
+def _unpack(blob):
+    blob = bytes(blob)
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return json.loads(raw)
+
+
+def encode_message(message):
+    return _pack({short: message[name] for name, short in MESSAGE_FIELDS.items() if message.get(name) is not None})
+
+
+def decode_message(blob):
+    return {_FIELD_NAMES[short]: value for short, value in _unpack(blob).items()}
+
+
+class SQLiteSessionStore:
+    def __init__(self, path, ttl_seconds=3 * 24 * 3600, max_sessions=10000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._next_eviction = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, profile BLOB, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_accessed ON sessions(accessed)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "session_id TEXT NOT NULL, seq INTEGER NOT NULL, body BLOB NOT NULL, "
+                "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # 与 ResponseCache 相同：每次操作单独建连接，脚本线程与后台线程可以并发访问
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _touch(self, conn, session_id, now):
+        conn.execute(
+            "INSERT INTO sessions (session_id, profile, accessed) VALUES (?, NULL, ?) "
+            "ON CONFLICT(session_id) DO UPDATE SET accessed = excluded.accessed",
+            (session_id, now),
+        )
+        if now >= self._next_eviction:
+            self._next_eviction = now + EVICT_INTERVAL
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        expired = conn.execute(
+            "SELECT session_id FROM sessions WHERE accessed < ? UNION "
+            "SELECT session_id FROM (SELECT session_id FROM sessions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (now - self.ttl_seconds, self.max_sessions),
+        ).fetchall()
+        conn.executemany("DELETE FROM messages WHERE session_id = ?", expired)
+        conn.executemany("DELETE FROM sessions WHERE session_id = ?", expired)
+
+    def load_profile(self, session_id):
+        """返回会话的个人信息字典；会话不存在或已过期时返回 None。"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT profile, accessed FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                return None
+            conn.execute("UPDATE sessions SET accessed = ? WHERE session_id = ?", (now, session_id))
+            return _unpack(row[0]) if row[0] is not None else {}
+
+    def save_profile(self, session_id, profile):
+        now = time.time()
+        with self._connect() as conn:
+            self._touch(conn, session_id, now)
+            conn.execute("UPDATE sessions SET profile = ? WHERE session_id = ?", (_pack(profile), session_id))
+
+    def count_messages(self, session_id):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def load_messages(self, session_id, start, stop):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT body FROM messages WHERE session_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (session_id, start, stop),
+            ).fetchall()
+        return [decode_message(body) for body, in rows]
+
+    def append_message(self, session_id, message):
+        return self.append_messages(session_id, [message])
+
+    def append_messages(self, session_id, messages):
+        """在同一事务内追加若干条连续的消息，返回第一条分配到的序号。
+        序号在写事务内按 MAX(seq)+1 分配，多个标签页或副本同时追加也不会互相覆盖或插到同一轮问答中间。"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._touch(conn, session_id, now)
+            first = conn.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, body) VALUES (?, ?, ?)",
+                [(session_id, first + i, encode_message(message)) for i, message in enumerate(messages)],
+            )
+        return first
+
+    def save_message(self, session_id, seq, message):
+        """改写已有的一条消息。"""
+        now = time.time()
+        with self._connect() as conn:
+            self._touch(conn, session_id, now)
+            conn.execute(
+                "UPDATE messages SET body = ? WHERE session_id = ? AND seq = ?", (encode_message(message), session_id, seq)
+            )
+
+    def clear_messages(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class MemorySessionStore:
+    """进程内实现，接口与 SQLiteSessionStore 相同；单进程开发调试用，重启后数据丢失。
+
+    除会话数上限外，所有会话编码后的总字节数超过 max_bytes 时也按最久未访问淘汰（至少保留当前会话）。
+    """
+
+    def __init__(self, ttl_seconds=3 * 24 * 3600, max_sessions=10000, max_bytes=MEMORY_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        # session_id → [profile, {seq: 编码后的消息}, accessed, 字节数]，按访问时间排序
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+
+    def _get(self, session_id, now, create=False):
+        # 调用方持有锁
+        entry = self._sessions.get(session_id)
+        if entry is not None and now - entry[2] > self.ttl_seconds:
+            self._drop(session_id)
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = self._sessions[session_id] = [None, {}, now, 0]
+        entry[2] = now
+        self._sessions.move_to_end(session_id)
+        self._evict()
+        return entry
+
+    def _drop(self, session_id):
+        self._bytes -= self._sessions.pop(session_id)[3]
+
+    def _resize(self, entry, delta):
+        # 调用方持有锁；写入后按新的总字节数淘汰
+        entry[3] += delta
+        self._bytes += delta
+        self._evict()
+
+    def _evict(self):
+        while len(self._sessions) > self.max_sessions or (self._bytes > self.max_bytes and len(self._sessions) > 1):
+            self._drop(next(iter(self._sessions)))
+
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+    def load_profile(self, session_id):
+        with self._lock:
+            entry = self._get(session_id, time.time())
+            if entry is None:
+                return None
+            return _unpack(entry[0]) if entry[0] is not None else {}
+
+    def save_profile(self, session_id, profile):
+        with self._lock:
+            entry = self._get(session_id, time.time(), create=True)
+            blob = _pack(profile)
+            old = len(entry[0]) if entry[0] is not None else 0
+            entry[0] = blob
+            self._resize(entry, len(blob) - old)
+
+    def count_messages(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return len(entry[1]) if entry is not None else 0
+
+    def load_messages(self, session_id, start, stop):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            messages = entry[1] if entry is not None else {}
+            return [decode_message(messages[seq]) for seq in range(start, stop) if seq in messages]
+
+    def append_message(self, session_id, message):
+        return self.append_messages(session_id, [message])
+
+    def append_messages(self, session_id, messages):
+        blobs = [encode_message(message) for message in messages]
+        with self._lock:
+            entry = self._get(session_id, time.time(), create=True)
+            first = len(entry[1])
+            for i, blob in enumerate(blobs):
+                entry[1][first + i] = blob
+            self._resize(entry, sum(map(len, blobs)))
+            return first
+
+    def save_message(self, session_id, seq, message):
+        blob = encode_message(message)
+        with self._lock:
+            entry = self._get(session_id, time.time(), create=True)
+            if seq in entry[1]:
+                old = len(entry[1][seq])
+                entry[1][seq] = blob
+                self._resize(entry, len(blob) - old)
+
+    def clear_messages(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                freed = sum(map(len, entry[1].values()))
+                entry[1].clear()
+                self._resize(entry, -freed)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+def open_session_store(location, ttl_seconds=3 * 24 * 3600, max_sessions=10000, max_bytes=MEMORY_MAX_BYTES):
+    """location 为 SQLite 文件路径；"memory" 表示只保存在当前进程内，此时 max_bytes 限制总内存占用。"""
+    if location == "memory":
+        return MemorySessionStore(ttl_seconds, max_sessions, max_bytes)
+    return SQLiteSessionStore(location, ttl_seconds, max_sessions)
+
+
+class SessionHistory(Sequence):
+    """一个会话的问诊记录，按全局下标访问（与普通列表一致）。
+
+    内存中只保留最近 window 条消息，append / extend 后超出的部分直接丢弃（已写入存储），
+    访问更早的下标时从存储分页读取，读到的消息不常驻内存；修改了早先取出的消息后需调用 save 写回。
+    """
+
+    def __init__(self, store, session_id, window=20):
+        self.store = store
+        self.session_id = session_id
+        self.window = window
+        self._reload(store.count_messages(session_id))
+
+    def _reload(self, length):
+        self._length = length
+        self._offset = max(0, length - self.window)
+        self._recent = self.store.load_messages(self.session_id, self._offset, length)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return self._range(0, self._length)[index]
+            return self._range(start, stop)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("history index out of range")
+        return self._range(index, index + 1)[0]
+
+    def __iter__(self):
+        return iter(self._range(0, self._length))
+
+    def _range(self, start, stop):
+        if stop <= start:
+            return []
+        older = self.store.load_messages(self.session_id, start, min(stop, self._offset)) if start < self._offset else []
+        return older + self._recent[max(start, self._offset) - self._offset:stop - self._offset]
+
+    def append(self, message):
+        self.extend([message])
+
+    def extend(self, messages):
+        """一次追加若干条消息；一轮问答的用户消息与回复应一起追加，保证在存储中相邻。"""
+        messages = list(messages)
+        if not messages:
+            return
+        first = self.store.append_messages(self.session_id, messages)
+        if first != self._length:
+            # 同一会话的其他标签页或副本在此期间也追加了消息：重新读取最近的窗口
+            self._reload(first + len(messages))
+            return
+        self._recent.extend(messages)
+        self._length += len(messages)
+        overflow = len(self._recent) - self.window
+        if overflow > 0:
+            del self._recent[:overflow]
+            self._offset += overflow
+
+    def save(self, index, message):
+        if index < 0:
+            index += self._length
+        self.store.save_message(self.session_id, index, message)
+        if index >= self._offset:
+            self._recent[index - self._offset] = message
+
+    def clear(self):
+        self.store.clear_messages(self.session_id)
+        self._recent = []
+        self._length = self._offset = 0
+
+    def snapshot(self):
+        """交给后台任务的只读副本：窗口内的消息只保留 role/content，更早的仍按需从存储读取。"""
+        clone = copy.copy(self)
+        clone._recent = [{"role": msg["role"], "content": msg["content"]} for msg in self._recent]
+        return clone
@@ -0,0 +1,103 @@
+# ----------- 启动加速：后台预热与启动耗时统计 -----------
+# Streamlit 每次重跑都会重新执行 app.py，但导入过的模块只执行一次，
+# 因此进程级的单例（后台加载任务、启动报告）放在这里。
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# 近似的进程启动时刻：首次执行 app.py 时导入本模块
+PROCESS_START = time.perf_counter()
+
+logger = logging.getLogger("tcm.startup")
+_tcm_logger = logging.getLogger("tcm")
+if not _tcm_logger.handlers:
+    _tcm_logger.addHandler(logging.StreamHandler())
+    _tcm_logger.setLevel(logging.INFO)
+
+
+class StartupReport:
+    """记录各启动阶段耗时（秒），同名阶段只记录第一次。"""
+
+    def __init__(self):
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name in self._phases:
+                return False
+            self._phases[name] = round(seconds, 4)
+        logger.info(json.dumps({"event": "startup_phase", "phase": name, "seconds": round(seconds, 4)}, ensure_ascii=False))
+        return True
+
+    def mark(self, name):
+        # 以进程启动为零点的时间戳，例如 first_paint
+        return self.record(name, time.perf_counter() - PROCESS_START)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._phases)
+
+
+class BackgroundLoader:
+    """在守护线程中执行一次加载函数，调用方随时查询是否就绪而不阻塞页面渲染。"""
+
+    def __init__(self, name, load, report):
+        self.name = name
+        self._load = load
+        self._report = report
+        self._done = threading.Event()
+        self._thread = None
+        self.value = None
+        self.error = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"warmup-{self.name}", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            with self._report.phase(f"warmup:{self.name}"):
+                self.value = self._load()
+        except Exception as e:
+            self.error = e
+            logger.exception("后台预热 %s 失败", self.name)
+        finally:
+            self._done.set()
+
+    @property
+    def ready(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """等待加载完成并返回结果，加载失败时抛出原异常。"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+report = StartupReport()
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def background(name, load):
+    """按名字获取（必要时创建并启动）进程级的后台加载任务，重复调用不会重复加载。"""
+    with _loaders_lock:
+        loader = _loaders.get(name)
+        if loader is None:
+            loader = _loaders[name] = BackgroundLoader(name, load, report).start()
+    return loader
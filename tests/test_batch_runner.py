@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+from batch_runner import BatchRunner, load_checkpoint, record_key
+
+
+class FakeService:
+    """按查询原样回复；fail 中的查询抛出异常。"""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.queries = []
+        self.upstream_calls = 0
+
+    async def consult(self, query, history=(), gender="未知", age="未知", more_advice=False, summary=None):
+        self.queries.append(query)
+        await asyncio.sleep(0)
+        if query in self.fail:
+            raise RuntimeError(f"{query} 失败")
+        self.upstream_calls += 1
+        return {
+            "content": f"回复：{query}",
+            "record_ids": [],
+            "prompt": {"mode": "diagnosis", "total": 10},
+            "usage": {},
+            "seconds": 0.0,
+        }
+
+    def status(self):
+        return {}
+
+
+def record(query, gender="女", age=30):
+    return {"gender": gender, "age": age, "turns": [{"query": query}, {"query": "详细说说", "more_advice": True}]}
+
+
+def run_batch(service, output, records, workers=2):
+    return asyncio.run(BatchRunner(service, str(output), workers).run(records))
+
+
+def read_rows(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_identical_records_are_consulted_once(tmp_path):
+    output = tmp_path / "out.jsonl"
+    service = FakeService()
+    records = [("a", record("头痛")), ("b", record(" 头痛 ")), ("c", record("失眠"))]
+    report = run_batch(service, output, records)
+    assert sorted(service.queries) == sorted(["头痛", "详细说说", "失眠", "详细说说"])
+    assert (report["succeeded"], report["deduplicated"], report["llm_calls"]) == (3, 1, 4)
+    rows = {row["id"]: row for row in read_rows(output)}
+    assert rows["a"]["turns"] == rows["b"]["turns"]
+    assert rows["a"]["key"] == rows["b"]["key"] == record_key(record("头痛"))
+
+
+def test_rerun_skips_successes_and_retries_failures(tmp_path):
+    output = tmp_path / "out.jsonl"
+    records = [("a", record("头痛")), ("b", record("失眠"))]
+    report = run_batch(FakeService(fail={"失眠"}), output, records)
+    assert (report["succeeded"], report["failed"]) == (1, 1)
+    done_ids, _ = load_checkpoint(str(output))
+    assert set(done_ids) == {"a"}
+
+    service = FakeService()
+    report = run_batch(service, output, records)
+    assert (report["resumed"], report["succeeded"], report["failed"]) == (1, 1, 0)
+    assert service.queries == ["失眠", "详细说说"]
+    done_ids, _ = load_checkpoint(str(output))
+    assert set(done_ids) == {"a", "b"}
+
+
+def test_rerun_reuses_results_of_identical_records(tmp_path):
+    output = tmp_path / "out.jsonl"
+    run_batch(FakeService(), output, [("a", record("头痛"))])
+    service = FakeService()
+    report = run_batch(service, output, [("a", record("头痛")), ("new", record("头痛"))])
+    assert service.queries == []
+    assert (report["resumed"], report["succeeded"], report["llm_calls"]) == (1, 1, 0)
+
+
+def test_half_written_line_is_ignored(tmp_path):
+    output = tmp_path / "out.jsonl"
+    run_batch(FakeService(), output, [("a", record("头痛"))])
+    with open(output, "a", encoding="utf-8") as f:
+        f.write('{"id": "b", "key": ')
+    done_ids, done_keys = load_checkpoint(str(output))
+    assert set(done_ids) == {"a"} and len(done_keys) == 1
+    # 续跑写入的结果另起一行，下次仍能读到
+    run_batch(FakeService(), output, [("a", record("头痛")), ("b", record("失眠"))])
+    assert set(load_checkpoint(str(output))[0]) == {"a", "b"}
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import constitution
+from constitution import CONSTITUTION_TYPES, QUESTION_IDS, QUESTIONS, TYPE_ITEMS, judge, score
+
+
+def reference_scores(answers):
+    """逐条按标准公式计算：转化分 = (原始分 - 条目数) / (条目数 × 4) × 100，反向条目计 6 - 答案。"""
+    result = {}
+    for name, items in TYPE_ITEMS.items():
+        values = [
+            6 - answers[item[1:]] if item.startswith("-") else answers[item]
+            for item in items
+            if answers.get(item.lstrip("-")) is not None
+        ]
+        result[name] = (sum(values) - len(values)) / (len(values) * 4) * 100
+    return result
+
+
+def answer_row(answers):
+    return [answers.get(qid, np.nan) for qid in QUESTION_IDS]
+
+
+def test_scores_follow_the_transformed_score_formula():
+    answers = constitution.random_answers(50, seed=7)
+    scores = score(answers)
+    for row, expected in zip(answers, scores):
+        given = {qid: float(value) for qid, value in zip(QUESTION_IDS, row) if not np.isnan(value)}
+        assert np.allclose(expected, [reference_scores(given)[name] for name in CONSTITUTION_TYPES], atol=1e-4)
+
+
+def test_reverse_scored_items_count_against_peaceful():
+    # 平和质的反向条目全部答"没有"、正向条目全部答"总是"时得满分，反过来得 0 分
+    best = {item.lstrip("-"): 1 if item.startswith("-") else 5 for item in TYPE_ITEMS["平和质"]}
+    worst = {qid: 6 - value for qid, value in best.items()}
+    assert judge(best).scores["平和质"] == 100.0
+    assert judge(worst).scores["平和质"] == 0.0
+    # q4 同时是阳虚质的正向条目
+    assert judge(worst).scores["阳虚质"] == 100.0
+
+
+@pytest.mark.parametrize("sex, asked, skipped", [("女", "q36", "q37"), ("男", "q37", "q36")])
+def test_sex_specific_items(sex, asked, skipped):
+    ids = [question.id for question in constitution.questions_for(sex)]
+    assert asked in ids and skipped not in ids
+    assert len(ids) == len(QUESTIONS) - 1
+    answers = {qid: 1 for qid in ids}
+    answers[asked] = 5
+    # 湿热质只按 6 个作答条目计分：(6 + 4 - 6) / 24 × 100
+    assert judge(answers, sex).scores["湿热质"] == round(4 / 24 * 100, 1)
+
+
+def peaceful_answers(others):
+    # 平和质满分，其余各体质的转化分约为 others
+    answers = {qid: 1 + others / 25 for qid in QUESTION_IDS}
+    answers.update({item.lstrip("-"): 1 if item.startswith("-") else 5 for item in TYPE_ITEMS["平和质"]})
+    return answers
+
+
+@pytest.mark.parametrize("others, expected", [(0, "是"), (37.5, "基本是"), (50, "否")])
+def test_peaceful_rules(others, expected):
+    answers = peaceful_answers(others)
+    scores = score([answer_row(answers)])
+    assert scores[0, constitution.PEACEFUL] >= constitution.PEACEFUL_SCORE
+    result = judge(answers)
+    assert result.results["平和质"] == expected
+    if expected == "否":
+        assert result.primary != "平和质"
+    else:
+        assert (result.primary, result.primary_result) == ("平和质", expected)
+
+
+def test_biased_thresholds():
+    answers = {qid: 1 for qid in QUESTION_IDS}
+    answers.update({qid: 3 for qid in TYPE_ITEMS["气郁质"]})  # 50 分
+    answers.update({qid: 2.4 for qid in TYPE_ITEMS["阴虚质"]})  # 35 分
+    result = judge(answers)
+    assert result.results["气郁质"] == "是"
+    assert result.results["阴虚质"] == "倾向是"
+    assert (result.primary, result.primary_result) == ("气郁质", "是")
+
+
+def test_csv_round_trip(tmp_path):
+    answers = constitution.random_answers(20, seed=3)
+    path = tmp_path / "answers.csv"
+    header = ["id", *QUESTION_IDS]
+    rows = [[f"p{i}", *("" if np.isnan(v) else int(v) for v in row)] for i, row in enumerate(answers)]
+    constitution.write_results(str(path), dict(zip(header, zip(*rows))))
+    ids, loaded = constitution.read_answers(str(path))
+    assert ids.tolist() == [f"p{i}" for i in range(20)]
+    assert np.array_equal(np.isnan(loaded), np.isnan(answers))
+    assert np.array_equal(np.nan_to_num(loaded), np.nan_to_num(answers))
+
+    output = tmp_path / "result.csv"
+    count, _ = constitution.score_file(str(path), str(output))
+    assert count == 20
+    result_ids, _ = constitution.read_answers(str(output))
+    assert result_ids.tolist() == ids.tolist()
+    with open(output, encoding="utf-8-sig") as f:
+        header = f.readline().strip().split(",")
+    assert header[:3] == ["id", "平和质_转化分", "平和质_判定"]
+    assert header[-2:] == ["主要体质", "主要体质_判定"]
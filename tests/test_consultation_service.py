@@ -0,0 +1,150 @@
+import asyncio
+import json
+from http import HTTPStatus
+
+import httpx
+import pytest
+
+from consultation_service import (
+    MODE_DIAGNOSIS,
+    ConsultationService,
+    GLMClient,
+    ModelRoute,
+    ServiceConfig,
+    UpstreamError,
+    start_http_server,
+)
+
+ROUTES = {MODE_DIAGNOSIS: (ModelRoute("primary", timeout=1.0), ModelRoute("fallback", timeout=1.0))}
+
+
+class RejectingClient:
+    """对 rejected 中的模型返回 400，其余模型正常回复。"""
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.models = []
+
+    async def chat(self, payload, usage=None):
+        self.models.append(payload["model"])
+        if payload["model"] in self.rejected:
+            raise UpstreamError(f"{payload['model']} 不存在", HTTPStatus.BAD_REQUEST)
+        return f"{payload['model']} 的回复"
+
+    async def stream_chat(self, payload, usage=None):
+        self.models.append(payload["model"])
+        if payload["model"] in self.rejected:
+            raise UpstreamError(f"{payload['model']} 不存在", HTTPStatus.BAD_REQUEST)
+        yield f"{payload['model']} 的回复"
+
+
+def make_service(client):
+    config = ServiceConfig(routes=ROUTES, rate_per_second=0, inquiry_cache_size=0)
+    return ConsultationService(client, lambda: None, None, config)
+
+
+async def collect(stream):
+    return "".join([delta async for delta in stream])
+
+
+def test_client_error_on_primary_falls_back():
+    client = RejectingClient({"primary"})
+    service = make_service(client)
+    content = asyncio.run(service.complete([{"role": "user", "content": "头痛"}], MODE_DIAGNOSIS))
+    assert content == "fallback 的回复"
+    assert client.models == ["primary", "fallback"]
+    # 请求错误不计入熔断
+    assert service.breaker.failures == 0
+    assert service.router.fallbacks == {(MODE_DIAGNOSIS, "primary", "error"): 1}
+
+
+def test_client_error_on_primary_falls_back_when_streaming():
+    client = RejectingClient({"primary"})
+    service = make_service(client)
+    content = asyncio.run(collect(service.stream([{"role": "user", "content": "头痛"}], MODE_DIAGNOSIS)))
+    assert content == "fallback 的回复"
+    assert client.models == ["primary", "fallback"]
+
+
+def test_client_error_on_every_route_is_raised_without_retry():
+    client = RejectingClient({"primary", "fallback"})
+    service = make_service(client)
+    with pytest.raises(UpstreamError) as excinfo:
+        asyncio.run(service.complete([{"role": "user", "content": "头痛"}], MODE_DIAGNOSIS))
+    assert excinfo.value.status_code == HTTPStatus.BAD_REQUEST
+    assert client.models == ["primary", "fallback"]
+    assert service.breaker.failures == 0
+
+
+@pytest.mark.parametrize("body", ["<html>bad gateway</html>", '{"choices": []}', '{"choices": [{"message": null}]}'])
+def test_malformed_upstream_body_is_retryable_upstream_error(body):
+    client = GLMClient("key", base_url="http://glm.test")
+    client._http = httpx.AsyncClient(
+        base_url="http://glm.test", transport=httpx.MockTransport(lambda request: httpx.Response(200, text=body))
+    )
+    with pytest.raises(UpstreamError) as excinfo:
+        asyncio.run(client.chat({"model": "primary", "messages": []}))
+    assert excinfo.value.retryable
+
+
+async def raw_exchange(service, raw):
+    server = await start_http_server(service, port=0)
+    try:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(raw)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+    finally:
+        server.close()
+    return response
+
+
+async def http_exchange(service, raw):
+    return int((await raw_exchange(service, raw)).split(b" ", 2)[1])
+
+
+def consult_request(body):
+    body = body.encode("utf-8")
+    return b"POST /v1/consult HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+
+
+@pytest.mark.parametrize("raw", [
+    b"GARBAGE\r\n\r\n",
+    b"POST /v1/consult HTTP/1.1\r\nContent-Length: x\r\n\r\n",
+    consult_request('"query"'),
+    consult_request('{"query": "头痛", "history": "x"}'),
+    consult_request('{"query": "头痛", "age": [30]}'),
+])
+def test_malformed_consult_request_gets_400(raw):
+    assert asyncio.run(http_exchange(make_service(RejectingClient(set())), raw)) == HTTPStatus.BAD_REQUEST
+
+
+def test_unexpected_consult_error_gets_500():
+    service = make_service(RejectingClient(set()))
+
+    async def broken(**params):
+        raise RuntimeError("boom")
+
+    service.consult = broken
+    assert asyncio.run(http_exchange(service, consult_request('{"query": "头痛"}'))) == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+def test_oversized_request_gets_413_without_reading_the_body():
+    raw = b"POST /v1/consult HTTP/1.1\r\nContent-Length: 1000000000\r\n\r\n{}"
+    status = asyncio.run(http_exchange(make_service(RejectingClient(set())), raw))
+    assert status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+
+def test_stream_strips_markers_split_across_chunks():
+    service = make_service(RejectingClient(set()))
+
+    async def chunks(**params):
+        for delta in ["答<", "|begin_of", "_box|>案<|end_of_box|", ">。<"]:
+            yield delta
+
+    service.consult_stream = chunks
+    response = asyncio.run(raw_exchange(service, consult_request('{"query": "头痛", "stream": true}')))
+    events = [line[6:] for line in response.decode("utf-8").split("\n") if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    assert "".join(json.loads(event)["delta"] for event in events[:-1]) == "答案。<"
@@ -0,0 +1,65 @@
+import re
+
+import pytest
+
+from benchmarks.mock_glm import DIAGNOSIS_REPLY, INQUIRY_REPLY, MORE_ADVICE_REPLY
+from formatting import format_ai_content, format_ai_content_no_bold, render_reply
+
+
+# 逐条替换的原始实现，作为输出一致性的基准
+def reference_format(content, bold=True):
+    content = re.sub(r'b>([^<]+?)/b>', r'<b>\1</b>' if bold else r'\1', content)
+    content = re.sub(r'br>', r'<br>', content)
+    content = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>' if bold else r'\1', content)
+    content = re.sub(r'(\d+\.)', r'<br>\1', content)
+    content = re.sub(r'（[一二三四五六七八九十]）', r'<br>\g<0>', content)
+    content = re.sub(r'([一二三四五六七八九十])、([^\n<]+)', r'<br>\1、\2', content)
+    content = re.sub(r'•\s*(.+)', r'<ul><li>\1</li></ul>', content)
+    content = re.sub(r'(?<!<)(<)(?![a-z/])', '', content)
+    # 原实现之后新增的一步：只保留格式化产生的标签
+    return re.sub(r"<(?!(?:/?(?:b|ul|li)|br/?)>)", "&lt;", content.replace("\n", ""))
+
+
+CASES = [
+    "",
+    "舌淡苔白",
+    "<<br>",
+    "**•**",
+    "•****",
+    "• **气虚** 为主",
+    "b>气虚/b>，br>宜健脾",
+    "一、辨证分析 二、养生建议\n三、注意",
+    "（一）饮食（二）起居",
+    "1.早睡 2.少食辛辣 10.复诊",
+    "a < b，<b>加粗</b>，<br>",
+    "**一、标题**\n• 条目一\n•条目二",
+    "**未闭合的加粗",
+    INQUIRY_REPLY,
+    DIAGNOSIS_REPLY,
+    MORE_ADVICE_REPLY,
+]
+
+
+@pytest.mark.parametrize("content", CASES)
+def test_matches_reference_formatter(content):
+    assert format_ai_content(content) == reference_format(content, bold=True)
+    assert format_ai_content_no_bold(content) == reference_format(content, bold=False)
+
+
+def test_render_reply_splits_diagnosis():
+    rendered = render_reply(DIAGNOSIS_REPLY)
+    assert rendered["kind"] == "diagnosis"
+    assert rendered["suggestions"] is not None
+    assert render_reply(INQUIRY_REPLY)["kind"] == "inquiry"
+
+
+@pytest.mark.parametrize("content", [
+    "<script>alert(1)</script>",
+    "<img src=x onerror=alert(1)>",
+    "<b onmouseover=alert(1)>气虚</b>",
+    "未闭合 <img src=x onerror=alert(1)",
+    "<iframe src=javascript:alert(1)>",
+])
+def test_model_html_cannot_inject_markup(content):
+    for rendered in (format_ai_content(content), format_ai_content_no_bold(content)):
+        assert re.findall(r"<[^>]*", rendered) == re.findall(r"<(?:/?(?:b|ul|li)|br/?)(?=>)", rendered)
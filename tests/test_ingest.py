@@ -0,0 +1,26 @@
+import pytest
+
+import ingest
+from knowledge_base import KNOWLEDGE_PATH, parse_knowledge
+
+
+def fields(records):
+    return [(r.section, r.disease, r.syndrome, r.symptoms, r.remedies, r.notes) for r in records]
+
+
+@pytest.mark.parametrize("block_chars", [200, 1000, 5000])
+def test_blocks_parse_like_the_whole_file(block_chars):
+    with open(KNOWLEDGE_PATH, encoding="utf-8") as f:
+        whole = parse_knowledge(f.read())
+    blocks = list(ingest.iter_blocks(KNOWLEDGE_PATH, block_chars))
+    assert fields([record for block in blocks for record in parse_knowledge(block)]) == fields(whole)
+
+
+def test_headingless_file_is_split_at_blank_lines(tmp_path):
+    path = tmp_path / "plain.txt"
+    text = ("一段没有标题的文字。" * 20 + "\n\n") * 500
+    path.write_text(text, encoding="utf-8")
+    blocks = list(ingest.iter_blocks(str(path), 2000))
+    assert len(blocks) > 1
+    assert max(map(len, blocks)) <= 2 * 2000 + 202
+    assert "".join(blocks) == text
@@ -0,0 +1,53 @@
+import types
+
+import pytest
+
+import llm_cache
+from llm_cache import ResponseCache, make_cache_key, normalize_query
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(llm_cache, "time", types.SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), ttl_seconds=60)
+    cache.set("a", "回复")
+    clock.value += 59
+    assert cache.get("a") == "回复"
+    clock.value += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_reads_refresh_lru_order(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), max_entries=2)
+    cache.set("a", "1")
+    clock.value += 1
+    cache.set("b", "2")
+    clock.value += 1
+    assert cache.get("a") == "1"
+    clock.value += 1
+    cache.set("c", "3")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("1", "3")
+
+
+def test_expired_entries_are_purged_on_write(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), ttl_seconds=60)
+    cache.set("old", "1")
+    clock.value += 120
+    cache.set("new", "2")
+    assert len(cache) == 1
+
+
+def test_cache_key_ignores_symptom_order_and_width():
+    args = ("diagnosis", ["r1", "r2"], "女", "青年", "GLM-4.5V", 0.2)
+    key = make_cache_key(args[0], "头痛、失眠", *args[1:])
+    assert make_cache_key(args[0], " 失眠，头痛 ", *args[1:]) == key
+    assert make_cache_key(args[0], "头痛、失眠", ["r2", "r1"], *args[2:]) != key
+    assert normalize_query("ＡＢＣ") == "abc"
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import pytest
+
+from consultation_service import ServiceRunner
+from prefetch import Prefetcher
+
+
+@pytest.fixture(scope="module")
+def runner():
+    return ServiceRunner()
+
+
+def returning(value, delay=0.0):
+    async def coro():
+        await asyncio.sleep(delay)
+        return value
+
+    return coro
+
+
+def failing():
+    async def coro():
+        raise RuntimeError("boom")
+
+    return coro
+
+
+def wait_idle(prefetcher):
+    deadline = time.monotonic() + 5
+    while prefetcher.stats()["in_flight"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_take_finished_and_inflight_results(runner):
+    prefetcher = Prefetcher(runner)
+    assert prefetcher.start("done", "s1", returning("建议"))
+    assert prefetcher.start("slow", "s1", returning("稍后的建议", 0.2))
+    prefetcher._entries["done"].future.result(5)
+    assert prefetcher.take("done") == "建议"
+    assert prefetcher.take("slow", timeout=5) == "稍后的建议"
+    assert prefetcher.take("done") is None
+    stats = prefetcher.stats()
+    assert (stats["hit"], stats["hit_inflight"], stats["miss"]) == (1, 1, 1)
+    assert stats["hit_rate"] == round(2 / 3, 3)
+
+
+def test_take_timeout_cancels_and_falls_back(runner):
+    prefetcher = Prefetcher(runner)
+    prefetcher.start("key", "s1", returning("太慢", 10))
+    future = prefetcher._entries["key"].future
+    assert prefetcher.take("key", timeout=0.05) is None
+    assert future.cancelled()
+    wait_idle(prefetcher)
+    assert prefetcher.stats()["miss"] == 1
+    assert prefetcher.stats()["in_flight"] == 0
+
+
+def test_failed_prefetch_is_counted(runner):
+    prefetcher = Prefetcher(runner)
+    prefetcher.start("key", "s1", failing())
+    assert prefetcher.take("key", timeout=5) is None
+    assert prefetcher.stats()["failed"] == 1
+
+
+def test_cancel_session_counts_cancelled_and_wasted(runner):
+    prefetcher = Prefetcher(runner)
+    prefetcher.start("finished", "s1", returning("没人看"))
+    prefetcher._entries["finished"].future.result(5)
+    prefetcher.start("running", "s1", returning("生成中", 10))
+    prefetcher.start("other", "s2", returning("另一个会话", 10))
+    prefetcher.cancel_session("s1")
+    stats = prefetcher.stats()
+    assert (stats["wasted"], stats["cancelled"]) == (1, 1)
+    assert stats["pending"] == 1
+    prefetcher.cancel_session("s2")
+    wait_idle(prefetcher)
+    assert prefetcher.stats()["cancelled"] == 2
+
+
+def test_inflight_limit_skips_new_prefetches(runner):
+    prefetcher = Prefetcher(runner, max_inflight=1)
+    assert prefetcher.start("a", "s1", returning("a", 10))
+    assert not prefetcher.start("b", "s1", returning("b"))
+    assert prefetcher.stats()["skipped"] == 1
+    prefetcher.cancel_session("s1")
+    wait_idle(prefetcher)
+    assert prefetcher.start("c", "s1", returning("c"))
+    assert prefetcher.take("c", timeout=5) == "c"
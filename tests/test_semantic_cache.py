@@ -0,0 +1,62 @@
+import math
+
+from semantic_cache import SemanticCache
+
+FEMALE = ("女", "青年", "GLM-4.5V", 0.2)
+MALE = ("男", "青年", "GLM-4.5V", 0.2)
+
+
+def at_angle(cosine):
+    return [cosine, math.sqrt(1 - cosine ** 2)]
+
+
+def embedder(vectors):
+    return lambda query: vectors.get(query)
+
+
+def test_exact_match_ignores_symptom_order():
+    cache = SemanticCache(max_entries=4)
+    _, probe = cache.lookup(FEMALE, "头痛、失眠")
+    cache.store(probe, "追问")
+    response, probe = cache.lookup(FEMALE, "失眠，头痛")
+    assert (response, probe.result) == ("追问", "exact")
+
+
+def test_semantic_match_respects_threshold():
+    cache = SemanticCache(max_entries=4, threshold=0.95)
+    embed = embedder({"头痛": [1.0, 0.0], "头疼": at_angle(0.96), "头晕": at_angle(0.9)})
+    _, probe = cache.lookup(FEMALE, "头痛", embed)
+    cache.store(probe, "追问")
+    response, probe = cache.lookup(FEMALE, "头疼", embed)
+    assert (response, probe.result, probe.similarity) == ("追问", "semantic", 0.96)
+    response, probe = cache.lookup(FEMALE, "头晕", embed)
+    assert (response, probe.result) == (None, "miss")
+
+
+def test_partitions_are_isolated():
+    cache = SemanticCache(max_entries=4)
+    embed = embedder({"头痛": [1.0, 0.0]})
+    _, probe = cache.lookup(FEMALE, "头痛", embed)
+    cache.store(probe, "女性的追问")
+    assert cache.lookup(MALE, "头痛", embed)[0] is None
+    _, probe = cache.lookup(MALE, "头痛", embed)
+    cache.store(probe, "男性的追问")
+    assert cache.lookup(FEMALE, "头痛", embed)[0] == "女性的追问"
+    assert cache.lookup(MALE, "头痛", embed)[0] == "男性的追问"
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(max_entries=2)
+    embed = embedder({"a": [1.0, 0.0], "b": [0.0, 1.0], "c": [-1.0, 0.0]})
+    for query in ("a", "b"):
+        _, probe = cache.lookup(FEMALE, query, embed)
+        cache.store(probe, query)
+    assert cache.lookup(FEMALE, "a", embed)[0] == "a"
+    _, probe = cache.lookup(FEMALE, "c", embed)
+    cache.store(probe, "c")
+    assert len(cache) == 2
+    assert cache.lookup(FEMALE, "b", embed)[0] is None
+    assert cache.lookup(FEMALE, "a", embed)[0] == "a"
+    # 被淘汰槽位的向量不再参与语义匹配
+    assert cache.lookup(FEMALE, "b2", embedder({"b2": [0.0, 1.0]}))[0] is None
+    assert cache.status()["evicted"] == 1
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from session_store import (
+    MemorySessionStore,
+    SessionHistory,
+    SQLiteSessionStore,
+    issue_session_token,
+    load_session_secret,
+    new_session_id,
+    verify_session_token,
+)
+
+SECRET = b"s" * 32
+
+
+def test_token_round_trip():
+    session_id = new_session_id()
+    assert verify_session_token(issue_session_token(session_id, SECRET), SECRET) == session_id
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda token: token[:-1] + ("0" if token[-1] != "0" else "1"),
+    lambda token: ("0" if token[0] != "0" else "1") + token[1:],
+    lambda token: token.partition(".")[0],
+    lambda token: "",
+    lambda token: None,
+    lambda token: "../etc/passwd." + token.partition(".")[2],
+])
+def test_tampered_tokens_are_rejected(tamper):
+    token = issue_session_token(new_session_id(), SECRET)
+    assert verify_session_token(tamper(token), SECRET) is None
+
+
+def test_token_from_another_secret_is_rejected():
+    token = issue_session_token(new_session_id(), b"other secret")
+    assert verify_session_token(token, SECRET) is None
+
+
+def test_secret_file_is_created_once(tmp_path):
+    path = str(tmp_path / "secret")
+    assert load_session_secret(path) == load_session_secret(path)
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    return MemorySessionStore()
+
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+
+def test_concurrent_appends_get_distinct_seqs(store):
+    session_id = new_session_id()
+
+    def worker(n):
+        for i in range(25):
+            store.append_messages(session_id, [message("user", f"{n}-{i}"), message("assistant", f"{n}-{i}")])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    messages = store.load_messages(session_id, 0, 200)
+    assert len(messages) == store.count_messages(session_id) == 200
+    # 每轮的提问与回复相邻
+    for user, assistant in zip(messages[::2], messages[1::2]):
+        assert (user["role"], assistant["role"]) == ("user", "assistant")
+        assert user["content"] == assistant["content"]
+
+
+def test_history_reloads_after_another_writer_appends(store):
+    session_id = new_session_id()
+    first, second = SessionHistory(store, session_id, window=4), SessionHistory(store, session_id, window=4)
+    first.extend([message("user", "1"), message("assistant", "1")])
+    second.extend([message("user", "2"), message("assistant", "2")])
+    assert [msg["content"] for msg in second] == ["1", "1", "2", "2"]
+    assert second[-1] == message("assistant", "2")
+    second.save(-1, message("assistant", "2'"))
+    assert store.load_messages(session_id, 3, 4) == [message("assistant", "2'")]
+
+
+def test_history_pages_older_messages_from_the_store(store):
+    session_id = new_session_id()
+    history = SessionHistory(store, session_id, window=2)
+    for i in range(5):
+        history.append(message("user", str(i)))
+    assert len(history._recent) == 2
+    assert [msg["content"] for msg in history[1:4]] == ["1", "2", "3"]
+    assert [msg["content"] for msg in SessionHistory(store, session_id, window=2)] == ["0", "1", "2", "3", "4"]
+
+
+def test_memory_store_evicts_by_bytes():
+    store = MemorySessionStore(max_bytes=2000)
+    blob = "".join(chr(0x4E00 + i) for i in range(200))
+    for i in range(10):
+        store.append_message(f"s{i}", message("user", blob))
+    assert store.total_bytes <= 2000
+    assert 0 < len(store) < 10
+    assert store.count_messages("s9") == 1
+    store.clear_messages("s9")
+    assert store.total_bytes == sum(entry[3] for entry in store._sessions.values())
@@ -0,0 +1,45 @@
+import math
+
+import pytest
+
+from knowledge_base import KnowledgeDocument, SymptomIndex
+
+SYNONYMS = {"偏头痛": ["头痛"], "心神不宁": ["心悸不宁"]}
+VOCABULARY = ["头痛", "偏头痛", "失眠", "心悸", "心神不宁", "打喷嚏"]
+
+
+def record(name, symptoms):
+    return KnowledgeDocument(name, {"disease": name, "symptoms": symptoms})
+
+
+@pytest.fixture
+def index():
+    documents = [
+        record("甲", "头痛，恶寒"),
+        record("乙", "偏头痛，失眠"),
+        record("丙", "失眠多梦"),
+        record("丁", "入夜心悸不宁"),
+    ]
+    return SymptomIndex(documents, VOCABULARY, SYNONYMS)
+
+
+def test_longer_terms_consume_their_span(index):
+    assert index.terms_in("最近偏头痛") == ["偏头痛"]
+    assert index.terms_in("头痛，偏头痛") == ["头痛", "偏头痛"]
+    assert index.terms_in("心悸不宁") == ["心神不宁"]
+
+
+def test_shared_synonym_maps_to_every_term(index):
+    # "头痛"是"偏头痛"的同义说法：提到头痛的证型两种选择都能匹配到
+    assert index.postings["头痛"] == {0}
+    assert index.postings["偏头痛"] == {0, 1}
+    assert "心悸" not in index.postings
+
+
+def test_terms_without_postings_stay_in_the_denominator(index):
+    [candidate] = index.match(["失眠", "打喷嚏"], k=1)
+    total = index.weights["失眠"] + index.default_weight
+    assert candidate.matched == ("失眠",)
+    assert candidate.score == round(index.weights["失眠"] / total, 3)
+    assert index.default_weight == math.log(1 + 4)
+    assert index.match([]) == []
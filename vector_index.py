@@ -0,0 +1,294 @@
+# ----------- 预编译 NumPy 向量索引 -----------
+# 部署时把知识库记录的向量预先算好，存成可内存映射的 float16/int8 矩阵和一份元数据；
+# 运行时只需 NumPy 做一次矩阵乘 + top-k，查询向量由量化后的 ONNX 编码器在 CPU 上计算，
+# 不再加载 Chroma、SQLite 持久化和完整的 PyTorch 模型。
+#
+# 用法：
+#   python vector_index.py build [--dtype int8]     # 生成 vector_index/ 下的矩阵和元数据
+#   python vector_index.py export-onnx              # 导出并动态量化查询编码器到 vector_index/onnx/
+#   python vector_index.py verify                   # 与 Chroma 的向量检索、融合检索和 MMR 结果逐条对比
+import argparse
+import json
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+from knowledge_base import (
+    CHROMA_PERSIST_DIR,
+    EMBEDDING_MODEL,
+    KNOWLEDGE_FILE,
+    PROJECT_DIR,
+    SPLITTER_CONFIG,
+    KnowledgeDocument,
+    load_knowledge_entries,
+)
+
+INDEX_DIR = os.path.join(PROJECT_DIR, "vector_index")
+ONNX_SUBDIR = "onnx"
+ONNX_MODEL_FILE = "model_quantized.onnx"
+# 与 sentence-transformers 中该模型的 max_seq_length 保持一致
+MAX_SEQ_LENGTH = 128
+# 分块把低精度矩阵转成 float32 做乘法，内存占用与语料规模无关
+SCORE_BLOCK_ROWS = 4096
+
+logger = logging.getLogger("tcm.vector_index")
+
+
+class SentenceTransformerEncoder:
+    def __init__(self, model_name=EMBEDDING_MODEL, batch_size=32):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        # 模型前向的批大小，批量导入时由 ingest.py 调优
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        return np.asarray(self.model.encode(list(texts), batch_size=self.batch_size), dtype=np.float32)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class OnnxQueryEncoder:
+    """动态量化的 ONNX 编码器，做与 sentence-transformers 相同的 mean pooling。"""
+
+    def __init__(self, model_dir):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_FILE), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {item.name for item in self.session.get_inputs()}
+
+    def embed_query(self, text):
+        encoding = self.tokenizer.encode(text)
+        feeds = {
+            "input_ids": np.asarray([encoding.ids], dtype=np.int64),
+            "attention_mask": np.asarray([encoding.attention_mask], dtype=np.int64),
+        }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+        hidden = self.session.run(None, feeds)[0][0]
+        mask = feeds["attention_mask"][0][:, None].astype(np.float32)
+        return (hidden * mask).sum(axis=0) / max(mask.sum(), 1.0)
+
+    def embed_documents(self, texts):
+        # 逐条推理，省去 padding；只用于启动时预热查询向量
+        return np.stack([self.embed_query(text) for text in texts])
+
+
+def load_query_encoder(index_dir=INDEX_DIR, model_name=EMBEDDING_MODEL):
+    # 有导出的 ONNX 模型且装了 onnxruntime/tokenizers 时用它，否则退回 sentence-transformers
+    onnx_dir = os.path.join(index_dir, ONNX_SUBDIR)
+    if os.path.exists(os.path.join(onnx_dir, ONNX_MODEL_FILE)):
+        try:
+            return OnnxQueryEncoder(onnx_dir)
+        except ImportError as e:
+            logger.warning("已导出 ONNX 编码器但无法加载（%s），退回 sentence-transformers，启动会加载完整的 PyTorch 模型", e)
+    else:
+        logger.warning("%s 下没有导出的 ONNX 编码器，使用 sentence-transformers；可运行 python vector_index.py export-onnx", onnx_dir)
+    return SentenceTransformerEncoder(model_name)
+
+
+class NumpyVectorStore:
+    """内存映射的向量矩阵 + 元数据，接口与 HybridRetriever 用到的 Chroma 方法一致。
+
+    Chroma 默认使用（平方）L2 距离，langchain 再换算成 1 - d/√2 的相关度；
+    这里按同样的公式计算，排序与 get_relevant_documents 的输出保持一致。
+    """
+
+    def __init__(self, index_dir, encoder=None):
+        with open(os.path.join(index_dir, "metadata.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.embedding_model = meta["embedding_model"]
+        self.splitter = meta["splitter"]
+        self.dtype = meta["dtype"]
+        self.documents = [KnowledgeDocument(item["page_content"], item["metadata"]) for item in meta["records"]]
+        self.matrix = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r")
+        self.sq_norms = np.load(os.path.join(index_dir, "sq_norms.npy"))
+        self.scales = np.load(os.path.join(index_dir, "scales.npy")) if self.dtype == "int8" else None
+        self.encoder = encoder
+
+    def content_hashes(self):
+        return {doc.metadata["record_id"]: doc.metadata["content_hash"] for doc in self.documents}
+
+    def _dot(self, query):
+        scores = np.empty(len(self.documents), dtype=np.float32)
+        for start in range(0, len(scores), SCORE_BLOCK_ROWS):
+            block = np.asarray(self.matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            scores[start:start + len(block)] = block @ query
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def search_by_vector(self, query, k=4):
+        query = np.asarray(query, dtype=np.float32)
+        distances = self.sq_norms - 2 * self._dot(query) + float(query @ query)
+        k = min(k, len(distances))
+        if k <= 0:
+            return []
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(self.documents[i], float(distances[i])) for i in top]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.search_by_vector(self.encoder.embed_query(query), k)
+
+    def similarity_search_with_relevance_scores(self, query, k=4):
+        return [(doc, 1.0 - distance / math.sqrt(2)) for doc, distance in self.similarity_search_with_score(query, k)]
+
+    def similarity_search(self, query, k=4):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+
+def is_index_current(store, documents, embedding_model=EMBEDDING_MODEL, splitter=SPLITTER_CONFIG):
+    current = {doc.metadata["record_id"]: doc.metadata["content_hash"] for doc in documents}
+    return store.embedding_model == embedding_model and store.splitter == splitter and store.content_hashes() == current
+
+
+def quantize(vectors, dtype="float16"):
+    """返回 (存储矩阵, 每行缩放系数或 None, 平方范数)；逐行独立计算，可分批调用。"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "int8":
+        # 每行独立的对称量化：v ≈ q * scale
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        stored = np.round(vectors / scales[:, None]).astype(np.int8)
+        restored = stored.astype(np.float32) * scales[:, None]
+        scales = scales.astype(np.float32)
+    elif dtype == "float16":
+        stored = vectors.astype(np.float16)
+        restored = stored.astype(np.float32)
+        scales = None
+    else:
+        raise ValueError(f"不支持的向量精度：{dtype}")
+    # 范数按量化后的向量计算，保证距离公式自洽
+    return stored, scales, (restored ** 2).sum(axis=1).astype(np.float32)
+
+
+def build_index(entries, encoder, index_dir=INDEX_DIR, dtype="float16", embedding_model=EMBEDDING_MODEL, splitter=SPLITTER_CONFIG):
+    vectors = encoder.embed_documents([text for text, _ in entries]).astype(np.float32)
+    os.makedirs(index_dir, exist_ok=True)
+    stored, scales, sq_norms = quantize(vectors, dtype)
+    if scales is not None:
+        np.save(os.path.join(index_dir, "scales.npy"), scales)
+    np.save(os.path.join(index_dir, "embeddings.npy"), stored)
+    np.save(os.path.join(index_dir, "sq_norms.npy"), sq_norms)
+    meta = {
+        "embedding_model": embedding_model,
+        "splitter": splitter,
+        "dtype": dtype,
+        "dim": int(vectors.shape[1]),
+        "records": [{"page_content": text, "metadata": metadata} for text, metadata in entries],
+    }
+    with open(os.path.join(index_dir, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return len(entries)
+
+
+def export_onnx(index_dir=INDEX_DIR, model_name=EMBEDDING_MODEL):
+    # 仅在构建阶段需要 torch 和 onnxruntime.quantization
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    out_dir = os.path.join(index_dir, ONNX_SUBDIR)
+    os.makedirs(out_dir, exist_ok=True)
+    model = SentenceTransformer(model_name)
+    transformer = model[0].auto_model.eval()
+    model.tokenizer.save_pretrained(out_dir)
+    sample = model.tokenizer(["头痛失眠"], return_tensors="pt")
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=14,
+        )
+    quantize_dynamic(fp32_path, os.path.join(out_dir, ONNX_MODEL_FILE), weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+    return out_dir
+
+
+def verify(index_dir, queries, k=8, knowledge_file=KNOWLEDGE_FILE):
+    """对比 Chroma 与 NumPy 索引的检索结果，返回逐条的重合率。
+
+    除向量 top-k 外，还把两个向量库分别接到同一个 HybridRetriever 上，对比应用实际使用的
+    融合检索（get_relevant_documents）与 MMR（辨证用的前 4 条、"更多中医建议"用的前 8 条）。
+    """
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from langchain_community.vectorstores import Chroma
+
+    from knowledge_base import HybridRetriever, load_knowledge_documents
+
+    reference = Chroma(
+        persist_directory=CHROMA_PERSIST_DIR,
+        embedding_function=HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL),
+    )
+    store = NumpyVectorStore(index_dir, load_query_encoder(index_dir))
+    lexical = HybridRetriever(load_knowledge_documents(knowledge_file))
+    reference_retriever = lexical.with_vectorstore(reference)
+    retriever = lexical.with_vectorstore(store)
+    report = []
+    for query in queries:
+        expected = [doc.metadata["record_id"] for doc in reference.similarity_search(query, k=k)]
+        start = time.perf_counter()
+        actual = [doc.metadata["record_id"] for doc in store.similarity_search(query, k=k)]
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        row = {"query": query, **_compare(expected, actual), "latency_ms": round(elapsed_ms, 3)}
+        for name, search in (
+            ("hybrid", lambda r: r.get_relevant_documents(query, k=k)),
+            ("mmr4", lambda r: r.max_marginal_relevance_search(query, k=4)),
+            ("mmr8", lambda r: r.max_marginal_relevance_search(query, k=8)),
+        ):
+            row[name] = _compare(
+                [doc.metadata["record_id"] for doc in search(reference_retriever)],
+                [doc.metadata["record_id"] for doc in search(retriever)],
+            )
+        report.append(row)
+    return report
+
+
+def _compare(expected, actual):
+    return {"overlap": len(set(expected) & set(actual)) / max(len(expected), 1), "same_order": expected == actual}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="预编译 NumPy 向量索引")
+    parser.add_argument("command", choices=["build", "export-onnx", "verify"])
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--knowledge", default=KNOWLEDGE_FILE)
+    parser.add_argument("--dtype", choices=["float16", "int8"], default="float16")
+    parser.add_argument("--query", action="append", help="verify 时使用的查询，可重复指定")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        count = build_index(load_knowledge_entries(args.knowledge), SentenceTransformerEncoder(), args.index_dir, args.dtype)
+        print(f"已写入 {count} 条记录到 {args.index_dir}（{args.dtype}），耗时 {time.perf_counter() - start:.1f}s")
+    elif args.command == "export-onnx":
+        print(f"量化编码器已导出到 {export_onnx(args.index_dir)}")
+    else:
+        queries = args.query or ["痰多黄稠", "头痛、失眠", "手脚冰凉，腰酸背痛", "焦虑易怒，心悸"]
+        for row in verify(args.index_dir, queries, knowledge_file=args.knowledge):
+            print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()